@@ -0,0 +1,410 @@
+#!/usr/bin/env python
+
+"""
+Measures how the clustering and similarity search scale with the number of workflows.
+
+For each size, a synthetic error history is generated and stored in an SQLite file.
+Sites and error codes are drawn from long-tailed distributions,
+so a few of them account for most errors, like in production.
+Then these steps are timed, along with their peak memory:
+
+- ``vectorize``: :py:func:`clusterworkflows.get_workflow_matrix`
+- ``fit``: :py:func:`clusterworkflows.fit_clusterer`
+- ``predict``: :py:func:`clusterworkflows.get_workflow_groups`
+- ``group``: one :py:func:`clusterworkflows.get_clustered_group` call
+- ``neighbors_build``: building a :py:class:`neighbors.NeighborIndex`
+- ``neighbors``: one :py:meth:`neighbors.NeighborIndex.query`
+
+The results are compared with a baseline file.
+Times depend on the machine, so a fixed calibration workload is also timed,
+and the baseline stores each time as a multiple of the calibration time.
+The calibration runs on one core, so everything else is also limited to one thread,
+including the k-means fit and the numerical libraries.
+Otherwise the relative times would depend on the number of cores.
+Memory is stored in MB.
+The exit code is 1 if any time or memory is larger than its baseline
+by more than the tolerance, so this can be run in CI.
+Nothing is fetched over the network.
+
+By default, up to 100000 workflows are run, which takes about a minute.
+The 1000000 workflow size takes much longer and needs more than 6 GB of memory,
+so it is only run with ``--full``. Its baseline has to be written
+with ``--full --write-baseline`` on a machine with enough memory.
+Sizes that are not in the baseline are not compared.
+
+Usage::
+
+    python benchmarks/clustering.py --full
+    python benchmarks/clustering.py --write-baseline
+"""
+
+import os
+
+# The calibration is single-threaded, so the numerical libraries must be too.
+# These are read when the libraries are first imported.
+for _variable in ['OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS']:
+    os.environ[_variable] = '1'
+
+# pylint: disable=wrong-import-position
+import sys
+import json
+import time
+import random
+import shutil
+import sqlite3
+import argparse
+import tempfile
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+import numpy
+import scipy.sparse
+import yaml
+
+from cmstoolbox import sitereadiness
+
+from workflowwebtools import serverconfig
+from workflowwebtools import errorutils
+
+
+SIZES = [1000, 10000, 100000, 1000000]
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'clustering_baseline.json')
+
+SITES = ['T1_XX_Site%i' % site for site in range(7)] + \
+    ['T2_XX_Site%i' % site for site in range(50)] + \
+    ['T3_XX_Site%i' % site for site in range(90)]
+
+CODES = [8021, 50660, 99109, 8028, -1, 134, 50664, 71304, 61202, 8001, 50115, 99303,
+         84, 85, 92, 50513, 60450, 73, 11003, 8004] + list(range(70000, 70040))
+
+
+def zipf_choice(rand, items, exponent=1.2):
+    """
+    :param random.Random rand: The random number generator
+    :param list items: Items, most common first
+    :param float exponent: How quickly the items become less common
+    :returns: A random item
+    """
+
+    weights = zipf_choice.cache.get((id(items), exponent))
+    if weights is None:
+        weights = []
+        total = 0.0
+        for rank in range(len(items)):
+            total += 1.0/(rank + 1)**exponent
+            weights.append(total)
+        weights = [weight/total for weight in weights]
+        zipf_choice.cache[(id(items), exponent)] = weights
+
+    target = rand.random()
+    low, high = 0, len(weights) - 1
+    while low < high:
+        mid = (low + high)//2
+        if weights[mid] < target:
+            low = mid + 1
+        else:
+            high = mid
+
+    return items[low]
+
+zipf_choice.cache = {}
+
+
+def make_rows(num_workflows, seed=0):
+    """
+    Generate the errors of workflows.
+    Each workflow has a few tasks, each with a few error codes at a few sites.
+
+    :param int num_workflows: The number of workflows
+    :param int seed: Seed for the random generator
+    :returns: Rows for the workflows table, like :py:func:`errorutils.error_rows`
+    :rtype: generator
+    """
+
+    rand = random.Random(seed)
+
+    for index in range(num_workflows):
+        workflow = 'bench_wf_%i' % index
+        for task in range(rand.randint(1, 4)):
+            stepname = '/%s/Task_%i' % (workflow, task)
+            for errorcode in set(zipf_choice(rand, CODES) for _ in range(rand.randint(1, 3))):
+                for sitename in set(zipf_choice(rand, SITES) for _ in range(rand.randint(1, 5))):
+                    numbererrors = int(rand.expovariate(1.0/30)) + 1
+                    yield ('_'.join([stepname, sitename, str(errorcode)]), stepname,
+                           errorcode, sitename, numbererrors, 'green')
+
+
+def measure(function, *args):
+    """
+    Tracing memory slows down Python a lot, so the function is run twice.
+    The first run is timed and the second is traced.
+
+    :param function: The function to run
+    :param args: Arguments to the function
+    :returns: The output of the first run, seconds taken, and peak memory in MB.
+              The memory is None if tracemalloc is not available.
+    :rtype: tuple
+    """
+
+    start = time.time()
+    output = function(*args)
+    elapsed = time.time() - start
+
+    peak = None
+    if tracemalloc:
+        tracemalloc.start()
+        function(*args)
+        peak = tracemalloc.get_traced_memory()[1]/1048576.0
+        tracemalloc.stop()
+
+    return output, elapsed, peak
+
+
+def calibrate(repeat=5):
+    """
+    Times a fixed mix of Python loops and sparse matrix products,
+    which are what the benchmarked steps spend their time on.
+
+    :param int repeat: The number of times to run the workload
+    :returns: The fastest time in seconds
+    :rtype: float
+    """
+
+    rows = list(make_rows(10000, seed=2))
+    matrix = scipy.sparse.random(50000, 200, density=0.02, format='csr',
+                                 random_state=numpy.random.RandomState(0))
+
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+
+        counts = {}
+        for row in rows:
+            key = (row[1].split('/')[1], row[2], row[3])
+            counts[key] = counts.get(key, 0) + row[4]
+        sorted(counts.items())
+
+        matrix.dot(matrix[:5000].T)
+
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    return best
+
+
+def run_size(num_workflows, workdir, lookups):
+    """
+    :param int num_workflows: The number of workflows to generate
+    :param str workdir: Where to put the database
+    :param int lookups: The number of workflows to look up similar workflows for
+    :returns: The seconds and peak MB of each step
+    :rtype: dict
+    """
+
+    from workflowwebtools import globalerrors
+    from workflowwebtools import clusterworkflows
+    from workflowwebtools import neighbors
+
+    db_path = os.path.join(workdir, 'history_%i.db' % num_workflows)
+    if os.path.exists(db_path):
+        os.remove(db_path)
+
+    start = time.time()
+    conn = sqlite3.connect(db_path)
+    curs = conn.cursor()
+    errorutils.create_table(curs)
+    errorutils.insert_rows(curs, make_rows(num_workflows))
+    conn.close()
+    print('Generated %i workflows in %.1f s' % (num_workflows, time.time() - start))
+
+    session = {'info': globalerrors.ErrorInfo(db_path)}
+    workflows = session['info'].return_workflows()
+    allmap = session['info'].get_allmap()
+
+    results = {}
+
+    matrix, results['vectorize'], results['vectorize_mb'] = measure(
+        clusterworkflows.get_workflow_matrix, workflows, session, allmap)
+
+    model, results['fit'], results['fit_mb'] = measure(
+        clusterworkflows.fit_clusterer, matrix)
+    clusterer = {'clusterer': model, 'allmap': allmap}
+
+    def predict():
+        """Predict the groups without using the predictions from earlier runs"""
+        clusterworkflows._GROUPS.clear() # pylint: disable=protected-access
+        return clusterworkflows.get_workflow_groups(clusterer, session)
+
+    _, results['predict'], results['predict_mb'] = measure(predict)
+
+    sample = random.Random(1).sample(workflows, min(lookups, len(workflows)))
+
+    def lookup_groups():
+        """Look up the group of each sampled workflow"""
+        for workflow in sample:
+            clusterworkflows.get_clustered_group(workflow, clusterer, session)
+
+    _, elapsed, results['group_mb'] = measure(lookup_groups)
+    results['group'] = elapsed/len(sample)
+
+    rows = session['info'].execute(
+        'SELECT stepname, errorcode, sitename, numbererrors FROM workflows')
+    index, results['neighbors_build'], results['neighbors_build_mb'] = measure(
+        neighbors.NeighborIndex, workflows, rows, None,
+        {'k': 10, 'errorcode': 1.0, 'sitename': 1.0})
+    del rows
+
+    def lookup_neighbors():
+        """Find the neighbors of each sampled workflow"""
+        for workflow in sample:
+            index.query(workflow, 10)
+
+    _, elapsed, results['neighbors_mb'] = measure(lookup_neighbors)
+    results['neighbors'] = elapsed/len(sample)
+
+    session['info'].teardown()
+    os.remove(db_path)
+
+    return results
+
+
+SLACK = {'seconds': 0.01, 'mb': 2.0}
+"""Changes smaller than these are always allowed, because small values are noisy"""
+
+
+def to_relative(results, calibration):
+    """
+    :param dict results: The results for each size, with times in seconds
+    :param float calibration: The output of :py:func:`calibrate`
+    :returns: The results with times as multiples of the calibration time
+    :rtype: dict
+    """
+
+    return {size: {metric: value if metric.endswith('_mb') or value is None
+                           else value/calibration
+                   for metric, value in metrics.items()}
+            for size, metrics in results.items()}
+
+
+def compare(results, baseline, tolerance, calibration):
+    """
+    :param dict results: The results for each size, with times in seconds
+    :param dict baseline: The baseline results for each size,
+                          with times as multiples of the calibration time
+    :param float tolerance: The allowed fractional increase over the baseline
+    :param float calibration: The output of :py:func:`calibrate` on this machine
+    :returns: Descriptions of the metrics that regressed
+    :rtype: list
+    """
+
+    failures = []
+
+    for size, metrics in sorted(results.items()):
+        for metric, value in sorted(metrics.items()):
+            expected = baseline.get(size, {}).get(metric)
+            if value is None or expected is None:
+                continue
+
+            is_memory = metric.endswith('_mb')
+            if not is_memory:
+                # The baseline time, scaled to this machine
+                expected *= calibration
+
+            limit = max(expected * (1 + tolerance),
+                        expected + SLACK['mb' if is_memory else 'seconds'])
+            if value > limit:
+                failures.append('%s workflows, %s: %.4g > %.4g (baseline %.4g)' % (
+                    size, metric, value, limit, expected))
+
+    return failures
+
+
+def main():
+    """Runs the benchmarks and compares them to the baseline"""
+
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1])
+    parser.add_argument('--sizes', type=int, nargs='+', default=SIZES[:3],
+                        help='Numbers of workflows to test. Default is %s' % SIZES[:3])
+    parser.add_argument('--full', action='store_true',
+                        help='Test all of the sizes, %s' % SIZES)
+    parser.add_argument('--clusters', type=int, default=20, help='Number of clusters')
+    parser.add_argument('--init', type=int, default=3, help='Number of k-means initializations')
+    parser.add_argument('--lookups', type=int, default=200,
+                        help='Number of workflows to time the similarity lookups for')
+    parser.add_argument('--baseline', default=BASELINE, help='JSON file of baseline results')
+    parser.add_argument('--tolerance', type=float, default=0.5,
+                        help='Fractional increase over the baseline that fails')
+    parser.add_argument('--write-baseline', action='store_true',
+                        help='Store the results as the new baseline instead of comparing')
+    parser.add_argument('--output', help='Also write the results to this JSON file')
+    parser.add_argument('--workdir', help='Directory for the databases, default is temporary')
+
+    args = parser.parse_args()
+
+    workdir = args.workdir or tempfile.mkdtemp()
+
+    # Use a configuration with the benchmark clustering parameters in the work directory
+    with open(os.path.join(os.path.dirname(serverconfig.__file__),
+                           'default', 'config.yml'), 'r') as input_file:
+        config = yaml.load(input_file, Loader=yaml.FullLoader)
+    config['workspace'] = workdir
+    config['cluster'].update(n_clusters=args.clusters, n_init=args.init, n_jobs=1)
+    serverconfig.LOCATION = os.path.join(workdir, 'config.yml')
+    with open(serverconfig.LOCATION, 'w') as output:
+        yaml.dump(config, output)
+
+    # Site readiness would be fetched over the network
+    sitereadiness.site_readiness = lambda site: 'green'
+
+    calibration = calibrate()
+    print('Calibration workload took %.4f s' % calibration)
+
+    results = {}
+    for size in (SIZES if args.full else args.sizes):
+        results[str(size)] = run_size(size, workdir, args.lookups)
+
+        print('%10s %10s %12s %10s' % ('step', 'seconds', 'calibrations', 'peak MB'))
+        for step in ['vectorize', 'fit', 'predict', 'group', 'neighbors_build', 'neighbors']:
+            peak = results[str(size)]['%s_mb' % step]
+            print('%10s %10.4f %12.3f %10s' % (
+                step[:10], results[str(size)][step], results[str(size)][step]/calibration,
+                '-' if peak is None else '%.1f' % peak))
+
+    if not args.workdir:
+        shutil.rmtree(workdir)
+
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump({'calibration': calibration, 'results': results},
+                      output, indent=2, sort_keys=True)
+
+    if args.write_baseline:
+        baseline = {}
+        if os.path.exists(args.baseline):
+            with open(args.baseline, 'r') as input_file:
+                baseline = json.load(input_file)
+        baseline.update(to_relative(results, calibration))
+        with open(args.baseline, 'w') as output:
+            json.dump(baseline, output, indent=2, sort_keys=True)
+        print('Wrote baseline to %s' % args.baseline)
+        return 0
+
+    if not os.path.exists(args.baseline):
+        print('No baseline at %s' % args.baseline)
+        return 0
+
+    with open(args.baseline, 'r') as input_file:
+        failures = compare(results, json.load(input_file), args.tolerance, calibration)
+
+    for failure in failures:
+        print('REGRESSION: %s' % failure)
+
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+
+"""
+Compares the row-by-row ingest that :py:func:`errorutils.add_to_database` used to do
+with the current batched ingest.
+
+A history database with ``--history`` rows is built first.
+Then a file of errors with ``--new`` rows, half of which are already
+in the history, is added to a copy of the database with each method.
+This is what ``wfwt-update-history`` does every hour.
+
+Usage::
+
+    python benchmarks/ingest.py --history 2000000 --new 200000
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import shutil
+import sqlite3
+import argparse
+import tempfile
+
+from cmstoolbox import sitereadiness
+
+from workflowwebtools import errorutils
+
+
+SITES = ['T%i_XX_Site%i' % (site % 3 + 1, site) for site in range(50)]
+CODES = ['NotReported', '8001', '8021', '8028', '50660', '50664', '61202', '71304', '99109', '134']
+
+
+def make_errors(start, number):
+    """
+    :param int start: The index of the first row
+    :param int number: The number of rows to make
+    :returns: Errors in the format of all_errors.json
+    :rtype: dict
+    """
+
+    errors = {}
+
+    for index in range(start, start + number):
+        step = '/wf_%i/Task_%i' % (index // 40, (index // 20) % 2)
+        code = CODES[(index // 10) % 2 * 5 + index % 5]
+        site = SITES[(index * 7) % len(SITES)]
+
+        errors.setdefault(step, {}).setdefault(code, {})[site] = index % 97 + 1
+
+    return errors
+
+
+def legacy_add(curs, data_location):
+    """
+    The old ingest, which checked for every row before inserting it alone
+
+    :param sqlite3.Cursor curs: is the cursor to the database
+    :param str data_location: Location of the errors file
+    """
+
+    with open(data_location, 'r') as input_file:
+        indict = json.load(input_file)
+
+    for stepname, errorcodes in indict.items():
+        if 'LogCollect' in stepname or 'Cleanup' in stepname:
+            continue
+
+        for errorcode, sitenames in errorcodes.items():
+            if errorcode == 'NotReported':
+                errorcode = '-1'
+
+            elif not re.match(r'\d+', errorcode):
+                continue
+
+            for sitename, numbererrors in sitenames.items():
+                numbererrors = numbererrors or int(errorcode == '-1')
+
+                if numbererrors:
+                    full_key = '_'.join([stepname, sitename, errorcode])
+                    if not list(curs.execute(
+                            'SELECT EXISTS(SELECT 1 FROM workflows WHERE fullkey=? LIMIT 1)',
+                            (full_key,)))[0][0]:
+                        curs.execute('INSERT INTO workflows VALUES (?,?,?,?,?,?)',
+                                     (full_key, stepname, errorcode,
+                                      sitename, numbererrors,
+                                      sitereadiness.site_readiness(sitename)))
+
+
+def time_ingest(function, history, errors_file, output):
+    """
+    :param function: Function that takes a cursor and the errors file
+    :param str history: Path to the history database, which is copied
+    :param str errors_file: The errors to add
+    :param str output: Where to put the copy of the database
+    :returns: The number of seconds taken, including the commit
+    :rtype: float
+    """
+
+    shutil.copy(history, output)
+    conn = sqlite3.connect(output)
+
+    start = time.time()
+    function(conn.cursor(), errors_file)
+    conn.commit()
+    elapsed = time.time() - start
+
+    conn.close()
+
+    return elapsed
+
+
+def main():
+    """Builds the inputs and prints the timing of each method"""
+
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1])
+    parser.add_argument('--history', type=int, default=2000000,
+                        help='Number of rows in the history database')
+    parser.add_argument('--new', type=int, default=200000,
+                        help='Number of rows in the errors file')
+    parser.add_argument('--workdir', help='Directory for the databases, default is temporary')
+
+    args = parser.parse_args()
+
+    workdir = args.workdir or tempfile.mkdtemp()
+    history = os.path.join(workdir, 'history.db')
+    errors_file = os.path.join(workdir, 'errors.json')
+
+    if os.path.exists(history):
+        os.remove(history)
+
+    conn = sqlite3.connect(history)
+    curs = conn.cursor()
+    errorutils.create_table(curs)
+
+    start = time.time()
+    step = 200000
+    for first in range(0, args.history, step):
+        errorutils.insert_rows(
+            curs, errorutils.error_rows(
+                make_errors(first, min(step, args.history - first)).items()))
+    conn.close()
+    print('Built history of %i rows in %.1f s' % (args.history, time.time() - start))
+
+    with open(errors_file, 'w') as output:
+        json.dump(make_errors(args.history - args.new // 2, args.new), output)
+
+    results = []
+    for name, function in [('legacy', legacy_add),
+                           ('batched', errorutils.add_to_database)]:
+        elapsed = time_ingest(function, history, errors_file,
+                              os.path.join(workdir, '%s.db' % name))
+        results.append((name, elapsed))
+        print('%-8s %8.2f s  %10.0f rows/s' % (name, elapsed, args.new/elapsed))
+
+    print('Speedup: %.1fx' % (results[0][1]/results[1][1]))
+
+    if not args.workdir:
+        shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+
+"""
+Compares building the action prediction input with :py:class:`predict.features.FeatureMap`
+against the pandas tables that were used before.
+
+A training table of exit codes and sites is generated, along with steps that have
+errors at some of those sites.
+Both ways of building the input are timed on the same steps, and their outputs are checked
+to be equal.
+Only sites from the training table are used, so that no random proxy sites are chosen.
+Neither keras nor a model is needed.
+
+Usage::
+
+    python benchmarks/prediction_features.py --steps 1 10 100 1000
+"""
+
+from __future__ import print_function
+
+import sys
+import time
+import random
+import argparse
+
+import numpy as np
+import pandas as pd
+
+from workflowwebtools.predict.features import FeatureMap
+
+
+def make_table(num_codes, num_sites):
+    """
+    :param int num_codes: The number of exit codes in the training table
+    :param int num_sites: The number of sites in the training table
+    :returns: An empty training table, like ``sparse_table.csv``
+    :rtype: pandas.DataFrame
+    """
+
+    codes = [-1] + list(range(50000, 50000 + num_codes - 1))
+    sites = ['T%i_XX_Site%i' % (1 + site % 3, site) for site in range(num_sites)]
+
+    return pd.DataFrame(0, index=codes, columns=sites)
+
+
+def make_steps(table, num_steps, seed=0):
+    """
+    :param pandas.DataFrame table: The training table
+    :param int num_steps: The number of steps to generate
+    :param int seed: Seed for the random generator
+    :returns: The errors of each step, keyed by exit code and then site
+    :rtype: list
+    """
+
+    rand = random.Random(seed)
+    codes = list(table.index)
+    sites = list(table.columns)
+
+    return [{('NotReported' if code == -1 else str(code)):
+             {site: rand.randint(1, 100) for site in rand.sample(sites, rand.randint(1, 5))}
+             for code in rand.sample(codes, rand.randint(1, 3))}
+            for _ in range(num_steps)]
+
+
+def pandas_features(steps, template_table):
+    """
+    The way the input was built before.
+    Each step fills a copy of the training table one cell at a time,
+    then the tables are flattened one site at a time.
+
+    :param list steps: The errors of each step
+    :param pandas.DataFrame template_table: The empty training table
+    :returns: A row of the model input for each step
+    :rtype: numpy.ndarray
+    """
+
+    df = pd.DataFrame(columns=('workflow', 'errors'))
+    for i, errors in enumerate(steps):
+        errors = dict(errors)
+        if 'NotReported' in errors:
+            errors[-1] = errors.pop('NotReported')
+        df.loc[i] = ['step%i' % i, errors]
+
+    def build_table(errors):
+        """Fill one table"""
+        sparse_df = template_table.copy()
+        for exit_code, site_dict in errors.items():
+            for site, count in site_dict.items():
+                sparse_df.loc[int(exit_code), site] = count
+        return sparse_df
+
+    def flatten(table):
+        """Flatten one site at a time"""
+        return [item for column in table for item in table[column]]
+
+    rows = df['errors'].apply(build_table).apply(flatten).values
+
+    return np.asarray([list(row) for row in rows], dtype=float)
+
+
+def time_function(function, *args):
+    """
+    :param function: The function to time
+    :param args: Arguments to the function
+    :returns: The output of the function and the seconds it took
+    :rtype: tuple
+    """
+
+    start = time.time()
+    output = function(*args)
+    return output, time.time() - start
+
+
+def main():
+    """Runs the comparison"""
+
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1])
+    parser.add_argument('--steps', type=int, nargs='+', default=[1, 10, 100, 1000],
+                        help='Numbers of steps to build the input for')
+    parser.add_argument('--codes', type=int, default=60,
+                        help='Number of exit codes in the training table')
+    parser.add_argument('--sites', type=int, default=150,
+                        help='Number of sites in the training table')
+
+    args = parser.parse_args()
+
+    table = make_table(args.codes, args.sites)
+
+    feature_map, map_seconds = time_function(FeatureMap, table.index, table.columns)
+    print('Built the feature map in %.4f s' % map_seconds)
+
+    print('%8s %12s %12s %8s' % ('steps', 'pandas s', 'numpy s', 'speedup'))
+
+    for num_steps in args.steps:
+        steps = make_steps(table, num_steps)
+
+        expected, pandas_seconds = time_function(pandas_features, steps, table)
+        output, numpy_seconds = time_function(feature_map.build, steps)
+
+        if not np.array_equal(expected, output):
+            print('Outputs differ for %i steps' % num_steps)
+            return 1
+
+        print('%8i %12.4f %12.4f %8.1f' % (num_steps, pandas_seconds, numpy_seconds,
+                                           pandas_seconds / max(numpy_seconds, 1e-9)))
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1 @@
+../bin/wfwt-compact-history
\ No newline at end of file
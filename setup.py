@@ -31,6 +31,7 @@ setuptools.setup(
         'pyOpenSSL',
         'pyyaml',
         'validators',
+        'ijson>=2.5',
         'tabulate',
         'pymongo<3.5.0',
         'cx_Oracle',
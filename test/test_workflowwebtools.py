@@ -70,6 +70,12 @@ class TestGlobalError(unittest.TestCase):
         self.assertEqual(check_this['test2']['errors'], {'row2': {'col1': 1}})
         self.assertEqual(check_this['test1']['sub']['/test1/a/1'], self.dictionary['/test1/a/1'])
 
+    def tearDown(self):
+        import workflowwebtools.snapshots as sn
+        for source in [self.testdat, self.testdat.replace('.json', '2.json')]:
+            if os.path.exists(sn.snapshot_dir(source)):
+                shutil.rmtree(sn.snapshot_dir(source))
+
     def test_steplist(self):
         info = ge.ErrorInfo(self.testdat)
 
@@ -77,6 +83,69 @@ class TestGlobalError(unittest.TestCase):
         self.assertEqual(info.get_step_list('test2'), ['/test2/a/1'])
         self.assertFalse(info.get_step_list('test3'))
 
+    def test_indexes(self):
+        info = ge.ErrorInfo(self.testdat)
+
+        self.assertEqual(list(info.return_workflows()), ['test1', 'test2'])
+        self.assertTrue(info.has_workflow('test2'))
+        self.assertFalse(info.has_workflow('test3'))
+        self.assertEqual(info.step_lists['test1'], ('/test1/a/1', '/test1/a/2'))
+        # No PrepIDs are stored when reading a specific data location
+        self.assertFalse(info.prepid_workflows)
+
+        if sys.version_info[0] > 2:
+            with self.assertRaises(TypeError):
+                info.step_lists['test3'] = ()
+
+    def test_snapshot_prepids(self):
+        import sqlite3
+        import workflowwebtools.workflowinfo as wi
+
+        built = []
+
+        class Workflow(object):
+            def __init__(self, workflow):
+                self.workflow = workflow
+
+            def get_prep_id(self):
+                return 'prep_a' if self.workflow == 'test1' else 'prep_b'
+
+            def get_errors(self, get_unreported=False):
+                return {'/%s/a/1' % self.workflow: {'1': {'site_a': 4}}}
+
+        class PrepID(object):
+            def __init__(self, prep_id):
+                built.append(prep_id)
+                self.prep_id = prep_id
+
+            def get_workflows(self):
+                return ['test1', 'other_a'] if self.prep_id == 'prep_a' else \
+                    ['test2', 'other_a', 'other_b']
+
+        info = ge.ErrorInfo(self.testdat)
+        info.data_location = ''
+
+        workflow_info, prepid_info = wi.WorkflowInfo, wi.PrepIDInfo
+        wi.WorkflowInfo, wi.PrepIDInfo = Workflow, PrepID
+        conn = sqlite3.connect(':memory:')
+        try:
+            info._build_snapshot(conn, self.testdat)
+        finally:
+            wi.WorkflowInfo, wi.PrepIDInfo = workflow_info, prepid_info
+
+        # Each PrepID is listed once, and each other workflow is only added once
+        self.assertEqual(sorted(built), ['prep_a', 'prep_b'])
+        self.assertEqual(
+            sorted(conn.execute('SELECT prepid, workflow FROM prepids')),
+            [('prep_a', 'other_a'), ('prep_a', 'test1'),
+             ('prep_b', 'other_a'), ('prep_b', 'other_b'), ('prep_b', 'test2')])
+        self.assertEqual(
+            [step for step, in conn.execute('SELECT DISTINCT stepname FROM workflows '
+                                            'ORDER BY stepname')],
+            ['/other_a/a/1', '/other_b/a/1', '/test1/a/1', '/test1/a/2', '/test2/a/1'])
+        conn.close()
+        info.teardown()
+
     def test_reset(self):
         info = ge.ErrorInfo(self.testdat)
         # Let's load the new one
@@ -87,6 +156,420 @@ class TestGlobalError(unittest.TestCase):
         self.assertEqual(info.get_step_list('test3'), ['/test3/test/2'])
         self.assertFalse(info.get_step_list('test1'))
 
+    def test_threads(self):
+        import sqlite3
+        import threading
+
+        info = ge.ErrorInfo(self.testdat)
+        query = 'SELECT DISTINCT stepname FROM workflows ORDER BY stepname'
+        expected = info.execute(query)
+
+        results = []
+        def read():
+            results.append(info.execute(query))
+
+        threads = [threading.Thread(target=read) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(results, [expected] * 4)
+        # Each thread has its own connection
+        self.assertEqual(len(info.readers.connections), 5)
+
+        # Readers cannot write
+        with self.assertRaises(sqlite3.OperationalError):
+            info.execute('DELETE FROM workflows')
+
+        # Setting up again switches this thread to the new database
+        info.data_location = self.testdat.replace('.json', '2.json')
+        info.setup()
+        self.assertEqual(info.execute(query), [('/test3/test/2',)])
+
+        # Teardown only closes the reader of this thread,
+        # since the other threads could still be reading
+        info.teardown()
+        self.assertEqual(len(info.readers.connections), 4)
+        with self.assertRaises(sqlite3.ProgrammingError):
+            info.execute(query)
+
+        # Other threads switch on their next query
+        info.setup()
+        self.assertEqual(info.execute(query), [('/test3/test/2',)])
+
+    def test_ingest(self):
+        import sqlite3
+        import workflowwebtools.errorutils as eu
+
+        curs = sqlite3.connect(':memory:').cursor()
+        eu.create_table(curs)
+
+        rows = list(eu.error_rows(eu.iter_location(self.testdat)))
+        self.assertEqual(eu.insert_rows(curs, iter(rows), batch_size=2), len(rows))
+        # Existing rows are ignored
+        self.assertEqual(eu.insert_rows(curs, iter(rows), batch_size=2), 0)
+
+        # Streaming gives the same rows as loading the whole file
+        ijson = eu.ijson
+        eu.ijson = None
+        try:
+            self.assertEqual(sorted(eu.error_rows(eu.iter_location(self.testdat))),
+                             sorted(rows))
+        finally:
+            eu.ijson = ijson
+
+    def test_prepid_expansion(self):
+        import threading
+        import workflowwebtools.errorutils as eu
+
+        calls = []
+        calls_lock = threading.Lock()
+        def record(name, output):
+            def func(arg):
+                with calls_lock:
+                    calls.append((name, arg))
+                return output(arg)
+            return func
+
+        patched = {
+            '_get_prep_id': record('prepid', lambda wf: 'prep_%s' % wf[0]),
+            '_get_prepid_workflows': record(
+                'siblings', lambda prep: ['%s_%i' % (prep[-1], i) for i in range(3)]),
+            '_get_errors': record('errors', lambda wf: {'/%s/step' % wf: {'1': {'site': 1}}})
+            }
+        original = {name: getattr(eu, name) for name in patched}
+
+        for name, func in patched.items():
+            setattr(eu, name, func)
+        try:
+            errors = eu.errors_from_list(['a1', 'a2', 'b1', 'a1'])
+        finally:
+            for name, func in original.items():
+                setattr(eu, name, func)
+
+        self.assertEqual(sorted(errors), ['/%s_%i/step' % (prep, i)
+                                          for prep in 'ab' for i in range(3)])
+        # Each PrepID and workflow is only fetched once
+        self.assertEqual(sorted(arg for name, arg in calls if name == 'siblings'),
+                         ['prep_a', 'prep_b'])
+        self.assertEqual(len([arg for name, arg in calls if name == 'errors']), 6)
+        self.assertEqual(len([arg for name, arg in calls if name == 'prepid']), 3)
+
+        self.assertEqual(eu.thread_map(lambda x: x * 2, range(250), 'Doubling'),
+                         [x * 2 for x in range(250)])
+
+    def test_workflowsource(self):
+        import sqlite3
+        import workflowwebtools.workflowsources as ws
+
+        path = os.path.join(os.path.abspath(os.path.dirname(__file__)), 'unified.db')
+        conn = sqlite3.connect(path)
+        conn.execute('CREATE TABLE workflow (NAME varchar(255), STATUS varchar(255), '
+                     'WM_STATUS varchar(255))')
+        conn.executemany('INSERT INTO workflow VALUES (?,?,?)',
+                         [('wf_a', 'assistance-manual', 'running-open'),
+                          ('wf_b', 'away', 'running-closed'),
+                          ('wf_c', 'assistance-MANUAL-recovered', 'completed')])
+        conn.commit()
+        conn.close()
+
+        try:
+            self.assertEqual(ws.get_source({}), None)
+            source = ws.get_source({'workflow_db': path})
+            self.assertTrue(source is ws.get_source({'workflow_db': path}))
+
+            self.assertEqual(sorted(source.workflows()), ['wf_a', 'wf_c'])
+            self.assertEqual(sorted(source.workflows(ws.RUNNING_QUERY)), ['wf_a', 'wf_b'])
+        finally:
+            os.remove(path)
+
+
+class TestSnapshots(unittest.TestCase):
+
+    def setUp(self):
+        self.source = os.path.join(os.path.abspath(os.path.dirname(__file__)),
+                                   'snapshot_source.json')
+        shutil.copy(TestGlobalError.testdat, self.source)
+
+    def tearDown(self):
+        import workflowwebtools.snapshots as sn
+        if os.path.exists(sn.snapshot_dir(self.source)):
+            shutil.rmtree(sn.snapshot_dir(self.source))
+        os.remove(self.source)
+
+    def test_reuse(self):
+        import workflowwebtools.snapshots as sn
+
+        info = ge.ErrorInfo(self.source)
+        self.assertEqual(len(sn.list_snapshots(self.source)), 1)
+        first = sn.list_snapshots(self.source)[0]
+
+        # Unchanged source reuses the snapshot
+        info.teardown()
+        info.setup()
+        self.assertEqual(sn.list_snapshots(self.source), [first])
+        self.assertEqual(info.get_step_list('test1'), ['/test1/a/1', '/test1/a/2'])
+
+        # Changed source builds a new version, but keeps the old one
+        shutil.copy(TestGlobalError.testdat.replace('.json', '2.json'), self.source)
+        info.teardown()
+        info.setup()
+        snapshots = sn.list_snapshots(self.source)
+        self.assertEqual(len(snapshots), 2)
+        self.assertEqual(snapshots[1], first)
+        self.assertEqual(info.get_step_list('test3'), ['/test3/test/2'])
+
+        # Rolling back is just opening the old snapshot
+        self.assertEqual(ge.ErrorInfo(first).get_step_list('test1'),
+                         ['/test1/a/1', '/test1/a/2'])
+
+    def test_prune(self):
+        import time
+        import sqlite3
+        import threading
+        import workflowwebtools.snapshots as sn
+
+        info = ge.ErrorInfo(self.source)
+        held = info.db_path
+
+        keep = sn.get_settings
+        sn.get_settings = lambda: dict(keep(), keep=0)
+        try:
+            # Snapshots held by an ErrorInfo are not removed
+            sn.prune(self.source)
+            self.assertEqual(sn.list_snapshots(self.source), [held])
+
+            info.teardown()
+            sn.prune(self.source)
+            self.assertEqual(sn.list_snapshots(self.source), [])
+        finally:
+            sn.get_settings = keep
+
+        # A reader of a removed snapshot fails, instead of creating an empty one
+        info.db_path = held
+        info.readers.replace(held)
+        errors = []
+
+        def read():
+            try:
+                info.execute('SELECT COUNT(*) FROM workflows')
+            except sqlite3.OperationalError as error:
+                errors.append(error)
+
+        thread = threading.Thread(target=read)
+        thread.start()
+        thread.join()
+
+        self.assertEqual(len(errors), 1)
+        self.assertFalse(os.path.exists(held))
+
+        # The session switches to a new snapshot
+        info.timestamp = time.time()
+        self.assertTrue(ge.check_session({'info': info}, can_refresh=True) is info)
+        self.assertTrue(os.path.exists(info.db_path))
+        self.assertEqual(info.get_step_list('test1'), ['/test1/a/1', '/test1/a/2'])
+        info.teardown()
+
+    def test_url_version(self):
+        import workflowwebtools.snapshots as sn
+        import workflowwebtools.errorutils as eu
+
+        url = 'https://example.com/all_errors.json'
+
+        def fail(*_):
+            raise AssertionError('Source should not be downloaded')
+
+        version, open_location = eu.url_version, eu.open_location
+        eu.url_version = lambda location: 'v1'
+        eu.open_location = fail
+        try:
+            digest, contents = sn.load_source(url)
+            self.assertEqual(contents, url)
+
+            eu.url_version = lambda location: 'v2'
+            self.assertNotEqual(sn.load_source(url)[0], digest)
+        finally:
+            eu.url_version, eu.open_location = version, open_location
+
+    def test_max_age(self):
+        import time
+        import workflowwebtools.snapshots as sn
+        import workflowwebtools.errorutils as eu
+
+        start = time.time()
+
+        class Clock(object):
+            now = start
+
+            def time(self):
+                return self.now
+
+        built = []
+
+        def build(conn, contents):
+            built.append(contents)
+            eu.create_table(conn.cursor())
+
+        sn.time = clock = Clock()
+        try:
+            first = sn.get_snapshot(self.source, build, 900)
+            self.assertEqual(sn.get_snapshot(self.source, build, 900), first)
+            self.assertEqual(len(built), 1)
+
+            # The same source is rebuilt once the snapshot is too old
+            clock.now += 900
+            self.assertNotEqual(sn.get_snapshot(self.source, build, 900), first)
+            self.assertEqual(len(built), 2)
+        finally:
+            sn.time = time
+
+
+class TestHistory(unittest.TestCase):
+
+    path = os.path.join(os.path.abspath(os.path.dirname(__file__)), 'history_test.db')
+
+    def tearDown(self):
+        for suffix in ['', '-wal', '-shm']:
+            if os.path.exists(self.path + suffix):
+                os.remove(self.path + suffix)
+
+    def test_partitions(self):
+        import sqlite3
+        import time
+        import workflowwebtools.errorutils as eu
+        import workflowwebtools.historydb as hd
+
+        # Start from a history made before the split
+        conn = sqlite3.connect(self.path)
+        eu.create_table(conn.cursor())
+        eu.add_to_database(conn.cursor(), TestGlobalError.testdat)
+        conn.commit()
+        conn.close()
+
+        old = time.time() - 86400 * 100
+        os.utime(self.path, (old, old))
+
+        conn = hd.connect(self.path)
+        curs = conn.cursor()
+        self.assertEqual(hd.list_partitions(curs), [hd.partition_name(old)])
+        self.assertEqual(len(list(curs.execute('SELECT * FROM workflows'))), 6)
+
+        # Rows already in an older month are not added again
+        self.assertEqual(hd.add_to_history(curs, TestGlobalError.testdat), 0)
+        self.assertEqual(
+            hd.add_to_history(curs, TestGlobalError.testdat.replace('.json', '2.json')), 1)
+        self.assertEqual(hd.list_partitions(curs),
+                         [hd.partition_name(old), hd.partition_name(time.time())])
+
+        # The newest ingest time is kept without reading the monthly tables
+        newest = hd.latest_ingest(curs)
+        self.assertGreater(newest, old + 86400 * 99)
+        self.assertEqual(hd.add_to_history(curs, TestGlobalError.testdat, newest + 10), 0)
+        self.assertEqual(hd.latest_ingest(curs), newest)
+
+        # A history from before the table is filled in when it is opened
+        curs.execute('DROP TABLE history_ingests')
+        conn.commit()
+        conn.close()
+        conn = hd.connect(self.path)
+        self.assertEqual(hd.latest_ingest(conn.cursor()), newest)
+        conn.close()
+
+        self.assertEqual(len(ge.ErrorInfo(self.path).return_workflows()), 3)
+
+        recent = ge.ErrorInfo(self.path, window=30)
+        self.assertEqual(list(recent.return_workflows()), ['test3'])
+        self.assertEqual(recent.get_step_list('test3'), ['/test3/test/2'])
+        recent.teardown()
+
+        conn = hd.connect(self.path)
+        self.assertEqual(hd.compact(conn, 1), [hd.partition_name(old)])
+        self.assertEqual(list(conn.execute('SELECT stepname FROM workflows')),
+                         [('/test3/test/2',)])
+        self.assertEqual(list(conn.execute('SELECT month FROM history_ingests')),
+                         [(hd.partition_name(newest),)])
+        conn.close()
+
+    def test_legacy_window(self):
+        import sqlite3
+        import time
+        import workflowwebtools.errorutils as eu
+
+        conn = sqlite3.connect(self.path)
+        eu.create_table(conn.cursor())
+        eu.add_to_database(conn.cursor(), TestGlobalError.testdat)
+        conn.close()
+
+        old = time.time() - 86400 * 100
+        os.utime(self.path, (old, old))
+
+        # The old history is converted, so the window applies to it
+        recent = ge.ErrorInfo(self.path, window=30)
+        self.assertFalse(list(recent.return_workflows()))
+        recent.teardown()
+
+    def test_checkpoint(self):
+        import workflowwebtools.historydb as hd
+
+        conn = hd.connect(self.path)
+        curs = conn.cursor()
+
+        errors = {
+            '/wf1/a': {'1': {'site_a': 1}},
+            '/wf1/b': {'2': {'site_b': 2}},
+            '/wf2/a': {'1': {'site_a': 3}}
+            }
+
+        self.assertEqual(hd.update_checkpointed(curs, 'src', 'first', errors), (3, 2, 2))
+        # An unchanged source is not read
+        self.assertEqual(hd.update_checkpointed(curs, 'src', 'first', None), (0, None, None))
+
+        # Only the changed workflow is added
+        errors['/wf2/a']['1']['site_c'] = 4
+        self.assertEqual(hd.update_checkpointed(curs, 'src', 'second', errors), (1, 1, 2))
+
+        # The order of steps does not matter
+        self.assertEqual(hd.workflow_digests(sorted(errors.items())),
+                         hd.workflow_digests(sorted(errors.items(), reverse=True)))
+
+        # A changed file is only read once
+        import workflowwebtools.errorutils as eu
+        reads = []
+        iter_location = eu.iter_location
+        eu.iter_location = lambda location: reads.append(location) or iter(errors.items())
+        try:
+            errors['/wf1/a']['1']['site_d'] = 5
+            self.assertEqual(hd.update_checkpointed(curs, 'src', 'third', 'errors.json'),
+                             (1, 1, 2))
+        finally:
+            eu.iter_location = iter_location
+        self.assertEqual(reads, ['errors.json'])
+
+        conn.close()
+
+    def test_prefetch(self):
+        import threading
+        import workflowwebtools.errorutils as eu
+
+        lock = threading.Lock()
+        started = []
+
+        def fetch(source):
+            with lock:
+                started.append(source)
+            return source * 2
+
+        output = []
+        for source, fetched in eu.prefetch_map(fetch, range(10), 3):
+            # Sources are handed over in order, and only a few are fetched ahead
+            with lock:
+                self.assertTrue(len(started) <= source + 4)
+            output.append((source, fetched))
+
+        self.assertEqual(output, [(source, source * 2) for source in range(10)])
+        self.assertEqual(list(eu.prefetch_map(fetch, [])), [])
+
 
 class TestClusteringAndReasons(unittest.TestCase):
 
@@ -151,8 +634,11 @@ class TestClusteringAndReasons(unittest.TestCase):
                 json.dump({}, cache)
 
     def tearDown(self):
+        import workflowwebtools.snapshots as sn
+
         os.remove(sc.workflow_history_path())
         if sc.workflow_history_path() != sc.all_errors_path():
+            shutil.rmtree(sn.snapshot_dir(sc.all_errors_path()))
             os.remove(sc.all_errors_path())
 
         for wkf in ge.check_session(None).return_workflows():
@@ -164,9 +650,11 @@ class TestClusteringAndReasons(unittest.TestCase):
     def test_updatehistory(self):
         import workflowwebtools.globalerrors as ge
 
+        history = ge.ErrorInfo(sc.workflow_history_path())
         self.assertEqual(ge.ErrorInfo(sc.all_errors_path()).info[1:],
-                         ge.ErrorInfo(sc.workflow_history_path()).info[1:],
+                         history.info[1:],
                          'Update workflow script did not create equivalent database')
+        history.teardown()
 
     def test_clusterer(self):
         import workflowwebtools.globalerrors as ge
@@ -179,6 +667,363 @@ class TestClusteringAndReasons(unittest.TestCase):
                              self.should_cluster[workflow],
                              'Clustering acting unexpectedly.')
 
+    def test_groupindex(self):
+        import workflowwebtools.clusterworkflows as cw
+
+        clusterer = cw.get_clusterer(sc.workflow_history_path())
+        labels, members = cw.get_workflow_groups(clusterer)
+
+        self.assertEqual(sorted(labels), sorted(self.should_cluster))
+        self.assertEqual(members[labels['test1']], ('test1', 'test2'))
+
+        # Predictions are shared until the clusterer changes
+        self.assertTrue(cw.get_workflow_groups(clusterer)[0] is labels)
+        self.assertFalse(cw.get_workflow_groups(
+            cw.get_clusterer(sc.workflow_history_path()))[0] is labels)
+
+        self.assertEqual(cw.get_clustered_group('not_a_workflow', clusterer), [])
+
+    def test_neighbors(self):
+        import workflowwebtools.neighbors as nb
+
+        history = nb.history_rows(sc.workflow_history_path(), ['test3', 'test'])
+        self.assertEqual(history['test3'], [('/test3/b/a', 3, 'site_c', 50)])
+        self.assertEqual(history['test'], [])
+
+        rows = [row for row in ge.check_session(None).execute(
+            'SELECT stepname, errorcode, sitename, numbererrors FROM workflows')
+                if not row[0].startswith('/test3/')]
+        settings = {'k': 10, 'errorcode': 1.0, 'sitename': 1.0}
+        index = nb.NeighborIndex(['test1', 'test2'], rows, history, settings)
+
+        neighbors = index.query('test1', 5)
+        # Past workflows without errors are not included
+        self.assertEqual([neighbor['workflow'] for neighbor in neighbors],
+                         ['test2', 'test3'])
+        self.assertEqual([neighbor['current'] for neighbor in neighbors],
+                         [True, False])
+        self.assertTrue(neighbors[0]['distance'] < neighbors[1]['distance'])
+        self.assertEqual(len(index.query('test1', 1)), 1)
+        self.assertEqual(index.query('test4', 1), [])
+
+        # Weights scale the distances
+        def distance(errorcode, sitename):
+            settings.update(errorcode=errorcode, sitename=sitename)
+            return nb.NeighborIndex(['test1', 'test2'], rows, history,
+                                    settings).query('test1', 1)[0]['distance']
+
+        self.assertAlmostEqual(distance(0, 2.0), 2 * distance(0, 1.0))
+        self.assertNotAlmostEqual(distance(1.0, 1.0), distance(0, 1.0))
+
+        # Adding past workflows gives the same index as building it with them
+        settings.update(errorcode=1.0, sitename=1.0)
+        full = nb.NeighborIndex(['test1', 'test2'], rows, history, settings)
+        index = nb.NeighborIndex(['test1', 'test2'], rows, {}, settings)
+        self.assertEqual([neighbor['workflow'] for neighbor in index.query('test1', 5)],
+                         ['test2'])
+
+        extended = index.extended(history)
+        self.assertFalse(extended is index)
+        self.assertTrue(extended.extended(history) is extended)
+        for workflow in ['test1', 'test3']:
+            self.assertEqual(len(extended.query(workflow, 5)), len(full.query(workflow, 5)))
+            for got, expected in zip(extended.query(workflow, 5), full.query(workflow, 5)):
+                self.assertEqual(got['workflow'], expected['workflow'])
+                self.assertEqual(got['current'], expected['current'])
+                self.assertAlmostEqual(got['distance'], expected['distance'])
+
+        # Large values of k are clamped, and other values give nothing
+        self.assertEqual(len(extended.query('test1', 100)), 2)
+        self.assertEqual(extended.query('test1', 0), [])
+        self.assertEqual(extended.query('test1', -3), [])
+
+        # Many workflows are read in a few queries
+        batch = nb.HISTORY_BATCH
+        nb.HISTORY_BATCH = 2
+        try:
+            workflows = ['test1', 'test2', 'test3', 'test']
+            self.assertEqual(
+                nb.history_rows(sc.workflow_history_path(), workflows),
+                {workflow: nb.history_rows(sc.workflow_history_path(), [workflow])[workflow]
+                 for workflow in workflows})
+        finally:
+            nb.HISTORY_BATCH = batch
+
+    def test_neighborindex(self):
+        import time
+        import workflowwebtools.neighbors as nb
+        import workflowwebtools.historydb as hdb
+
+        queries = []
+
+        class Collection(object):
+            acted = ['test3']
+
+            def find(self, query, *_):
+                queries.append(query)
+                return [{'workflow': workflow} for workflow in self.acted]
+
+        class Actions(object):
+            collection = Collection()
+
+            def get_acted_workflows(self, _):
+                return ['test3']
+
+            def get_actions_collection(self):
+                return self.collection
+
+        manageactions = nb.manageactions
+        nb.manageactions = Actions()
+        settings = nb.get_settings
+        nb.get_settings = lambda: dict(settings(), check_every=0)
+
+        info = ge.ErrorInfo(sc.all_errors_path())
+        session = {'info': info}
+        try:
+            index = nb.get_index(session)
+            self.assertEqual(sorted(index.workflows), ['test1', 'test2', 'test3'])
+            self.assertEqual(queries, [])
+
+            # The same snapshot gives the index right away, and checks for actions after
+            self.assertTrue(nb.get_index(session) is index)
+            with nb._UPDATE_LOCK:
+                self.assertEqual(len(queries), 1)
+
+            # New actions are added in the background
+            nb.manageactions.collection.acted = ['test4']
+            conn = hdb.connect(sc.workflow_history_path())
+            hdb.add_to_history(conn.cursor(), {'/test4/b/a': {'3': {'site_c': 50}}})
+            conn.commit()
+            conn.close()
+
+            for _ in range(100):
+                nb.get_index(session)
+                with nb._UPDATE_LOCK:
+                    if 'test4' in nb._INDEX['index'].index:
+                        break
+                time.sleep(0.01)
+
+            self.assertTrue('test4' in nb.get_index(session).index)
+            self.assertTrue('test4' not in index.index)
+        finally:
+            with nb._UPDATE_LOCK:
+                nb.manageactions = manageactions
+                nb.get_settings = settings
+                nb._INDEX.update(key=None, index=None, checked=0)
+            info.teardown()
+
+    def test_incremental(self):
+        import time
+        import workflowwebtools.clusterworkflows as cw
+        import workflowwebtools.historydb as hdb
+
+        clusterer = cw.get_clusterer(sc.workflow_history_path(), incremental=True)
+        self.assertTrue(clusterer['baseline'] >= 0)
+
+        # Nothing new to fold in
+        self.assertTrue(cw.update_clusterer(
+            clusterer, sc.workflow_history_path())['clusterer'] is clusterer['clusterer'])
+
+        conn = hdb.connect(sc.workflow_history_path())
+
+        # A workflow like test3 is folded into the same clusters
+        hdb.add_to_history(conn.cursor(), {'/test4/b/a': {'3': {'site_c': 50}}},
+                           time.time() + 1)
+        updated = cw.update_clusterer(clusterer, sc.workflow_history_path())
+        self.assertFalse(updated['clusterer'] is clusterer['clusterer'])
+        self.assertEqual(updated['allmap'], clusterer['allmap'])
+        self.assertEqual(
+            cw.get_clustered_group('test3', updated),
+            self.should_cluster['test3'])
+
+        # New error codes and sites cause a full refit
+        hdb.add_to_history(conn.cursor(), {'/test5/b/a': {'4': {'site_d': 40}}},
+                           updated['updated'] + 1)
+        refit = cw.update_clusterer(updated, sc.workflow_history_path())
+        self.assertTrue(4 in refit['allmap']['errorcode'] or '4' in refit['allmap']['errorcode'])
+
+        conn.close()
+
+    def test_incremental_current(self):
+        import time
+        import workflowwebtools.clusterworkflows as cw
+        import workflowwebtools.historydb as hdb
+        import workflowwebtools.snapshots as sn
+
+        current = os.path.join(os.path.abspath(os.path.dirname(__file__)), 'current_errors.json')
+        with open(current, 'w') as output:
+            json.dump({'/test6/c/a': {'1': {'site_a': 3}}}, output)
+
+        class Later(object):
+            def __getattr__(self, name):
+                return getattr(time, name)
+
+            def time(self):
+                return time.time() + 10
+
+        try:
+            # The current errors are added to the history during the fit,
+            # so they are not new to the clusterer afterwards
+            hdb.time = Later()
+            try:
+                clusterer = cw.get_clusterer(sc.workflow_history_path(), current,
+                                             incremental=True)
+            finally:
+                hdb.time = time
+            self.assertEqual(clusterer['snapshot'], sn.get_snapshot(current))
+            self.assertTrue(cw.update_clusterer(
+                clusterer, sc.workflow_history_path(), current)['clusterer']
+                            is clusterer['clusterer'])
+        finally:
+            if os.path.exists(sn.snapshot_dir(current)):
+                shutil.rmtree(sn.snapshot_dir(current))
+            os.remove(current)
+
+    def test_storedclusterer(self):
+        import workflowwebtools.clusterworkflows as cw
+        import workflowwebtools.historydb as hdb
+
+        # The key is taken after the fit changes the history
+        fitted = cw.get_clusterer(sc.workflow_history_path(), sc.all_errors_path())
+        key = cw.model_key(sc.workflow_history_path())
+        self.assertEqual(fitted['key'], key)
+
+        # Rewriting the file without changing its contents keeps the key
+        conn = hdb.connect(sc.workflow_history_path())
+        conn.execute('VACUUM')
+        conn.close()
+        self.assertEqual(key, cw.model_key(sc.workflow_history_path()))
+
+        cw.save_clusterer(fitted, key)
+        try:
+            stored_key, clusterer = cw.load_clusterer()
+            self.assertEqual(stored_key, key)
+            for workflow in ge.GLOBAL_INFO.return_workflows():
+                self.assertEqual(cw.get_clustered_group(workflow, clusterer),
+                                 self.should_cluster[workflow])
+
+            # Adding to the history makes the stored clusterer stale
+            conn = hdb.connect(sc.workflow_history_path())
+            hdb.add_to_history(conn.cursor(), {'/test4/b/a': {'3': {'site_c': 50}}})
+            conn.close()
+            self.assertNotEqual(key, cw.model_key(sc.workflow_history_path()))
+
+            # Saves from several threads do not share a temporary file
+            import threading
+            threads = [threading.Thread(target=cw.save_clusterer, args=(fitted, key))
+                       for _ in range(4)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            self.assertEqual(cw.load_clusterer()[0], key)
+            self.assertFalse([name for name in os.listdir(os.path.dirname(cw.model_path()))
+                              if name.endswith('.tmp')])
+
+            # Unreadable files are ignored
+            with open(cw.model_path(), 'wb') as output:
+                output.write(b'not a pickle')
+            self.assertEqual(cw.load_clusterer(), (None, None))
+        finally:
+            os.remove(cw.model_path())
+
+    def test_featurestore(self):
+        import tempfile
+        import workflowwebtools.featurestore as fs
+
+        store_dir = tempfile.mkdtemp()
+        path = os.path.join(store_dir, 'features.db')
+        actions = {'test1': {'Action': 'clone', 'Parameters': {'memory': 3000}},
+                   'test3': {'Action': 'acdc', 'Parameters': {'b/a': {'memory': 4000}}}}
+        history = ge.ErrorInfo(sc.workflow_history_path())
+
+        try:
+            # Workflows without actions are skipped
+            self.assertEqual(fs.add_workflows(['test1', 'test2', 'test3'], actions,
+                                              sc.workflow_history_path(), 100, path), 2)
+            self.assertEqual(fs.add_workflows(
+                ['test1'], {'test1': {'Action': 'clone', 'Parameters': {'memory': 5000}}},
+                sc.workflow_history_path(), 200, path), 1)
+
+            # The errors are the same as the ones in actionshistorylink
+            session = {'info': history}
+            for subtask, entry in fs.read(path=path):
+                for key, readiness in fs.READINESS.items():
+                    self.assertEqual(
+                        entry['errors'][key],
+                        json.loads(json.dumps(ge.get_step_table(
+                            subtask, session, readymatch=readiness, sparse=True))))
+
+            self.assertEqual([(subtask, entry['added']) for subtask, entry in
+                              fs.read(start=100, end=200, path=path)],
+                             [('/test1/a/1', 100), ('/test3/b/a', 100)])
+            self.assertEqual([subtask for subtask, _ in fs.read(start=150, path=path)],
+                             ['/test1/a/1'])
+
+            # The latest row of each subtask is used
+            dumped = fs.dump_json(path=path)
+            self.assertEqual(dumped['/test1/a/1']['parameters'],
+                             {'memory': 5000, 'action': 'clone'})
+            self.assertEqual(dumped['/test3/b/a']['parameters'],
+                             {'memory': 4000, 'action': 'acdc'})
+
+            # Acted workflows that are not stored yet are added with the time of the action
+            class Collection(object):
+                def find(self):
+                    return [{'workflow': 'test1', 'timestamp': 300,
+                             'parameters': actions['test1']},
+                            {'workflow': 'test2', 'timestamp': 300,
+                             'parameters': actions['test1']},
+                            {'workflow': 'test3', 'timestamp': 400,
+                             'parameters': actions['test3']}]
+
+            class Actions(object):
+                def get_actions_collection(self):
+                    return Collection()
+
+            manageactions = fs.manageactions
+            fs.manageactions = Actions()
+            try:
+                fs.backfill(sc.workflow_history_path(), path + '.new')
+                self.assertEqual([(subtask, entry['added']) for subtask, entry in
+                                  fs.read(path=path + '.new')],
+                                 [('/test1/a/1', 300), ('/test2/a/2', 300),
+                                  ('/test3/b/a', 400)])
+                self.assertEqual(fs.backfill(sc.workflow_history_path(), path + '.new'), 0)
+                # Only the workflow missing from the first store is added
+                self.assertEqual(fs.backfill(sc.workflow_history_path(), path), 1)
+            finally:
+                fs.manageactions = manageactions
+        finally:
+            history.teardown()
+            shutil.rmtree(store_dir)
+
+    def test_workflowmatrix(self):
+        import workflowwebtools.clusterworkflows as cw
+
+        allmap = ge.check_session(None).get_allmap()
+        workflows = ge.check_session(None).return_workflows()
+        matrix = cw.get_workflow_matrix(workflows)
+
+        self.assertEqual(matrix.shape,
+                         (len(workflows), len(allmap['errorcode']) + len(allmap['sitename'])))
+        # Only the errors that occur are stored
+        self.assertEqual(matrix.format, 'csr')
+        self.assertEqual(matrix.nnz, 10)
+
+        # test3 only has one error code at one site
+        self.assertEqual(matrix[workflows.index('test3')].nnz, 2)
+        self.assertEqual([list(row) for row in matrix.toarray()],
+                         [list(row) for row in cw.get_workflow_vectors(workflows)])
+
+        # Rows are reordered and unknown workflows are left empty
+        matrix = cw.build_workflow_matrix(
+            [('/test2/a/2', allmap['errorcode'][0], allmap['sitename'][0], 3),
+             ('/other/a/1', allmap['errorcode'][0], allmap['sitename'][0], 5)],
+            ['test1', 'test2'], allmap)
+        self.assertEqual(matrix[0].nnz, 0)
+        self.assertEqual(matrix[1].nnz, 2)
+
     def test_steptable(self):
         # This isn't particularly well written,
         # but we should expect a table with
@@ -219,6 +1064,72 @@ class TestClusteringAndReasons(unittest.TestCase):
         for step in self.errors:
             self.assertEqual(dense[step], to_dense[step])
 
+    def test_features(self):
+        import tempfile
+        import workflowwebtools.paramsregression as pr
+
+        raw_data = {
+            step: {'errors': {'good_sites': ge.get_step_table(step, sparse=True),
+                              'bad_sites': {}},
+                   'parameters': {'action': 'acdc'}}
+            for step in self.errors
+        }
+
+        features = pr.build_features(raw_data)
+        self.assertEqual(features['keys'], sorted(self.errors))
+        for row, step in enumerate(features['keys']):
+            dense = convert_to_dense(raw_data[step]['errors'],
+                                     allerrors=features['allerrors'],
+                                     allsites=features['allsites'])
+            self.assertEqual(features['features'][row].toarray()[0].tolist(),
+                             sum(dense['good_sites'] + dense['bad_sites'], []))
+
+        # Dense matrices must already be in the order of the vocabularies
+        dense_data = dict(raw_data)
+        dense_data['/dense/step'] = {
+            'errors': convert_to_dense(raw_data[features['keys'][0]]['errors'],
+                                       allerrors=features['allerrors'],
+                                       allsites=features['allsites']),
+            'parameters': {'action': 'acdc'}}
+        dense_features = pr.build_features(dense_data)
+        self.assertEqual((dense_features['features'][0] !=
+                          dense_features['features'][1]).nnz, 0)
+
+        dense_data['/dense/step']['errors']['good_sites'] = [[1, 2]]
+        self.assertRaises(ValueError, pr.build_features, dense_data)
+
+        cache_dir = tempfile.mkdtemp()
+        try:
+            input_path = os.path.join(cache_dir, 'raw.json')
+            with open(input_path, 'w') as output:
+                json.dump(raw_data, output)
+
+            pr.cached_features(input_path)
+            self.assertTrue(os.path.exists(pr.features_path(input_path)))
+
+            stored = pr.cached_features(input_path)
+            self.assertEqual(stored['keys'], features['keys'])
+            self.assertEqual(stored['allsites'], features['allsites'])
+            self.assertEqual(stored['parameters'], [{'action': 'acdc'}] * len(self.errors))
+            self.assertEqual((stored['features'] != features['features']).nnz, 0)
+
+            # The labels come from the stored features, so the raw data is not parsed again
+            class NoLoad(object):
+                def __getattr__(self, name):
+                    return getattr(json, name)
+                def load(self, *_):
+                    raise AssertionError('Raw data was parsed')
+
+            pr.json = NoLoad()
+            try:
+                classifier = pr.get_classifier(None, 'action', pr.cached_features(input_path))
+            finally:
+                pr.json = json
+            self.assertEqual(classifier.predict(stored['features']).tolist(),
+                             [0] * len(self.errors))
+        finally:
+            shutil.rmtree(cache_dir)
+
 
 class TestReasons(unittest.TestCase):
 
@@ -368,5 +1279,259 @@ class TestBlankReasons(TestActions):
         wf, reasons, params = ma.submitaction('test', **request)
         self.assertEqual(reasons[0]['short'], reasons[0]['long'])
 
+class TestClassifyErrors(unittest.TestCase):
+
+    logs = [
+        'Site name: T2_XX\n\nFileReadError (Exit code: 85)\n'
+        'Could not open root://eos/store/a.root\nFatal (Exit code: 8021)',
+        'Site name: T2_YY\n\nFileReadError (Exit code: 85)\n'
+        'Could not open root://eos/store/a.root or root://eos/store/b.root\n'
+        'R__unzip: error in b.root'
+        ]
+
+    class Workflow(object):
+        workflow = 'test_classify'
+
+        def __init__(self, logs):
+            self.logs = logs
+            self.error_index = {}
+
+        def get_explanation(self, errorcode):
+            return self.logs
+
+        def get_errors(self, get_unreported=False):
+            return {'/test_classify/a': {'85': {'site_a': 10}, '8021': {'site_b': 1}}}
+
+    def test_index(self):
+        import workflowwebtools.classifyerrors as ce
+
+        types, params = ce.index_logs(85, self.logs)
+        self.assertEqual(types, {'85': 'FileReadError (Exit code: 85)',
+                                 '8021': 'Fatal (Exit code: 8021)'})
+        self.assertEqual(params, ['root://eos/store/a.root', 'R__unzip'])
+
+        # No procedure means no additional parameters
+        self.assertEqual(ce.index_logs(1, self.logs), (types, []))
+
+    def test_cache(self):
+        import workflowwebtools.classifyerrors as ce
+
+        workflow = self.Workflow(self.logs)
+        max_error, classification = ce.classify_workflow(workflow, 'version1')
+        self.assertEqual(max_error, 85)
+        self.assertEqual(classification, ce.classifyerror(85, self.Workflow(self.logs)))
+
+        # The logs are only indexed once
+        self.assertTrue(ce.classify_workflow(workflow, 'version1')[1] is classification)
+        self.assertEqual(list(workflow.error_index), [85])
+
+        # The result is shared with other sessions
+        self.assertTrue(ce.classify_workflow(self.Workflow(self.logs), 'version1')[1]
+                        is classification)
+
+        # A new version or forgetting the workflow classifies again
+        self.assertFalse(ce.classify_workflow(workflow, 'version2')[1] is classification)
+        workflow.error_index = {}
+        workflow.logs = []
+        self.assertFalse(ce.classify_workflow(workflow, 'version2')[1][0] == '')
+        ce.forget('test_classify')
+        self.assertEqual(ce.classify_workflow(workflow, 'version2')[1][0], '')
+
+        # Only the most recent results are kept
+        keep = ce._CLASSIFIED_KEEP
+        ce._CLASSIFIED_KEEP = 2
+        try:
+            for version in ['version3', 'version4', 'version5']:
+                ce.classify_workflow(workflow, version)
+            self.assertEqual(list(ce._CLASSIFIED),
+                             [('test_classify', 'version4'), ('test_classify', 'version5')])
+        finally:
+            ce._CLASSIFIED_KEEP = keep
+
+    def test_classifyall(self):
+        import workflowwebtools.classifyerrors as ce
+
+        logs = self.logs
+
+        class Workflow(self.Workflow):
+            def __init__(self, workflow):
+                super(Workflow, self).__init__(logs)
+                self.workflow = workflow
+                if workflow.endswith('4'):
+                    raise ValueError('No job details')
+
+        workflows = ['test_classify_%i' % index for index in range(5)]
+
+        # Nothing is fetched over the network
+        workflow_info = ce.workflowinfo.WorkflowInfo
+        ce.workflowinfo.WorkflowInfo = Workflow
+        try:
+            classifications = ce.classify_all(workflows, 1)
+            # The threads give the same results
+            self.assertEqual(ce.classify_all(workflows, 3), classifications)
+        finally:
+            ce.workflowinfo.WorkflowInfo = workflow_info
+
+        expected = ce.describe(85, ce.classifyerror(85, self.Workflow(logs)))
+        self.assertEqual(expected['types'], 'FileReadError (Exit code: 85)<br>'
+                         'Fatal (Exit code: 8021)')
+        self.assertEqual(classifications,
+                         dict([(workflow, expected) for workflow in workflows[:4]] +
+                              [(workflows[4], {'error': 'No job details'})]))
+
+        self.assertEqual(ce.load_classifications()['workflows'], {})
+        ce.save_classifications(classifications, 'version1')
+        with open(ce.classifications_path(), 'r') as input_file:
+            saved = json.load(input_file)
+        stored = ce.load_classifications()
+        os.remove(ce.classifications_path())
+
+        self.assertEqual(saved['version'], 'version1')
+        self.assertEqual(saved['workflows'], classifications)
+        self.assertEqual(stored, saved)
+
+
+class TestPredictFeatures(unittest.TestCase):
+
+    def test_featuremap(self):
+        from workflowwebtools.predict.features import FeatureMap
+
+        feature_map = FeatureMap([-1, 85, 8021], ['NA', 'T1_XX_A', 'T2_XX_B', 'T2_XX_C'])
+
+        features = feature_map.build([
+            {'85': {'T1_XX_A': 3}, 'NotReported': {'T2_XX_C': 4}, '1': {'T1_XX_A': 5}},
+            {'8021': {'T1_XX_A_Disk': 6, 'T3_XX_D': 7}}
+            ])
+
+        self.assertEqual(features.shape, (2, 12))
+        # One site at a time, and unknown exit codes are skipped
+        self.assertEqual(features[0].tolist(), [0, 0, 0, 0, 3, 0, 0, 0, 0, 4, 0, 0])
+        # Sites are replaced by the site without the last part, and tiers without sites skipped
+        self.assertEqual(features[1].tolist(), [0, 0, 0, 0, 0, 6, 0, 0, 0, 0, 0, 0])
+
+        # The same proxy is used each time
+        proxy = feature_map.site_column('T2_YY_E')
+        self.assertTrue(proxy in [2, 3])
+        for _ in range(10):
+            self.assertEqual(feature_map.site_column('T2_YY_E'), proxy)
+
+    def test_microbatcher(self):
+        import threading
+        from workflowwebtools.predict.batching import MicroBatcher
+
+        batches = []
+
+        def double(values):
+            batches.append(len(values))
+            if 'bad' in values:
+                raise ValueError('bad input')
+            return [value * 2 for value in values]
+
+        batcher = MicroBatcher(double, window=1.0, max_size=8)
+        outputs = {}
+
+        def call(value):
+            outputs[value] = batcher(value)
+
+        threads = [threading.Thread(target=call, args=(value,)) for value in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(outputs, {value: value * 2 for value in range(8)})
+        # A full batch does not wait for the whole window
+        self.assertEqual(batches, [8])
+
+        batcher.window = 0.01
+        self.assertEqual(batcher(5), 10)
+        self.assertRaises(ValueError, batcher, 'bad')
+
+        # Only the caller with the bad input gets the error of a failed batch
+        batcher.window = 1.0
+        batcher.max_size = 3
+        del batches[:]
+        errors = {}
+
+        def call_bad(value):
+            try:
+                outputs[value] = batcher(value)
+            except ValueError as error:
+                errors[value] = error
+
+        threads = [threading.Thread(target=call_bad, args=(value,))
+                   for value in ['a', 'bad', 'c']]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(list(errors), ['bad'])
+        self.assertEqual((outputs['a'], outputs['c']), ('aa', 'cc'))
+        self.assertEqual(batches, [3, 1, 1, 1])
+
+
+class TestLockStats(unittest.TestCase):
+
+    def test_report(self):
+        import threading
+        import time
+        import workflowwebtools.lockstats as ls
+
+        lock1 = ls.InstrumentedLock('test_lock')
+        lock2 = ls.InstrumentedLock('test_lock')
+
+        with lock1:
+            pass
+
+        lock2.acquire()
+        self.assertFalse(lock2.acquire(False))
+        def wait_for_lock():
+            with lock2:
+                pass
+
+        thread = threading.Thread(target=wait_for_lock)
+        thread.start()
+        time.sleep(0.05)
+        lock2.release()
+        thread.join()
+
+        report = [lock for lock in ls.report() if lock['name'] == 'test_lock'][0]
+
+        self.assertEqual(report['acquires'], 3)
+        self.assertEqual(report['contended'], 1)
+        self.assertTrue(report['wait']['max'] > 0.04)
+        self.assertEqual(sum(report['hold']['buckets'].values()), 3)
+        self.assertTrue(report['callsites'][0]['callsite'].startswith('test_workflowwebtools.py'))
+
+    def test_lockdict(self):
+        import workflowwebtools.lockstats as ls
+
+        locks = ls.InstrumentedLockDict('test_workflow_lock')
+
+        self.assertTrue(locks.get('wf_a') is locks.get('wf_a'))
+        self.assertFalse(locks.get('wf_a') is locks.get('wf_b'))
+
+        held = locks.acquire(['wf_b', 'wf_a', 'wf_b'])
+        self.assertEqual(len(held), 2)
+        self.assertTrue(locks.get('wf_a').locked())
+        # Other workflows are not blocked
+        self.assertTrue(locks.get('wf_c').acquire(False))
+        locks.get('wf_c').release()
+
+        locks.release(held)
+        self.assertFalse(locks.get('wf_b').locked())
+
+        # Locks are dropped once they are released and not used
+        import gc
+        locks.get('wf_d').acquire()
+        gc.collect()
+        self.assertTrue('wf_d' in locks.locks)
+        locks.get('wf_d').release()
+        gc.collect()
+        self.assertFalse('wf_d' in locks.locks)
+        self.assertFalse('wf_c' in locks.locks)
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -17,6 +17,7 @@ import yaml
 from CMSMonitoring.StompAMQ import StompAMQ
 import workflowmonit.workflowCollector as wc
 import workflowmonit.alertingDefs as ad
+from workflowwebtools import workflowsources
 
 CRED_FILE_PATH = os.path.join(os.path.dirname(
     os.path.abspath(__file__)), 'credential.yml')
@@ -191,9 +192,7 @@ def buildDoc(configpath):
     :rtype: list
     """
 
-    DB_QUERY_CMD = "SELECT NAME FROM CMS_UNIFIED_ADMIN.WORKFLOW WHERE WM_STATUS LIKE 'running%'"
-
-    _wkfs = wc.get_workflow_from_db(configpath, DB_QUERY_CMD)
+    _wkfs = wc.get_workflow_from_db(configpath, workflowsources.RUNNING_QUERY)
     completedWfs = getCompletedWorkflowsFromDb(configpath)
     wkfs = [w for w in _wkfs if w.workflow not in completedWfs]
 
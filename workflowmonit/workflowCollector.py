@@ -12,9 +12,9 @@ import threading
 from collections import defaultdict
 
 import yaml
-import cx_Oracle
 from workflowwebtools import workflowinfo
 from workflowwebtools import errorutils
+from workflowwebtools import workflowsources
 
 
 def save_json(json_obj, filename='tmp', gzipped=False):
@@ -87,7 +87,9 @@ def invalidate_caches(cacheDir=None):
 
 def get_workflowlist_from_db(config, queryCmd):
     '''
-    get a list of workflows from oracle db from a config dictionary which has a ``oracle`` key.
+    get a list of workflows from the workflow source in a config dictionary,
+    which has either a ``oracle`` or ``workflow_db`` key.
+    See :py:mod:`workflowwebtools.workflowsources`.
 
     :param dict config: config dictionary
     :param str queryCmd: SQL query command
@@ -96,17 +98,11 @@ def get_workflowlist_from_db(config, queryCmd):
     :rtype: list
     '''
 
-    if 'oracle' not in config:
+    source = workflowsources.get_source(config)
+    if source is None:
         return []
 
-    oracle_db_conn = cx_Oracle.connect(
-        *config['oracle'])  # pylint:disable=c-extension-no-member
-    oracle_cursor = oracle_db_conn.cursor()
-    oracle_cursor.execute(queryCmd)
-    wkfs = [row for row, in oracle_cursor]
-    oracle_db_conn.close()
-
-    return wkfs
+    return source.workflows(queryCmd)
 
 
 def get_workflow_from_db(configPath, queryCmd):
@@ -625,9 +621,8 @@ def main():
     # status_location = '/home/wsi/workdir/statuses.json' # dummy
     CONFIG_FILE_PATH = os.path.join(os.path.dirname(
         os.path.abspath(__file__)), 'config.yml')
-    #DB_QUERY_CMD = "SELECT NAME FROM CMS_UNIFIED_ADMIN.WORKFLOW WHERE WM_STATUS LIKE 'running%'"
-    DB_QUERY_CMD = "SELECT NAME FROM CMS_UNIFIED_ADMIN.workflow WHERE lower(STATUS) LIKE '%manual%'"
-    wfs = get_workflow_from_db(CONFIG_FILE_PATH, DB_QUERY_CMD)
+    # Use workflowsources.RUNNING_QUERY for the running workflows
+    wfs = get_workflow_from_db(CONFIG_FILE_PATH, workflowsources.MANUAL_QUERY)
 
     print("Number of workflows retrieved from Oracle DB: ", len(wfs))
     invalidate_caches()
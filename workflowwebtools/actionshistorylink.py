@@ -14,33 +14,54 @@ from . import manageactions
 from . import globalerrors
 
 
-def dump_json(file_name=None):
+def subtask_parameters(action, subtask):
+    """
+    Get the parameters of an action that apply to one subtask.
+    These are the labels that the models are trained to predict.
+
+    :param dict action: The action document of a workflow,
+                        with the keys 'Action' and 'Parameters'
+    :param str subtask: The full name of the subtask
+    :returns: The parameters, including the key 'action'
+    :rtype: dict
+    """
+
+    name = action['Action']
+    if name in ['acdc', 'recovery']:
+        parameters = action['Parameters'].get('/'.join(subtask.split('/')[2:]), {})
+    else:
+        parameters = action['Parameters']
+
+    parameters = dict(parameters)
+    parameters['action'] = name if name != 'special' else action['Parameters']['action']
+
+    return parameters
+
+
+def dump_json(file_name=None, window=None):
     """
     Dump a list of pairs into a file and returns the dictionary.
     The pairs are dictionary of errors, and action document.
     Each element in the list corresponds to a different subtask.
 
     :param str file_name: The location to place the json file, if set
+    :param int window: Only use the errors added to the history in this many days.
+                       Defaults to ``history: window_days`` in the server configuration.
     :returns: The errors and actions for each subtask
     :rtype: dict
     """
 
     output = {}
 
-    history = globalerrors.ErrorInfo(serverconfig.workflow_history_path())
+    history = globalerrors.ErrorInfo(
+        serverconfig.workflow_history_path(),
+        serverconfig.history_window() if window is None else window)
     actions = manageactions.get_actions(0, acted=None)
 
     session = {'info': history}
 
     for workflow in actions:
         for subtask in history.get_step_list(workflow):
-            action = actions[workflow]['Action']
-            if action in ['acdc', 'recovery']:
-                parameters = actions[workflow]['Parameters'].get(
-                    '/'.join(subtask.split('/')[2:]), {})
-            else:
-                parameters = actions[workflow]['Parameters']
-
             output[subtask] = {
                 'errors': {
                     'good_sites': globalerrors.get_step_table(
@@ -50,14 +71,9 @@ def dump_json(file_name=None):
                         subtask, session, readymatch=['yellow', 'red', 'none'],
                         sparse=True)
                     },
-                'parameters':
-                    parameters
+                'parameters': subtask_parameters(actions[workflow], subtask)
                 }
 
-            output[subtask]['parameters']['action'] = \
-                action if action != 'special' else \
-                actions[workflow]['Parameters']['action']
-
     if file_name:
         with open(file_name, 'w') as output_file:
             json.dump(output, output_file)
@@ -3,15 +3,107 @@ This module reads the explain error info for a session and tries to
 classify them in a way that can help recommend procedures to the operator.
 These procedures are gathered from :py:mod:`WorkflowWebTools.procedures`.
 
+Every workflow in a snapshot of the current errors can also be classified at once
+by :py:func:`classify_all`, which spreads the workflows over a pool of threads.
+Most of the time is spent fetching logs, so threads are enough,
+and they are safe to start from the threads of the server.
+The results are stored in the workspace, so they can be served in bulk.
+
 :author: Daniel Abercrombie <dabercro@mit.edu>
 """
 
+import os
 import re
+import json
+import time
+import threading
 
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 
+from . import serverconfig
+from . import workflowinfo
+from . import errorutils
 from .procedures import PROCEDURES
 
+
+LOG_MARKERS = re.compile(r'\(Exit code: \d+\)|\.root')
+"""
+Finds everything in a log that could be part of a line with a type of error or
+additional parameters, in a single scan.
+Only the lines with these markers are looked at further.
+"""
+
+ERROR_TYPE = re.compile(r'[\w\s]+ \(Exit code: (\d+)\)')
+"""Matches the lines that start with a type of error and its exit code"""
+
+
+def index_logs(errorcode, logs):
+    """
+    Extract the types of errors and additional parameters from the logs of an error code
+
+    :param int errorcode: The error code of the logs, which selects the procedure
+    :param list logs: The logs from :py:meth:`workflowinfo.WorkflowInfo.get_explanation`
+    :returns: The types of errors, keyed by exit code, and the list of additional parameters
+    :rtype: dict, list
+    """
+
+    additional_re = PROCEDURES.get(errorcode, {}).get('additional', {}).get('re', None)
+
+    error_types = {}
+    additional_params = []
+    seen_params = set()
+
+    for log in logs:
+        line_end = -1
+        for marker in LOG_MARKERS.finditer(log):
+            # Each line is only checked once, even with many markers
+            if marker.start() < line_end:
+                continue
+
+            line_start = log.rfind('\n', 0, marker.start()) + 1
+            line_end = log.find('\n', marker.end())
+            if line_end < 0:
+                line_end = len(log)
+
+            line = log[line_start:line_end]
+
+            # Add each type of error associated with the log
+            match = ERROR_TYPE.match(line)
+            if match and match.group(1) not in error_types:
+                error_types[match.group(1)] = match.group(0)
+
+            # Get additional parameters
+            if additional_re and '.root' in line:
+                add_match = additional_re.search(line)
+                if add_match and add_match.group(1) not in seen_params:
+                    seen_params.add(add_match.group(1))
+                    additional_params.append(add_match.group(1))
+
+    return error_types, additional_params
+
+
+def get_index(errorcode, workflow):
+    """
+    Get the types of errors and additional parameters for an error code of a workflow.
+    These are only extracted from the logs once for each time the
+    job detail of the workflow is loaded.
+
+    :param int errorcode: The error code that we want to classify
+    :param workflowinfo.WorkflowInfo workflow: the workflow that we want to get the errors from
+    :returns: The output of :py:func:`index_logs`
+    :rtype: dict, list
+    """
+
+    logs = workflow.get_explanation(str(errorcode))
+
+    # The index is replaced when the explanations are rebuilt
+    index = workflow.error_index
+    if errorcode not in index:
+        index[errorcode] = index_logs(errorcode, logs)
+
+    return index[errorcode]
+
+
 def classifyerror(errorcode, workflow):
     """
     Return the most relevant characteristics of an error code for this session.
@@ -36,29 +128,7 @@ def classifyerror(errorcode, workflow):
 
     procedure = PROCEDURES.get(errorcode, {})
 
-    logs = workflow.get_explanation(str(errorcode))
-
-    error_re = re.compile(r'[\w\s]+ \(Exit code: (\d+)\)')
-    error_types = {}
-
-    additional_re = procedure.get('additional', {}).get('re', None)
-    additional_params = []
-
-    for log in logs:
-        for line in log.split('\n'):
-            # Add each type of error associated with the log
-            match = error_re.match(line)
-            if match and match.group(1) not in error_types.keys():
-                error_types[match.group(1)] = match.group(0)
-            # Get additional parameters
-
-            if '.root' not in line:
-                continue
-
-            if additional_re:
-                add_match = additional_re.search(line)
-                if add_match and add_match.group(1) not in additional_params:
-                    additional_params.append(add_match.group(1))
+    error_types, additional_params = get_index(errorcode, workflow)
 
     # Create the strings to return
 
@@ -79,6 +149,58 @@ def classifyerror(errorcode, workflow):
             additional_actions_string.replace(' |br| |br| ', '<br>'))
 
 
+_CLASSIFIED = OrderedDict()
+_CLASSIFIED_LOCK = threading.Lock()
+_CLASSIFIED_KEEP = 4096
+
+
+def classify_workflow(workflow, version=None):
+    """
+    Get the most common error code of a workflow and its classification.
+    The result is shared by every session for the same workflow and version,
+    until :py:func:`forget` is called for the workflow.
+    Only the most recently used results are kept.
+
+    :param workflowinfo.WorkflowInfo workflow: the workflow that we want to classify
+    :param version: Identifies the errors that the workflow is classified for,
+                    such as the path of the current snapshot
+    :returns: The output of :py:func:`get_max_errorcode` and :py:func:`classifyerror`
+    :rtype: int, tuple
+    """
+
+    key = (workflow.workflow, version)
+
+    with _CLASSIFIED_LOCK:
+        output = _CLASSIFIED.pop(key, None)
+        if output is not None:
+            _CLASSIFIED[key] = output
+            return output
+
+    max_error = get_max_errorcode(workflow)
+    output = (max_error, classifyerror(max_error, workflow))
+
+    with _CLASSIFIED_LOCK:
+        _CLASSIFIED.pop(key, None)
+        _CLASSIFIED[key] = output
+        while len(_CLASSIFIED) > _CLASSIFIED_KEEP:
+            _CLASSIFIED.popitem(last=False)
+
+    return output
+
+
+def forget(workflow):
+    """
+    Drop the cached classifications of a workflow,
+    such as when its job details are loaded again.
+
+    :param str workflow: The name of the workflow
+    """
+
+    with _CLASSIFIED_LOCK:
+        for key in [key for key in _CLASSIFIED if key[0] == workflow]:
+            _CLASSIFIED.pop(key)
+
+
 def get_max_errorcode(workflow):
     """
     Get the errorcode with the most errors for a session
@@ -105,3 +227,107 @@ def get_max_errorcode(workflow):
             output = code
 
     return output
+
+
+def describe(max_error, classification):
+    """
+    :param int max_error: The output of :py:func:`get_max_errorcode`
+    :param tuple classification: The output of :py:func:`classifyerror`
+    :returns: The classification with the keys 'maxerror', 'types', 'recommended', and 'params'
+    :rtype: dict
+    """
+
+    return {
+        'maxerror': max_error,
+        'types': classification[0],
+        'recommended': classification[1],
+        'params': classification[2]
+    }
+
+
+def classify_name(workflow):
+    """
+    Classify a workflow from only its name.
+    This is run in the threads of :py:func:`classify_all`.
+
+    :param str workflow: The name of the workflow
+    :returns: The workflow name and the output of :py:func:`describe`.
+              If the workflow could not be classified, the second element
+              only has the key 'error', with the reason.
+    :rtype: str, dict
+    """
+
+    try:
+        info = workflowinfo.WorkflowInfo(workflow)
+        max_error = get_max_errorcode(info)
+        return workflow, describe(max_error, classifyerror(max_error, info))
+    except Exception as error:      # pylint: disable=broad-except
+        return workflow, {'error': str(error)}
+
+
+def classify_all(workflows, threads=None):
+    """
+    Classify many workflows in parallel.
+
+    :param list workflows: The names of the workflows
+    :param int threads: The number of threads.
+                        Defaults to ``classify: threads`` in ``config.yml``.
+                        With one thread, the workflows are classified in this thread.
+    :returns: The output of :py:func:`describe` for each workflow
+    :rtype: dict
+    """
+
+    workflows = list(workflows)
+    if threads is None:
+        threads = serverconfig.config_dict().get('classify', {}).get('threads', 8)
+
+    if int(threads) == 1:
+        return dict(classify_name(workflow) for workflow in workflows)
+
+    return dict(errorutils.thread_map(classify_name, workflows, 'Classifying workflows',
+                                      int(threads)))
+
+
+def classifications_path():
+    """
+    :returns: The location of the stored classifications in the workspace
+    :rtype: str
+    """
+
+    return os.path.join(serverconfig.config_dict()['workspace'], 'classifications.json')
+
+
+def save_classifications(classifications, version):
+    """
+    Store the classifications of all workflows in the workspace
+
+    :param dict classifications: The output of :py:func:`classify_all`
+    :param str version: Identifies the snapshot that was classified
+    """
+
+    path = classifications_path()
+    temp_path = '%s.%i.tmp' % (path, os.getpid())
+
+    with open(temp_path, 'w') as output:
+        json.dump({'version': version, 'updated': int(time.time()),
+                   'workflows': classifications}, output)
+
+    # Readers only ever see a complete file
+    os.rename(temp_path, path)
+
+
+def load_classifications():
+    """
+    Load the classifications stored by :py:func:`save_classifications`
+
+    :returns: Object with the keys 'version', 'updated', and 'workflows'.
+              If nothing is stored, the version and time are None and there are no workflows.
+    :rtype: dict
+    """
+
+    path = classifications_path()
+    if os.path.exists(path):
+        with open(path, 'r') as input_file:
+            return json.load(input_file)
+
+    return {'version': None, 'updated': None, 'workflows': {}}
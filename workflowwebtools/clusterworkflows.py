@@ -45,15 +45,119 @@ can be some separation for the number of errors in a workflow
 :author: Daniel Abercrombie <dabercro@mit.edu>
 """
 
+import os
+import copy
+import json
 import threading
+import collections
+import pickle
+import hashlib
+import tempfile
 
 import cherrypy
 import numpy
+import scipy.sparse
 import sklearn.cluster
 
 from . import globalerrors
+from . import historydb
 from . import serverconfig
-from . import errorutils
+from . import snapshots
+from . import lockstats
+
+
+def normalize_block(block, settings):
+    """
+    Places each row of a block of the error matrix on a hypersphere shell,
+    using the equation at the top of this module.
+
+    :param scipy.sparse.spmatrix block: The errors of one kind for each workflow
+    :param dict settings: The ``distance``, ``width``, and ``midpoint`` parameters
+    :returns: The normalized block
+    :rtype: scipy.sparse.csr_matrix
+    """
+
+    lengths = numpy.sqrt(numpy.asarray(block.multiply(block).sum(axis=1), dtype=float).ravel())
+    lengths[lengths == 0] = 1.0
+
+    norms = (float(settings['distance'])/1.4142 +
+             2.0 * float(settings['width']) *
+             (lengths/(lengths + float(settings['midpoint'])) - 0.5))/lengths
+
+    return scipy.sparse.diags(norms).dot(block).tocsr()
+
+
+def build_workflow_matrix(rows, workflows, allmap, settings=None):
+    """
+    Builds the matrix of errors for workflows.
+    The columns are the error codes, followed by the site names, in the order of the allmap.
+
+    :param rows: Iterable of ``(stepname, errorcode, sitename, numbererrors)``
+    :type rows: iterable
+    :param list workflows: The workflows to make rows for, in order
+    :param dict allmap: A globalerrors.ErrorInfo allmap that sets the columns.
+                        Errors not in the allmap are ignored.
+    :param dict settings: The ``cluster`` settings from the server configuration
+    :returns: A matrix with one row for each workflow
+    :rtype: scipy.sparse.csr_matrix
+    """
+
+    settings = settings or serverconfig.config_dict()['cluster']
+
+    workflow_index = {workflow: index for index, workflow in enumerate(workflows)}
+    num_codes = len(allmap['errorcode'])
+    code_index = {code: index for index, code in enumerate(allmap['errorcode'])}
+    site_index = {site: num_codes + index for index, site in enumerate(allmap['sitename'])}
+
+    row_indices = []
+    col_indices = []
+    values = []
+
+    for stepname, errorcode, sitename, numbererrors in rows:
+        row = workflow_index.get(stepname.split('/')[1])
+        if row is None:
+            continue
+
+        for col in (code_index.get(errorcode), site_index.get(sitename)):
+            if col is not None:
+                row_indices.append(row)
+                col_indices.append(col)
+                values.append(numbererrors)
+
+    num_cols = num_codes + len(site_index)
+
+    # Duplicate entries are summed when converting
+    matrix = scipy.sparse.coo_matrix(
+        (numpy.array(values, dtype=float),
+         (numpy.array(row_indices, dtype=int), numpy.array(col_indices, dtype=int))),
+        shape=(len(workflows), num_cols)).tocsr()
+
+    return scipy.sparse.hstack(
+        [normalize_block(matrix[:, :num_codes], settings['errorcode']),
+         normalize_block(matrix[:, num_codes:], settings['sitename'])]).tocsr()
+
+
+def get_workflow_matrix(workflows, session=None, allmap=None):
+    """
+    Gets the errors for workflows in a sparse matrix.
+    The errors are read with a single query.
+
+    :param list workflows: the workflows that rows are returned for
+    :param cherrypy.Session session: Stores the information for a session
+    :param dict allmap: a globalerrors.ErrorInfo allmap to override the
+                        session's allmap
+    :returns: A matrix with one row for each workflow.
+              See :py:func:`build_workflow_matrix`.
+    :rtype: scipy.sparse.csr_matrix
+    """
+
+    curs = globalerrors.check_session(session, can_refresh=True)
+    if not allmap:
+        allmap = curs.get_allmap()
+
+    rows = curs.execute('SELECT stepname, errorcode, sitename, numbererrors FROM workflows')
+
+    return build_workflow_matrix(rows, workflows, allmap)
 
 
 def get_workflow_vectors(workflows, session=None, allmap=None):
@@ -67,127 +171,276 @@ def get_workflow_vectors(workflows, session=None, allmap=None):
     :return: a list of numpy arrays of errors for the workflow
     :rtype: list of numpy.array
     """
-    curs = globalerrors.check_session(session, can_refresh=True)
-    if not allmap:
-        allmap = globalerrors.check_session(session).get_allmap()
 
-    columns = ['errorcode', 'sitename']
-    column_output = {}
+    return list(get_workflow_matrix(workflows, session, allmap).toarray())
 
-    for column in columns:
-        # Initialize with all zeros
-        settings = serverconfig.config_dict()['cluster'][column]
-        column_output[column] = [numpy.zeros(len(allmap[column])) for _ in workflows]
 
-        cherrypy.log('Getting db_lock: 3')
-        curs.db_lock.acquire()
-        curs.curs.execute("SELECT SUM(numbererrors), {0}, stepname "
-                          "FROM workflows "
-                          "GROUP BY stepname, {0} "
-                          "ORDER BY {0} ASC, stepname ASC;".format(column))
-
-        numerrors, colval, stepname = curs.curs.fetchone() or (0, '', '')
-        wfname = stepname.split('/')[1] if stepname else ''
+def fit_clusterer(data, incremental=False):
+    """
+    Fit a new clusterer to the workflow vectors
+
+    :param data: The workflow vectors to fit
+    :type data: scipy.sparse.csr_matrix
+    :param bool incremental: If True, use a clusterer that can be updated
+                             with :py:func:`update_clusterer`
+    :returns: The fitted clusterer
+    :rtype: sklearn.cluster.KMeans or sklearn.cluster.MiniBatchKMeans
+    """
 
-        for icol, value in enumerate(allmap[column]):
-            for iwkf, workflow in enumerate(workflows):
-                while colval == value and workflow == wfname:
-                    column_output[column][iwkf][icol] += numerrors
-                    numerrors, colval, stepname = curs.curs.fetchone() or (0, '', '')
-                    if stepname:
-                        wfname = stepname.split('/')[1]
+    settings = serverconfig.config_dict()['cluster']
 
-        cherrypy.log('releasing db_lock: 3')
-        curs.db_lock.release()
+    clusterer = sklearn.cluster.KMeans(n_clusters=settings['n_clusters'],
+                                       n_init=settings['n_init'],
+                                       n_jobs=settings.get('n_jobs', -1))
 
-        # Preprocessing here
-        for output in column_output[column]:
-            length = numpy.linalg.norm(output) or 1.0
-            norm = (float(settings['distance'])/1.4142 +
-                    2.0 * float(settings['width']) *
-                    (length/(length + float(settings['midpoint'])) - 0.5))/length
+    clusterer.fit(data)
 
-            output *= float(norm)
+    if incremental:
+        # Start from the full fit, so that only updates are approximate
+        clusterer = sklearn.cluster.MiniBatchKMeans(
+            n_clusters=settings['n_clusters'],
+            init=clusterer.cluster_centers_, n_init=1,
+            batch_size=settings.get('batch_size', 1000))
+        clusterer.partial_fit(data)
 
-    return [numpy.concatenate([column_output[col][iwkf] for col in columns]) \
-                for iwkf, _ in enumerate(workflows)]
+    return clusterer
 
 
-def get_clusterer(history_path, errors_path=''):
+def get_clusterer(history_path, errors_path='', window=None, incremental=None):
     """Use this function to get the clusterer of workflows
 
     :param str history_path: Path to the workflow historical data.
                              This can be a local file path or a URL.
     :param str errors_path: The errors for a given session to include
                             in the clustering
+    :param int window: Only cluster with the errors added to the history
+                       in this many days. Defaults to ``history: window_days``
+                       in the server configuration.
+    :param bool incremental: If True, the clusterer can be updated with
+                             :py:func:`update_clusterer` instead of refit.
+                             Defaults to ``cluster: incremental`` in the server configuration.
     :return: A dict of a clusterer that is fitted to historical data
-             with its allmap. The keys are 'clusterer' and 'allmap'.
+             with its allmap and the :py:func:`model_key` of the history it was fit to.
+             The keys are 'clusterer', 'allmap', and 'key'.
+             Incremental clusterers also have the keys 'updated', 'baseline', and 'snapshot'.
     :rtype: dict
     """
 
     cherrypy.log('Initializing cluster session')
 
+    if incremental is None:
+        incremental = serverconfig.config_dict()['cluster'].get('incremental', False)
+
     # This will be the location of our training data
     fake_session = {
-        'info': globalerrors.ErrorInfo(history_path)
+        'info': globalerrors.ErrorInfo(
+            history_path, serverconfig.history_window() if window is None else window)
         }
 
     # If the path to additional errors is given, add that to the clustering data.
     if errors_path:
-        errorutils.add_to_database(globalerrors.check_session(fake_session), errors_path)
-        globalerrors.check_session(fake_session).set_all_lists()
+        globalerrors.check_session(fake_session).add_errors(errors_path)
+
+    # Rows ingested in the history after this are new to the clusterer.
+    # This is read after the current errors are added, so they are not folded in again.
+    newest = _history_rows(history_path)[1]
+    key = model_key(history_path)
 
     # Get the data by getting table for each workflow
     workflows = globalerrors.check_session(fake_session).return_workflows()
 
     # Fill the data
     cherrypy.log('Getting workflow vectors')
-    data = get_workflow_vectors(workflows, fake_session)
+    data = get_workflow_matrix(workflows, fake_session)
+    allmap = fake_session['info'].get_allmap()
+    # Close the history database, since it is not read after this
+    globalerrors.check_session(fake_session).teardown()
 
-    cherrypy.log('Number of datapoints to cluster: %i' % len(data))
+    cherrypy.log('Number of datapoints to cluster: %i with %i non-zero entries' %
+                 (data.shape[0], data.nnz))
     cherrypy.log('Fitting workflows...')
 
-    settings = serverconfig.config_dict()['cluster']
-    clusterer = sklearn.cluster.KMeans(n_clusters=settings['n_clusters'],
-                                       n_init=settings['n_init'],
-                                       n_jobs=-1)
-
-    clusterer.fit(numpy.array(data))
+    clusterer = fit_clusterer(data, incremental)
 
     cherrypy.log('Done')
 
-    return {'clusterer': clusterer, 'allmap': fake_session['info'].get_allmap()}
+    output = {'clusterer': clusterer, 'allmap': allmap, 'key': key}
+
+    if incremental:
+        output.update({
+            'updated': newest,
+            # The mean squared distance of workflows to their cluster center
+            'baseline': -clusterer.score(data)/(data.shape[0] or 1),
+            'snapshot': _snapshot_path(errors_path)
+            })
+
+    return output
+
+
+def _snapshot_path(errors_path):
+    """
+    :param str errors_path: The current errors
+    :returns: The path of the snapshot of the current errors, or None
+    :rtype: str
+    """
+
+    if not errors_path:
+        return None
+
+    return snapshots.get_snapshot(errors_path)
+
+
+def _history_rows(history_path, since=None):
+    """
+    Get the errors of all workflows with errors added to the history after a time.
+
+    :param str history_path: Path to the workflow history database
+    :param int since: The ingest time of the newest errors that are not new.
+                      If None, no rows are read.
+    :returns: The ``(stepname, errorcode, sitename, numbererrors)`` of the workflows
+              and the ingest time of the newest errors in the history.
+              These are None if the history does not store when errors were added.
+    :rtype: tuple
+    """
+
+    if not os.path.exists(history_path):
+        return None, None
+
+    conn = snapshots.connect(history_path)
+    try:
+        if not historydb.is_history(conn.cursor()):
+            return None, None
+
+        newest = historydb.latest_ingest(conn.cursor()) or 0
+        if since is None:
+            return [], newest
+
+        workflow = "substr(stepname, 2, instr(substr(stepname, 2), '/') - 1)"
+        return list(conn.execute(
+            'SELECT stepname, errorcode, sitename, numbererrors FROM workflows '
+            'WHERE {0} IN (SELECT DISTINCT {0} FROM workflows WHERE ingested > ?)'.format(
+                workflow), (since,))), newest
+    finally:
+        conn.close()
+
+
+def update_clusterer(clusterer, history_path, errors_path=''):
+    """
+    Fold the workflows with errors added to the history since the clusterer was last
+    fit or updated into the clusterer. The current errors are also folded in
+    when they have changed.
+    The clusterer is refit from scratch with :py:func:`get_clusterer` if it
+    is not incremental, or if the new workflows are too far from the current clusters.
+    The drift is the larger of the fractional increase of the mean squared distance
+    of new workflows to their clusters and the fraction of new errors with error codes
+    or sites that were not in the clustering data. It is compared with
+    ``cluster: drift_threshold`` in the server configuration.
+
+    :param dict clusterer: The output of :py:func:`get_clusterer`, which is not changed
+    :param str history_path: Path to the workflow history database
+    :param str errors_path: The current errors
+    :returns: A new clusterer, in the same format as :py:func:`get_clusterer`
+    :rtype: dict
+    """
+
+    if 'baseline' not in clusterer:
+        return get_clusterer(history_path, errors_path)
+
+    key = model_key(history_path)
+    rows, newest = _history_rows(history_path, clusterer['updated'])
+    if rows is None:
+        cherrypy.log('History has no ingest times, so refitting clusters')
+        return get_clusterer(history_path, errors_path, incremental=True)
+
+    snapshot = _snapshot_path(errors_path)
+    if snapshot and snapshot != clusterer['snapshot']:
+        conn = snapshots.connect(snapshot)
+        try:
+            rows.extend(conn.execute(
+                'SELECT stepname, errorcode, sitename, numbererrors FROM workflows'))
+        finally:
+            conn.close()
+
+    output = dict(clusterer, updated=newest, snapshot=snapshot, key=key)
+
+    if not rows:
+        return output
+
+    allmap = clusterer['allmap']
+    known_codes = set(allmap['errorcode'])
+    known_sites = set(allmap['sitename'])
+    unknown = sum(1 for _, errorcode, sitename, _ in rows
+                  if errorcode not in known_codes or sitename not in known_sites)
+
+    workflows = sorted(set(row[0].split('/')[1] for row in rows))
+    data = build_workflow_matrix(rows, workflows, allmap)
+
+    drift = max(-clusterer['clusterer'].score(data)/data.shape[0]/(clusterer['baseline'] or 1e-9)
+                - 1.0, float(unknown)/len(rows))
+
+    cherrypy.log('Cluster drift from %i new workflows: %.3f' % (len(workflows), drift))
+
+    if drift > float(serverconfig.config_dict()['cluster'].get('drift_threshold', 0.5)):
+        cherrypy.log('Drift is over threshold, so refitting clusters')
+        return get_clusterer(history_path, errors_path, incremental=True)
+
+    # Update a copy, so that the old clusterer can be used until this one is ready
+    output['clusterer'] = copy.deepcopy(clusterer['clusterer'])
+    output['clusterer'].partial_fit(data)
+
+    return output
+
+
+_GROUPS = collections.OrderedDict()
+_GROUPS_LOCK = threading.Lock()
+_GROUPS_KEEP = 8
 
 
 def get_workflow_groups(clusterer, session=None):
-    """Groups workflows together based on a fitted clusterer
+    """Groups workflows together based on a fitted clusterer.
+    The groups are only predicted once for each snapshot of errors and clusterer,
+    and are shared by every session.
 
     :param dict clusterer: is a dictionary with the clusterer fit with
                            historic data and the allmap to generate it.
                            This matches the output of :func:`get_clusterer`.
     :param cherrypy.Session session: Stores the information for a session
-    :returns: A dictionary pointing workflows to a group
-    :rtype: dict
+    :returns: A dictionary pointing workflows to a group and
+              a dictionary pointing groups to a tuple of their workflows
+    :rtype: dict, dict
     """
 
     errorinfo = globalerrors.check_session(session, can_refresh=True)
+    # Only the current errors include workflows with no errors, so the location is part of the key
+    key = (errorinfo.db_path, errorinfo.data_location)
 
-    if errorinfo.clusters:
-        return errorinfo.clusters
+    with _GROUPS_LOCK:
+        groups = _GROUPS.get(key)
+        if groups is not None and groups[0] is clusterer['clusterer']:
+            _GROUPS[key] = _GROUPS.pop(key)
+            return groups[1], groups[2]
 
     cherrypy.log('Fitting existing workflows.')
 
-    workflows = globalerrors.check_session(session).return_workflows()
-    vectors = get_workflow_vectors(workflows, session, clusterer['allmap'])
+    workflows = errorinfo.return_workflows()
+    predictions = clusterer['clusterer'].predict(
+        get_workflow_matrix(workflows, session, clusterer['allmap']))
 
-    predictions = clusterer['clusterer'].predict(numpy.array(vectors))
+    labels = {}
+    members = {}
+    for workflow, label in zip(workflows, predictions):
+        labels[workflow] = label
+        members.setdefault(label, []).append(workflow)
 
-    cherrypy.log(str(predictions))
+    members = {label: tuple(group) for label, group in members.items()}
 
-    for index, workflow in enumerate(workflows):
-        errorinfo.clusters[workflow] = predictions[index]
+    with _GROUPS_LOCK:
+        _GROUPS.pop(key, None)
+        _GROUPS[key] = (clusterer['clusterer'], labels, members)
+        while len(_GROUPS) > _GROUPS_KEEP:
+            _GROUPS.popitem(last=False)
 
-    return errorinfo.clusters
+    return labels, members
 
 
 def get_clustered_group(workflow, clusterer, session=None):
@@ -201,21 +454,109 @@ def get_clustered_group(workflow, clusterer, session=None):
     :rtype: set
     """
 
-    output = []
+    labels, members = get_workflow_groups(clusterer, session)
 
-    predictions = get_workflow_groups(clusterer, session)
+    group = labels.get(workflow)
 
-    group = predictions.get(workflow)
+    if group is None:
+        return []
 
-    if group is not None:
-        for wkf, cluster in predictions.items():
-            if cluster == group and wkf != workflow:
-                output.append(wkf)
+    return [wkf for wkf in members[group] if wkf != workflow]
 
-    return output
+
+def model_key(history_path):
+    """
+    Get the key of the clusterer that would be fit to a workflow history.
+    It changes when the contents of the history or the clustering configuration change.
+    For a history database, the contents are given by the number of errors
+    and the time the newest errors were added, so rewriting the file
+    without changing its contents does not change the key.
+
+    :param str history_path: Path to the workflow historical data
+    :returns: The hash of the history and the configuration
+    :rtype: str
+    """
+
+    history_digest = None
+
+    if os.path.isfile(history_path):
+        conn = snapshots.connect(history_path)
+        try:
+            if historydb.is_history(conn.cursor()):
+                history_digest = [
+                    conn.execute('SELECT COUNT(*) FROM history_keys').fetchone()[0],
+                    historydb.latest_ingest(conn.cursor())
+                    ]
+        finally:
+            conn.close()
+
+    if history_digest is None:
+        history_digest = snapshots.load_source(history_path)[0]
+
+    # How long to wait after a failed fit and how many processes fit do not change the clusters
+    settings = {key: value for key, value in serverconfig.config_dict()['cluster'].items()
+                if key not in ['retry_after', 'n_jobs']}
+
+    return hashlib.sha1(json.dumps(
+        [history_digest, settings, serverconfig.history_window()],
+        sort_keys=True).encode()).hexdigest()
+
+
+def model_path():
+    """
+    :returns: The location of the stored clusterer in the workspace
+    :rtype: str
+    """
+
+    return os.path.join(serverconfig.config_dict()['workspace'], 'clusterer.pkl')
+
+
+def save_clusterer(clusterer, key):
+    """
+    Store a clusterer in the workspace, so that it does not have to be
+    fit again when the server restarts.
+
+    :param dict clusterer: The output of :py:func:`get_clusterer`
+    :param str key: The output of :py:func:`model_key` for the history the clusterer was fit to,
+                    which is stored under 'key' in the clusterer
+    """
+
+    path = model_path()
+    # Each save gets its own file, so that concurrent saves do not write over each other
+    handle, temp_path = tempfile.mkstemp(suffix='.tmp', prefix=os.path.basename(path) + '.',
+                                         dir=os.path.dirname(path))
+
+    with os.fdopen(handle, 'wb') as output:
+        pickle.dump({'key': key, 'clusterer': clusterer}, output, pickle.HIGHEST_PROTOCOL)
+
+    # Other processes only ever see a complete file
+    os.rename(temp_path, path)
+
+
+def load_clusterer():
+    """
+    Load the clusterer stored by :py:func:`save_clusterer`
+
+    :returns: The key and the clusterer. Both are None if there is no usable clusterer stored.
+    :rtype: str, dict
+    """
+
+    path = model_path()
+    if not os.path.exists(path):
+        return None, None
+
+    try:
+        with open(path, 'rb') as input_file:
+            stored = pickle.load(input_file)
+    except Exception as error:      # pylint: disable=broad-except
+        # Models stored by a different version of sklearn cannot always be read
+        cherrypy.log('Could not load clusterer from %s: %s' % (path, error))
+        return None, None
+
+    return stored['key'], stored['clusterer']
 
 
-CLUSTER_LOCK = threading.Lock()
+CLUSTER_LOCK = lockstats.InstrumentedLock('CLUSTER_LOCK')
 """
 Lock that should be acquired before running clustering functions in here
 """
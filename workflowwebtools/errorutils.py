@@ -10,38 +10,188 @@ to generate an ErrorInfo instance in other applications.
 import os
 import json
 import re
+import ssl
+import time
+from itertools import islice
+from multiprocessing.pool import ThreadPool
 try:
     import urlparse
 except ImportError:
     import urllib.parse as urlparse # pylint: disable=import-error
+try:
+    import httplib
+except ImportError:
+    import http.client as httplib # pylint: disable=import-error
+try:
+    import ijson
+except ImportError:
+    # Without ijson, local files are loaded whole with json.
+    # It is installed with the package, so this only happens for other installs.
+    ijson = None
 
 import validators
 import cherrypy
-import cx_Oracle
 
 from cmstoolbox import sitereadiness
-from cmstoolbox.webtools import get_json
+from cmstoolbox.webtools import get_json, get_cookie_header
 
 from . import workflowinfo
 from . import serverconfig
+from . import workflowsources
+
+def thread_map(function, inputs, description, num_threads=None):
+    """
+    Call a function on each input from a bounded pool of threads.
+    Progress and the total time are written to the log.
+
+    :param function: Function that takes a single input
+    :type function: function
+    :param list inputs: The inputs to pass to the function
+    :param str description: What is being done, for the log
+    :param int num_threads: The size of the pool.
+                            Defaults to ``fetch_threads`` in ``config.yml``.
+    :returns: The outputs of the function, in the same order as the inputs
+    :rtype: list
+    :raises Exception: any error raised by the function, after the pool is stopped
+    """
+
+    inputs = list(inputs)
+    if not inputs:
+        return []
+
+    start = time.time()
+    num_threads = min(int(num_threads or serverconfig.config_dict().get('fetch_threads', 16)),
+                      len(inputs))
+    pool = ThreadPool(num_threads)
+
+    output = []
+    try:
+        for result in pool.imap(function, inputs):
+            output.append(result)
+            if not len(output) % 100:
+                cherrypy.log('%s: %i/%i done in %.1f s' %
+                             (description, len(output), len(inputs), time.time() - start))
+    except Exception:
+        pool.terminate()
+        raise
+
+    pool.close()
+    pool.join()
+
+    cherrypy.log('%s: %i done with %i threads in %.1f s' %
+                 (description, len(output), num_threads, time.time() - start))
+
+    return output
+
+
+def prefetch_map(function, inputs, num_threads=None):
+    """
+    Call a function on each input from a bounded pool of threads,
+    while the caller works through the outputs in order.
+    At most ``num_threads`` outputs are fetched ahead of the caller,
+    so only that many are held in memory at once.
+
+    :param function: Function that takes a single input
+    :type function: function
+    :param list inputs: The inputs to pass to the function
+    :param int num_threads: The size of the pool and the number of outputs fetched ahead.
+                            Defaults to ``fetch_threads`` in ``config.yml``.
+    :returns: Generator of each input and its output, in the same order as the inputs
+    :rtype: generator
+    """
+
+    inputs = list(inputs)
+    if not inputs:
+        return
+
+    num_threads = min(int(num_threads or serverconfig.config_dict().get('fetch_threads', 16)),
+                      len(inputs))
+    pool = ThreadPool(num_threads)
+
+    remaining = iter(inputs)
+    pending = [(value, pool.apply_async(function, (value,)))
+               for value in islice(remaining, num_threads)]
+
+    try:
+        while pending:
+            value, result = pending.pop(0)
+            output = result.get()
+
+            # Start the next fetch before the caller works on this output
+            for new in islice(remaining, 1):
+                pending.append((new, pool.apply_async(function, (new,))))
+
+            yield value, output
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def _get_prep_id(workflow):
+    """
+    :param str workflow: Name of the workflow
+    :returns: PrepID of the workflow
+    :rtype: str
+    """
+    return workflowinfo.WorkflowInfo(workflow).get_prep_id()
+
+
+def _get_prepid_workflows(prep_id):
+    """
+    :param str prep_id: Name of the PrepID
+    :returns: The workflows in the PrepID
+    :rtype: list
+    """
+    return workflowinfo.PrepIDInfo(prep_id).get_workflows()
+
+
+def _get_errors(workflow):
+    """
+    :param str workflow: Name of the workflow
+    :returns: The errors of the workflow, including the unreported ones
+    :rtype: dict
+    """
+    return workflowinfo.WorkflowInfo(workflow).get_errors(get_unreported=True)
+
+
+def merge_errors(workflows):
+    """
+    Fetch the errors of many workflows in parallel
+
+    :param list workflows: The workflows to get the errors for
+    :returns: The errors of all of the workflows, in the format of all_errors.json
+    :rtype: dict
+    """
+
+    indict = {}
+    for errors in thread_map(_get_errors, workflows, 'Fetching workflow errors'):
+        indict.update(errors)
+
+    return indict
+
 
 def errors_from_list(workflows):
     """
+    Get the errors of the workflows and all other workflows in the same PrepIDs.
+    Each PrepID and workflow is only fetched once,
+    even when several workflows share a PrepID.
+
     :param list workflows: A list of workflows that are in assistance-manual
     :returns: The errors for the workflows
     :rtype: dict
     """
-    indict = {}
 
-    for workflow in workflows:
-        base = workflowinfo.WorkflowInfo(workflow)
-        prep_id = base.get_prep_id()
-        for wkf in set(workflowinfo.PrepIDInfo(prep_id).get_workflows()):
-            indict.update(
-                workflowinfo.WorkflowInfo(wkf).get_errors(get_unreported=True)
-                )
+    prep_ids = sorted(set(thread_map(_get_prep_id, sorted(set(workflows)),
+                                     'Resolving PrepIDs')))
 
-    return indict
+    all_workflows = set()
+    for siblings in thread_map(_get_prepid_workflows, prep_ids, 'Listing PrepID workflows'):
+        all_workflows.update(siblings)
+
+    cherrypy.log('%i workflows in %i PrepIDs from %i manual workflows' %
+                 (len(all_workflows), len(prep_ids), len(workflows)))
+
+    return merge_errors(sorted(all_workflows))
 
 
 def open_location(data_location):
@@ -55,14 +205,9 @@ def open_location(data_location):
     """
     config_dict = serverconfig.config_dict()
 
-    if 'oracle' in config_dict:
-        oracle_db_conn = cx_Oracle.connect(*config_dict['oracle']) # pylint:disable=c-extension-no-member
-        oracle_cursor = oracle_db_conn.cursor()
-        oracle_cursor.execute(
-            "SELECT NAME FROM CMS_UNIFIED_ADMIN.workflow WHERE lower(STATUS) LIKE '%manual%'")
-        wkfs = [row for row, in oracle_cursor]
-        oracle_db_conn.close()
-        return errors_from_list(wkfs)
+    source = workflowsources.get_source(config_dict)
+    if source is not None:
+        return errors_from_list(source.workflows(workflowsources.MANUAL_QUERY))
 
     raw = None
 
@@ -94,6 +239,53 @@ def open_location(data_location):
     ])
 
 
+def url_version(data_location):
+    """
+    Ask the server for the version of a JSON file, without downloading it.
+    The same Shibboleth cookie as :py:func:`open_location` is used.
+
+    :param str data_location: The url of the file
+    :returns: The ETag or Last-Modified header, with the Content-Length if given.
+              None if the server does not send either header or the request fails.
+    :rtype: str
+    """
+
+    components = urlparse.urlparse(data_location)
+    cookie_stuff = serverconfig.config_dict()['data']
+
+    headers = {}
+    if cookie_stuff.get('cookie_file'):
+        headers['Cookie'] = get_cookie_header(
+            'https://%s%s' % (components.netloc, components.path),
+            cookie_stuff['cookie_file'], cookie_stuff.get('cookie_pem'),
+            cookie_stuff.get('cookie_key')).get(components.hostname, '')
+
+    conn = httplib.HTTPSConnection(
+        components.hostname, components.port or 443,
+        context=ssl._create_unverified_context()) # pylint: disable=protected-access
+
+    try:
+        conn.request('HEAD', components.path +
+                     ('?%s' % components.query if components.query else ''),
+                     headers=headers)
+        response = conn.getresponse()
+        if response.status != 200:
+            return None
+
+        version = response.getheader('ETag') or response.getheader('Last-Modified')
+        if version is None:
+            return None
+
+        return '%s %s' % (version, response.getheader('Content-Length', ''))
+
+    except (IOError, httplib.HTTPException) as error:
+        cherrypy.log('Could not get the version of %s: %s' % (data_location, error))
+        return None
+
+    finally:
+        conn.close()
+
+
 def get_list_info(status_list):
     """
     Get the list of workflows that match the statuses listed
@@ -105,36 +297,71 @@ def get_list_info(status_list):
     :rtype: dict
     """
 
-    indict = {}
-    for workflow in status_list:
-        indict.update(
-            workflowinfo.WorkflowInfo(workflow).get_errors(get_unreported=True)
-            )
+    return merge_errors(sorted(set(status_list)))
 
-    return indict
 
+BATCH_SIZE = 50000
+"""Number of rows inserted per transaction by :py:func:`add_to_database`"""
 
-def add_to_database(curs, data_location): # pylint: disable=too-complex
-    """Add data from a file to a central database through the passed cursor
 
-    :param sqlite3.Cursor curs: is the cursor to the database
-    :param data_location: If a string, this
-         is the location of the file
-         or url of data to add to the database.
-         This should be in JSON format, and if a local file does not exist,
-         a url will be assumed. If the url is invalid,
-         an empty database will be returned.
-         If a list, it's a list of status to get workflows from wmstats.
-    :type data_location: str or list
+def iter_location(data_location):
     """
+    Iterate over the errors at a location.
+    Local files of errors are parsed incrementally with ijson,
+    so the whole file is never held in memory.
+    This is only done when no workflow source is configured,
+    since :py:func:`open_location` otherwise reads lists of workflows
+    from the source instead of the file.
+    Everything else, or everything if ijson is missing,
+    is loaded whole through :py:func:`open_location`.
 
-    indict = get_list_info(data_location) \
-        if isinstance(data_location, list) else \
-        (open_location(data_location) or {})
+    :param str data_location: The location of the file or url
+    :returns: Generator of ``(stepname, errors)`` pairs,
+              where the errors are in the format of the unified all_errors.json
+    :rtype: generator
+    """
 
-    number_added = 0
+    if workflowsources.get_source() is None and os.path.isfile(data_location):
+        if ijson is None:
+            cherrypy.log('ijson is not installed, so %s is loaded whole' % data_location)
+
+        else:
+            with open(data_location, 'rb') as input_file:
+                items = ijson.kvitems(input_file, '')
+                first = next(items, None)
+
+                if first is None:
+                    return
+
+                # Lists of statuses have to be expanded into errors by open_location
+                if not isinstance(first[1], list):
+                    yield first
+                    for item in items:
+                        yield item
+
+                    return
+
+    for item in (open_location(data_location) or {}).items():
+        yield item
 
-    for stepname, errorcodes in indict.items():
+
+def error_rows(items):
+    """
+    Convert errors into rows for the workflows table.
+    LogCollect and Cleanup steps, error codes that are not numbers,
+    and entries with no errors are skipped.
+
+    :param items: Iterable of ``(stepname, errors)`` pairs,
+                  like the output of :py:func:`iter_location`
+    :type items: iterable
+    :returns: Generator of tuples matching the columns made by :py:func:`create_table`
+    :rtype: generator
+    """
+
+    # Each site is only looked up once
+    readiness = {}
+
+    for stepname, errorcodes in items:
         if 'LogCollect' in stepname or 'Cleanup' in stepname:
             continue
 
@@ -146,22 +373,91 @@ def add_to_database(curs, data_location): # pylint: disable=too-complex
                 continue
 
             for sitename, numbererrors in sitenames.items():
-                numbererrors = numbererrors or int(errorcode == '-1')
+                numbererrors = int(numbererrors or int(errorcode == '-1'))
 
                 if numbererrors:
-                    full_key = '_'.join([stepname, sitename, errorcode])
-                    if not list(curs.execute(
-                            'SELECT EXISTS(SELECT 1 FROM workflows WHERE fullkey=? LIMIT 1)',
-                            (full_key,)))[0][0]:
-                        number_added += 1
-                        curs.execute('INSERT INTO workflows VALUES (?,?,?,?,?,?)',
-                                     (full_key, stepname, errorcode,
-                                      sitename, numbererrors,
-                                      sitereadiness.site_readiness(sitename)))
-
-    # This is to prevent the ErrorInfo objects from locking the database
-    if 'conn' in dir(curs):
-        curs.conn.commit()
+                    if sitename not in readiness:
+                        readiness[sitename] = sitereadiness.site_readiness(sitename)
+
+                    yield ('_'.join([stepname, sitename, errorcode]), stepname, errorcode,
+                           sitename, numbererrors, readiness[sitename])
+
+
+def insert_rows(curs, rows, batch_size=BATCH_SIZE, table='workflows', after_batch=None):
+    """
+    Insert rows into the workflows table, in one transaction per batch.
+    Rows with a fullkey that is already in the table are ignored.
+
+    :param sqlite3.Cursor curs: is the cursor to the database
+    :param rows: Iterable of rows, like the output of :py:func:`error_rows`
+    :type rows: iterable
+    :param int batch_size: The number of rows to insert per transaction
+    :param str table: The table to insert into. It must have the columns of the workflows table.
+    :param after_batch: If given, this is called with the cursor after each batch is inserted,
+                        in the same transaction. It returns the number of rows it added,
+                        which is counted instead of the rows inserted into ``table``.
+    :type after_batch: function
+    :returns: The number of rows added
+    :rtype: int
+    """
+
+    conn = curs.connection
+    rows = iter(rows)
+    number_added = 0
+
+    batch = list(islice(rows, batch_size))
+    while batch:
+        # Inserting in order of fullkey keeps the index pages that are touched together
+        batch.sort()
+        before = conn.total_changes
+        curs.executemany('INSERT OR IGNORE INTO %s VALUES (?,?,?,?,?,?)' % table, batch)
+        if after_batch is None:
+            number_added += conn.total_changes - before
+        else:
+            number_added += after_batch(curs)
+        conn.commit()
+
+        batch = list(islice(rows, batch_size))
+
+    return number_added
+
+
+def iter_source(data_location):
+    """
+    :param data_location: The source of errors, as described in :py:func:`add_to_database`
+    :type data_location: str, list, or dict
+    :returns: Iterable of ``(stepname, errors)`` pairs
+    """
+
+    if isinstance(data_location, dict):
+        return data_location.items()
+    if isinstance(data_location, list):
+        return get_list_info(data_location).items()
+
+    return iter_location(data_location)
+
+
+def add_to_database(curs, data_location, batch_size=BATCH_SIZE):
+    """Add data from a file to a central database through the passed cursor.
+    Errors are streamed into the database, and each batch is committed
+    through the connection of the cursor by :py:func:`insert_rows`.
+    Callers do not need to commit, but any transaction they have open
+    on that connection is committed too.
+
+    :param sqlite3.Cursor curs: is the cursor to the database
+    :param data_location: If a string, this
+         is the location of the file
+         or url of data to add to the database.
+         This should be in JSON format, and if a local file does not exist,
+         a url will be assumed. If the url is invalid,
+         an empty database will be returned.
+         If a list, it's a list of status to get workflows from wmstats.
+         If a dict, it is the errors already loaded from one of these sources.
+    :type data_location: str, list, or dict
+    :param int batch_size: The number of rows to insert per transaction
+    """
+
+    number_added = insert_rows(curs, error_rows(iter_source(data_location)), batch_size)
 
     if number_added:
         cherrypy.log('Number of points added to the database: %i' % number_added)
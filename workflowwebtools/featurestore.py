@@ -0,0 +1,238 @@
+"""
+An append-only store of the training data for :py:mod:`paramsregression`
+and the models in :py:mod:`predict`.
+
+When Unified reports that workflows were acted on through
+:py:meth:`WorkflowTools.reportaction`, one row is added for each subtask of those workflows.
+Each row holds the sparse good sites and bad sites matrices of the subtask,
+taken from the workflow history, and the parameters of the action as labels.
+These are the same as the entries made by :py:func:`actionshistorylink.dump_json`,
+but they are only built once, instead of from the whole history and every action
+each time a model is trained.
+
+Rows are never changed, so training can read only the rows added in a time range.
+Workflows that were acted on before the store existed are added by :py:func:`backfill`,
+which :py:meth:`WorkflowTools.actionshistory` runs before giving the training data.
+The store is ``<workspace>/featurestore.db``.
+"""
+
+import os
+import json
+import time
+import sqlite3
+
+from . import serverconfig
+from . import manageactions
+from . import actionshistorylink
+
+
+READINESS = {
+    'good_sites': ['green'],
+    'bad_sites': ['yellow', 'red', 'none']
+    }
+"""The site readiness statuses of the errors in each matrix"""
+
+
+def store_path():
+    """
+    :returns: The location of the feature store in the workspace
+    :rtype: str
+    """
+
+    return os.path.join(serverconfig.config_dict()['workspace'], 'featurestore.db')
+
+
+def connect(path=None):
+    """
+    Open the feature store, creating it if needed
+
+    :param str path: Location of the store. Defaults to :py:func:`store_path`.
+    :returns: A connection to the store
+    :rtype: sqlite3.Connection
+    """
+
+    conn = sqlite3.connect(path or store_path(), timeout=30)
+    conn.execute('CREATE TABLE IF NOT EXISTS features ('
+                 'added int, workflow varchar(255), subtask varchar(255), '
+                 'good_sites text, bad_sites text, parameters text)')
+    conn.execute('CREATE INDEX IF NOT EXISTS added_index ON features (added)')
+
+    return conn
+
+
+def subtask_errors(history_path, workflow):
+    """
+    Get the sparse error matrices of each subtask of a workflow from the history database
+
+    :param str history_path: Location of the workflow history database
+    :param str workflow: The workflow
+    :returns: Dictionary with the keys 'good_sites' and 'bad_sites' for each subtask.
+              Each is a matrix like the output of :py:func:`globalerrors.get_step_table`
+              with ``sparse=True``.
+    :rtype: dict
+    """
+
+    output = {}
+
+    if not (history_path.endswith('.db') and os.path.isfile(history_path)):
+        return output
+
+    conn = sqlite3.connect(history_path)
+    try:
+        # All steps of a workflow are between these in the stepname index
+        rows = conn.execute(
+            'SELECT stepname, errorcode, sitename, numbererrors, sitereadiness FROM workflows '
+            'WHERE stepname >= ? AND stepname < ?', ('/%s/' % workflow, '/%s0' % workflow))
+
+        for stepname, errorcode, sitename, numbererrors, readiness in rows:
+            errors = output.setdefault(stepname, {key: {} for key in READINESS})
+            for key, statuses in READINESS.items():
+                if readiness in statuses:
+                    errors[key].setdefault(str(errorcode), {})[sitename] = numbererrors
+    finally:
+        conn.close()
+
+    return output
+
+
+def add_workflows(workflows, actions=None, history_path=None, added=None, path=None):
+    """
+    Add a row for each subtask of workflows that were acted on
+
+    :param list workflows: The workflows
+    :param dict actions: The action document of each workflow.
+                         Defaults to the actions stored in the database.
+    :param str history_path: Location of the workflow history database.
+                             Defaults to the one in the server configuration.
+    :param int added: The time to store the rows with. Defaults to now.
+    :param str path: Location of the store. Defaults to :py:func:`store_path`.
+    :returns: The number of rows added
+    :rtype: int
+    """
+
+    if not workflows:
+        return 0
+
+    if actions is None:
+        actions = {
+            match['workflow']: match['parameters'] for match in
+            manageactions.get_actions_collection().find({'workflow': {'$in': list(workflows)}})
+        }
+
+    history_path = history_path or serverconfig.workflow_history_path()
+    added = int(time.time()) if added is None else added
+
+    rows = []
+    for workflow in workflows:
+        if workflow not in actions:
+            continue
+
+        for subtask, errors in sorted(subtask_errors(history_path, workflow).items()):
+            rows.append((added, workflow, subtask,
+                         json.dumps(errors['good_sites']), json.dumps(errors['bad_sites']),
+                         json.dumps(actionshistorylink.subtask_parameters(
+                             actions[workflow], subtask))))
+
+    conn = connect(path)
+    try:
+        with conn:
+            conn.executemany('INSERT INTO features VALUES (?, ?, ?, ?, ?, ?)', rows)
+    finally:
+        conn.close()
+
+    return len(rows)
+
+
+def backfill(history_path=None, path=None):
+    """
+    Add rows for the workflows with actions that are not in the store yet.
+    The rows are stored with the time of the action.
+
+    :param str history_path: Location of the workflow history database.
+                             Defaults to the one in the server configuration.
+    :param str path: Location of the store. Defaults to :py:func:`store_path`.
+    :returns: The number of rows added
+    :rtype: int
+    """
+
+    conn = connect(path)
+    try:
+        stored = {workflow for workflow, in conn.execute('SELECT DISTINCT workflow FROM features')}
+    finally:
+        conn.close()
+
+    # Actions reported together have the same timestamp
+    missing = {}
+    for match in manageactions.get_actions_collection().find():
+        if match['workflow'] not in stored:
+            missing.setdefault(match.get('timestamp', 0), {})[match['workflow']] = \
+                match['parameters']
+
+    return sum(add_workflows(sorted(actions), actions, history_path, added, path)
+               for added, actions in sorted(missing.items()))
+
+
+def read(start=None, end=None, path=None):
+    """
+    Read the rows of the store, oldest first, without loading them all at once
+
+    :param int start: Only read rows added at or after this time, if set
+    :param int end: Only read rows added before this time, if set
+    :param str path: Location of the store. Defaults to :py:func:`store_path`.
+    :returns: Generator of the subtask and its entry, which is like an entry of
+              :py:func:`actionshistorylink.dump_json` with the time it was added under 'added'
+    :rtype: generator
+    """
+
+    query = 'SELECT added, subtask, good_sites, bad_sites, parameters FROM features'
+    conditions = []
+    params = []
+
+    if start is not None:
+        conditions.append('added >= ?')
+        params.append(start)
+    if end is not None:
+        conditions.append('added < ?')
+        params.append(end)
+    if conditions:
+        query += ' WHERE ' + ' AND '.join(conditions)
+
+    conn = connect(path)
+    try:
+        for added, subtask, good_sites, bad_sites, parameters in \
+                conn.execute(query + ' ORDER BY added, rowid', params):
+            yield subtask, {
+                'errors': {
+                    'good_sites': json.loads(good_sites),
+                    'bad_sites': json.loads(bad_sites)
+                    },
+                'parameters': json.loads(parameters),
+                'added': added
+                }
+    finally:
+        conn.close()
+
+
+def dump_json(file_name=None, start=None, end=None, path=None):
+    """
+    Get the training data in the same form as :py:func:`actionshistorylink.dump_json`.
+    If a subtask was added more than once, its latest row is used.
+
+    :param str file_name: The location to place the json file, if set
+    :param int start: Only use rows added at or after this time, if set
+    :param int end: Only use rows added before this time, if set
+    :param str path: Location of the store. Defaults to :py:func:`store_path`.
+    :returns: The errors and actions for each subtask
+    :rtype: dict
+    """
+
+    output = {}
+    for subtask, entry in read(start, end, path):
+        entry.pop('added')
+        output[subtask] = entry
+
+    if file_name:
+        with open(file_name, 'w') as output_file:
+            json.dump(output, output_file)
+
+    return output
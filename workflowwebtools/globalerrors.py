@@ -12,6 +12,11 @@ import time
 import threading
 
 from collections import defaultdict
+try:
+    from types import MappingProxyType
+except ImportError:
+    # Python 2 does not have read-only dictionaries
+    MappingProxyType = dict
 
 import cherrypy
 
@@ -19,48 +24,160 @@ from cmstoolbox import sitereadiness
 
 from . import workflowinfo
 from . import errorutils
+from . import snapshots
+from . import historydb
 from . import serverconfig
+from . import lockstats
 from .reasonsmanip import reasons_list
 
+class ThreadReaders(object):
+    """
+    The read-only connections to the database of an :py:class:`ErrorInfo`.
+    Each thread reads through its own connection, so queries do not wait for each other.
+    """
+
+    def __init__(self, window=None):
+        """
+        :param int window: If set, only read the errors added in this many days
+        """
+
+        self.window = window
+        # The database to open, or None if it was closed
+        self.db_path = None
+        # Each thread's connection and the generation it was opened for
+        self.local = threading.local()
+        # Incremented whenever the database is replaced or closed
+        self.generation = 0
+        # All open connections, so that they can be closed when the ErrorInfo is deleted
+        self.connections = []
+        self.lock = threading.Lock()
+
+    def replace(self, db_path):
+        """
+        Make each thread open a new connection on its next query.
+        Connections in use by other threads are closed by those threads.
+
+        :param str db_path: The new database, or None if it was closed
+        """
+
+        # The path is set first, so a thread that sees the new generation opens the new path
+        self.db_path = db_path
+        self.generation += 1
+
+    def get(self):
+        """
+        Get the connection of the current thread.
+        If the database was replaced since the connection was opened,
+        the old connection is closed and a new one is opened.
+
+        :returns: Connection to the current database
+        :rtype: sqlite3.Connection
+        :raises sqlite3.ProgrammingError: if the database was closed
+        """
+
+        conn = getattr(self.local, 'conn', None)
+        generation = self.generation
+        db_path = self.db_path
+
+        if conn is not None and self.local.generation != generation:
+            self.close(conn)
+            conn = None
+
+        if conn is None:
+            if db_path is None:
+                raise sqlite3.ProgrammingError('The database was closed by teardown()')
+            conn = snapshots.connect(db_path)
+            if self.window:
+                historydb.select_window(conn, time.time() - 86400 * self.window)
+            conn.execute('PRAGMA query_only=1')
+            with self.lock:
+                self.connections.append(conn)
+            self.local.conn = conn
+            self.local.generation = generation
+
+        return conn
+
+    def close(self, conn):
+        """
+        :param sqlite3.Connection conn: Connection to close and forget
+        """
+
+        with self.lock:
+            if conn in self.connections:
+                self.connections.remove(conn)
+
+        conn.close()
+
+    def close_current(self):
+        """Close the connection of the current thread, if it has one"""
+
+        conn = getattr(self.local, 'conn', None)
+        if conn is not None:
+            self.local.conn = None
+            self.close(conn)
+
+    def close_all(self):
+        """Close every connection. No other thread can be using them anymore."""
+
+        with self.lock:
+            connections = self.connections
+            self.connections = []
+
+        for conn in connections:
+            conn.close()
+
+
 class ErrorInfo(object):
     """Holds the information for any errors for a session"""
 
-    def __init__(self, data_location=''):
+    def __init__(self, data_location='', window=None):
         """Initialization with a setup.
         :param str data_location: Set the location of the data to read in the info
+        :param int window: If reading the workflow history, only use the errors
+                           added in this many days. See :py:mod:`historydb`.
         """
 
         self.data_location = data_location
+        self.window = window
 
         # These are setup by setup()
         self.timestamp = None
+        self.db_path = None
+        # The writer connection, which is only used while holding db_lock
         self.conn = None
         self.curs = None
-        self.db_lock = threading.Lock()
+        self.db_lock = lockstats.InstrumentedLock('ErrorInfo.db_lock')
+        # Each thread reads through its own connection
+        self.readers = ThreadReaders(window)
+        # Protects the caches below, which are shared by concurrent requests
+        self.cache_lock = lockstats.InstrumentedLock('ErrorInfo.cache_lock')
         # These are setup by set_all_lists(), which is called in setup()
         self.info = None
         self.allsteps = None
         self.readiness = None
-        # This is created in clusterworkflows.get_workflow_groups()
-        self.clusters = {}
+        # These are read-only indexes, set by set_indexes()
+        self.workflow_list = ()
+        self.workflow_set = frozenset()
+        self.step_lists = MappingProxyType({})
+        self.prepid_workflows = MappingProxyType({})
         # These are set in get_workflow()
         self.workflowinfos = {}
         # These are set in get_prepid()
         self.prepidinfos = {}
         # Filled by _get_step_tables
         self._step_tables = None
-        # Filled by get_step_list
-        self._step_list = None
 
         self.setup()
 
     def __del__(self):
         """Delete anything left over."""
         self.teardown()
+        self.readers.close_all()
 
     def execute(self, query, params=None):
         """
-        Locks the internal database and makes the query.
+        Makes a read-only query through the connection of the current thread.
+        Queries from different threads do not wait for each other.
 
         :param str query: The query, which can include '?'
         :param tuple params: The parameters to pass into the query
@@ -68,25 +185,43 @@ class ErrorInfo(object):
         :rtype: list
         """
 
-        output = []
+        curs = self.readers.get().cursor()
+        if params:
+            curs.execute(query, params)
+        else:
+            curs.execute(query)
 
-        self.db_lock.acquire()
-        curs = self.conn.cursor()
-        try:
-            if params:
-                curs.execute(query, params)
-            else:
-                curs.execute(query)
+        return list(curs.fetchall())
 
-            output = list(curs.fetchall())
-        finally:
-            self.db_lock.release()
+    def add_errors(self, data_location):
+        """
+        Adds errors to the database through the writer connection,
+        then updates the lists of steps, sites, and errors.
 
-        return output
+        :param data_location: Passed to :py:func:`errorutils.add_to_database`
+        :type data_location: str, list, or dict
+        """
+
+        with self.db_lock:
+            if historydb.is_history(self.curs):
+                historydb.add_to_history(self.curs, data_location)
+            else:
+                errorutils.add_to_database(self.curs, data_location)
+
+        self.set_all_lists()
 
 
     def setup(self):
-        """Create an SQL database from the all_errors.json generated by production"""
+        """
+        Open an SQL database of the all_errors.json generated by production.
+        The database is built as a snapshot in the workspace,
+        which is reused while the source does not change.
+        See :py:mod:`snapshots` for details.
+
+        This can also be called on an ErrorInfo that is already open.
+        Queries running in other threads finish on the old database,
+        and each thread switches to the new database on its next query.
+        """
 
         self.timestamp = time.time()
 
@@ -99,44 +234,97 @@ class ErrorInfo(object):
 
         if isinstance(data_location, str) and data_location.endswith('.db') \
                 and os.path.exists(data_location):
-            self.conn = sqlite3.connect(data_location, check_same_thread=False)
-            curs = self.conn.cursor()
-            self.curs = curs
+            db_path = data_location
+            if self.window is not None or os.path.abspath(db_path) == \
+                    os.path.abspath(serverconfig.workflow_history_path()):
+                # Converts a history made before it was split by month,
+                # so that the window can be applied
+                conn = historydb.connect(db_path)
+            else:
+                conn = sqlite3.connect(db_path, check_same_thread=False)
+                # Let readers continue while the database is written to
+                conn.execute('PRAGMA journal_mode=WAL')
 
         else:
-            self.conn = sqlite3.connect(':memory:', check_same_thread=False)
-            curs = self.conn.cursor()
-            self.curs = curs
-
-            errorutils.create_table(self)
-            errorutils.add_to_database(self, data_location)
+            # The errors of the other workflows in the PrepIDs are not part of the source
+            db_path = snapshots.get_snapshot(
+                data_location, self._build_snapshot,
+                None if self.data_location else int(snapshots.get_settings()['max_age']))
+            conn = snapshots.connect(db_path, read_only=False)
+
+        # Other sessions do not prune a snapshot while this one uses it
+        snapshots.hold(db_path)
+
+        with self.db_lock:
+            old_conn = self.conn
+            old_path = self.db_path
+            self.conn = conn
+            self.curs = conn.cursor()
+            self.db_path = db_path
+            self.readers.replace(db_path)
+
+        if old_conn is not None:
+            old_conn.close()
+        if old_path is not None:
+            snapshots.release(old_path)
 
+        self._step_tables = None
 
         self.set_all_lists()
+
+        # If all ACDCs are to be shown, include the ones with zero errors like this
+        if not self.data_location and serverconfig.config_dict().get('include_all_acdcs') and \
+                self.execute("SELECT name FROM sqlite_master "
+                             "WHERE type='table' and name='prepids'"):
+            current_workflows = self.workflow_set
+            self.allsteps.extend(['/%s/' % zero for zero, in \
+                                      self.execute('SELECT DISTINCT workflow FROM prepids') \
+                                      if zero not in current_workflows])
+            self.allsteps.sort()
+            self.set_indexes()
+
         self.readiness = [sitereadiness.site_readiness(site) for site in self.info[3]]
 
-        if not self.data_location:
-            current_workflows = self.return_workflows()
+        self.connection_log('opened')
+
+    def _build_snapshot(self, conn, contents):
+        """
+        Fills a new snapshot database.
+        If this ErrorInfo is for the current errors, the other workflows
+        sharing PrepIDs with the current workflows are also added,
+        and the PrepIDs are stored in the ``prepids`` table.
 
-            prep_ids = {self.get_workflow(wf).get_prep_id() for wf in current_workflows}
+        :param sqlite3.Connection conn: Connection to the new snapshot
+        :param contents: Data to pass to :py:func:`errorutils.add_to_database`
+        """
 
-            other_workflows = sum([self.get_prepid(prep_id).get_workflows() \
-                                       for prep_id in prep_ids], [])
+        # This does not touch the open database, which other threads might be reading
+        snapshots.build_errors(conn, contents)
+        curs = conn.cursor()
 
-            errorutils.add_to_database(self, [new for new in other_workflows \
-                                                  if new not in current_workflows])
-            self.set_all_lists()
-            current_workflows = self.return_workflows()
+        if not self.data_location:
+            current_workflows = {step.split('/')[1] for step, in \
+                                     curs.execute('SELECT DISTINCT stepname FROM workflows')}
 
-            # If all ACDCs are to be shown, include the ones with zero errors like this
-            if serverconfig.config_dict().get('include_all_acdcs'):
-                self.allsteps.extend(['/%s/' % zero for zero in other_workflows \
-                                          if zero not in current_workflows])
-                self.allsteps.sort()
+            # Each PrepID is only listed once, even when several workflows share it
+            prep_ids = sorted(set(errorutils.thread_map(
+                lambda workflow: self.get_workflow(workflow).get_prep_id(),
+                sorted(current_workflows), 'Resolving PrepIDs')))
+            prep_workflows = errorutils.thread_map(
+                lambda prep_id: self.get_prepid(prep_id).get_workflows(),
+                prep_ids, 'Listing PrepID workflows')
 
-            self.readiness = [sitereadiness.site_readiness(site) for site in self.info[3]]
+            curs.execute('CREATE TABLE prepids (prepid varchar(255), workflow varchar(255))')
+            other_workflows = set()
+            for prep_id, workflows in zip(prep_ids, prep_workflows):
+                curs.executemany('INSERT INTO prepids VALUES (?,?)',
+                                 [(prep_id, workflow) for workflow in workflows])
+                other_workflows.update(workflows)
 
-        self.connection_log('opened')
+            cherrypy.log('%i workflows in %i PrepIDs from %i current workflows' %
+                         (len(other_workflows), len(prep_ids), len(current_workflows)))
+
+            errorutils.add_to_database(curs, sorted(other_workflows - current_workflows))
 
     def set_all_lists(self):
         """
@@ -179,16 +367,65 @@ class ErrorInfo(object):
 
         self.allsteps = allsteps
 
+        self.set_indexes()
+
+    def set_indexes(self):
+        """
+        Builds the indexes of workflows, their steps, and PrepIDs from :py:attr:`allsteps`
+        and the ``prepids`` table of the snapshot, if it exists.
+        The indexes are only replaced once they are complete,
+        so they are safe to read from other threads.
+        """
+
+        workflow_list = []
+        step_lists = defaultdict(list)
+
+        for step in self.allsteps:
+            workflow = step.split('/')[1]
+            if not workflow_list or workflow_list[-1] != workflow:
+                workflow_list.append(workflow)
+            # Zero error ACDCs are added without a step
+            if step != '/%s/' % workflow:
+                step_lists[workflow].append(step)
+
+        prepid_workflows = defaultdict(list)
+        if self.execute("SELECT name FROM sqlite_master WHERE type='table' and name='prepids'"):
+            for prep_id, workflow in self.execute('SELECT prepid, workflow FROM prepids'):
+                prepid_workflows[prep_id].append(workflow)
+
+        self.workflow_list = tuple(workflow_list)
+        self.workflow_set = frozenset(workflow_list)
+        self.step_lists = MappingProxyType(
+            {workflow: tuple(steps) for workflow, steps in step_lists.items()})
+        self.prepid_workflows = MappingProxyType(
+            {prep_id: tuple(workflows) for prep_id, workflows in prepid_workflows.items()})
+
     def teardown(self):
-        """Close the database when cache expires"""
+        """
+        Close the database.
+        Only the reader connection of this thread is closed here.
+        Other threads may still be in the middle of a query,
+        so they close their own readers the next time they query,
+        just like after :py:meth:`setup` opens a new database.
+        Those queries raise an error until :py:meth:`setup` is called again.
+        """
         self._step_tables = None
-        self._step_list = None
 
-        self.conn.close()
-        self.connection_log('closed')
+        with self.db_lock:
+            if self.conn is not None:
+                self.conn.close()
+                self.conn = None
+                self.curs = None
+            old_path = self.db_path
+            self.db_path = None
+            self.readers.replace(None)
 
-        if self.clusters:
-            self.clusters = {}
+        if old_path is not None:
+            snapshots.release(old_path)
+
+        self.readers.close_current()
+
+        self.connection_log('closed')
 
     def connection_log(self, action):
         """Logs actions on the sqlite3 connection
@@ -213,20 +450,20 @@ class ErrorInfo(object):
 
     def return_workflows(self):
         """
-        :returns: the ordered list of all workflow prep IDs that need attention
-        :rtype: list
+        :returns: the ordered workflows that need attention
+        :rtype: tuple
         """
-        wfs = list()
 
-        last = ''
+        return self.workflow_list
 
-        for step in self.allsteps:
-            val = step.split('/')[1]
-            if val != last:
-                wfs.append(val)
-                last = val
+    def has_workflow(self, workflow):
+        """
+        :param str workflow: The workflow to check
+        :returns: If the workflow is in this ErrorInfo
+        :rtype: bool
+        """
 
-        return wfs
+        return workflow in self.workflow_set
 
     def get_workflow(self, workflow):
         """
@@ -237,10 +474,11 @@ class ErrorInfo(object):
         :returns: Cached WorkflowInfo from the ToolBox.
         :rtype: WorkflowWebTools.workflowinfo.WorkflowInfo
         """
-        if not self.workflowinfos.get(workflow):
-            self.workflowinfos[workflow] = workflowinfo.WorkflowInfo(workflow)
+        with self.cache_lock:
+            if not self.workflowinfos.get(workflow):
+                self.workflowinfos[workflow] = workflowinfo.WorkflowInfo(workflow)
 
-        return self.workflowinfos[workflow]
+            return self.workflowinfos[workflow]
 
     def get_prepid(self, prep_id):
         """
@@ -248,10 +486,11 @@ class ErrorInfo(object):
         :returns: Either cached PrepIDInfo, or a new one
         :rtype: WorkflowWebTools.workflowinfo.PrepIDInfo
         """
-        if not self.prepidinfos.get(prep_id):
-            self.prepidinfos[prep_id] = workflowinfo.PrepIDInfo(prep_id)
+        with self.cache_lock:
+            if not self.prepidinfos.get(prep_id):
+                self.prepidinfos[prep_id] = workflowinfo.PrepIDInfo(prep_id)
 
-        return self.prepidinfos[prep_id]
+            return self.prepidinfos[prep_id]
 
     def get_step_list(self, workflow):
         """Gets the list of steps within a workflow
@@ -261,24 +500,33 @@ class ErrorInfo(object):
         :rtype: list
         """
 
-        if self._step_list is None:
-            self._step_list = defaultdict(list)
-            cherrypy.log('Getting db_lock: 2')
-            self.db_lock.acquire()
-            self.curs.execute('SELECT DISTINCT(stepname) FROM workflows ORDER BY stepname')
-            for tup in self.curs.fetchall():
-                stepname = tup[0]
-                self._step_list[stepname.split('/')[1]].append(stepname)
-            cherrypy.log('Releasing db_lock: 2')
-            self.db_lock.release()
+        return list(self.step_lists.get(workflow, ()))
+
+    def get_prepid_workflows(self, prep_id):
+        """
+        :param str prep_id: The PrepID to get the workflows of
+        :returns: The workflows in the PrepID.
+                  This is read from the snapshot when possible,
+                  and otherwise from the cached PrepIDInfo.
+        :rtype: list
+        """
+
+        workflows = self.prepid_workflows.get(prep_id)
+        if workflows is not None:
+            return list(workflows)
 
-        return self._step_list[workflow]
+        return self.get_prepid(prep_id).get_workflows()
 
     def _get_step_tables(self):
-        """Sets the internal step tables for fast fetching"""
+        """
+        Sets the internal step tables for fast fetching
+
+        :returns: The new step tables
+        :rtype: dict
+        """
 
         # The keys are stepname, then sitereadiness
-        self._step_tables = defaultdict(lambda: defaultdict(list))
+        step_tables = defaultdict(lambda: defaultdict(list))
 
         for step, ready, errors, site, code in self.execute(
                 """
@@ -286,9 +534,14 @@ class ErrorInfo(object):
                 ORDER BY errorcode ASC, sitename ASC
                 """):
             # Append everything to 'all' to keep the order
-            self._step_tables[step]['all'].append((errors, site, code))
+            step_tables[step]['all'].append((errors, site, code))
             # Order is not as important when we are getting sparse for different readiness
-            self._step_tables[step][ready].append((errors, site, code))
+            step_tables[step][ready].append((errors, site, code))
+
+        # Only publish the tables once they are full, for other threads
+        self._step_tables = step_tables
+
+        return step_tables
 
     def get_step_table(self, step, readymatch=None):
         """
@@ -303,21 +556,25 @@ class ErrorInfo(object):
         :rtype: list of tuples
         """
 
-        if self._step_tables is None:
+        step_tables = self._step_tables
+
+        if step_tables is None:
             cherrypy.log('Setting up step tables')
-            self._get_step_tables()
+            step_tables = self._get_step_tables()
 
         keys = readymatch or ['all']
 
+        tables = step_tables.get(step, {})
+
         output = []
         for key in keys:
-            output.extend(self._step_tables[step][key])
+            output.extend(tables.get(key, []))
 
         return output
 
 
 GLOBAL_INFO = None
-GLOBAL_LOCK = threading.Lock()
+GLOBAL_LOCK = lockstats.InstrumentedLock('GLOBAL_LOCK')
 
 
 def check_session(session, can_refresh=False):
@@ -331,14 +588,11 @@ def check_session(session, can_refresh=False):
     """
 
     if session:
-        cherrypy.log('Getting global lock: 1')
         GLOBAL_LOCK.acquire()
         if session.get('lock') is None:
-            session['lock'] = threading.Lock()
-        cherrypy.log('Releasing global lock: 1')
+            session['lock'] = lockstats.InstrumentedLock('session')
         GLOBAL_LOCK.release()
 
-        cherrypy.log('Getting session lock')
         session['lock'].acquire()
 
         if session.get('info') is None:
@@ -346,24 +600,23 @@ def check_session(session, can_refresh=False):
         theinfo = session.get('info')
 
     else:
-        cherrypy.log('Getting global lock: 2')
         GLOBAL_LOCK.acquire()
         global GLOBAL_INFO
         if GLOBAL_INFO is None:
             GLOBAL_INFO = ErrorInfo()
 
         theinfo = GLOBAL_INFO
-        cherrypy.log('Releasing global lock: 2')
         GLOBAL_LOCK.release()
 
-    # If session ErrorInfo is old, set up another connection
-    if can_refresh and theinfo.timestamp < time.time() - \
-            60*serverconfig.config_dict()['refresh_period']:
-        theinfo.teardown()
+    # If session ErrorInfo is old, or its snapshot was removed by another process,
+    # switch to the latest database.
+    # Connections still in use by other threads are not closed.
+    if can_refresh and (
+            theinfo.timestamp < time.time() - 60*serverconfig.config_dict()['refresh_period'] or
+            (theinfo.db_path is not None and not os.path.exists(theinfo.db_path))):
         theinfo.setup()
 
     if session:
-        cherrypy.log('Releasing session lock')
         session['lock'].release()
 
     return theinfo
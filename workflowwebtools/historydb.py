@@ -0,0 +1,455 @@
+"""
+Manages the workflow history database, which is filled by ``wfwt-update-history``
+and used for clustering and training.
+
+The errors in the history are split into one table per month,
+named ``workflows_YYYYMM`` after the month (in UTC) that they were added.
+Each row also has an ``ingested`` column with the time it was added.
+The ``workflows`` view joins all of the months,
+so the history can be read like any other error database.
+The ``history_keys`` table holds every ``fullkey`` in the history and its month,
+so that an error is never added twice, even to different months.
+
+History databases made before the split are converted when they are opened
+by :py:func:`connect`.
+All of their rows are put in the month that the file was last modified.
+
+To bound the time it takes to read the history,
+:py:class:`globalerrors.ErrorInfo` can be given a window of days.
+Each of its connections then gets a temporary ``workflows`` view
+that only includes the months and rows that are in the window.
+Old months can be dropped with ``wfwt-compact-history``, which uses :py:func:`compact`.
+
+Sources can also be added with :py:func:`update_checkpointed`,
+which records a hash of each source and of the errors of each of its workflows.
+Sources that have not changed since the last update are skipped without being read,
+and only the workflows that changed are added from the others.
+"""
+
+import os
+import json
+import time
+import sqlite3
+import hashlib
+from collections import defaultdict
+
+import cherrypy
+
+from . import errorutils
+
+
+PREFIX = 'workflows_'
+"""The start of the name of each monthly table"""
+
+COLUMNS = 'fullkey, stepname, errorcode, sitename, numbererrors, sitereadiness, ingested'
+"""The columns of each monthly table and the ``workflows`` view"""
+
+
+def partition_name(timestamp):
+    """
+    :param float timestamp: A unix timestamp
+    :returns: The name of the table for the month of the timestamp
+    :rtype: str
+    """
+    return PREFIX + time.strftime('%Y%m', time.gmtime(timestamp))
+
+
+def list_partitions(curs):
+    """
+    :param sqlite3.Cursor curs: Cursor to the history database
+    :returns: The names of the monthly tables, from oldest to newest
+    :rtype: list
+    """
+
+    return sorted(name for name, in curs.execute(
+        "SELECT name FROM main.sqlite_master WHERE type='table' AND "
+        "name GLOB '%s[0-9][0-9][0-9][0-9][0-9][0-9]'" % PREFIX))
+
+
+def is_history(curs):
+    """
+    :param sqlite3.Cursor curs: Cursor to a database
+    :returns: If the database is split by month
+    :rtype: bool
+    """
+
+    return bool(list(curs.execute(
+        "SELECT name FROM main.sqlite_master WHERE type='table' AND name='history_keys'")))
+
+
+def _view_query(partitions, since=None):
+    """
+    :param list partitions: The tables to include in the view
+    :param int since: If set, only rows ingested after this time are included
+    :returns: The query that the view is made of
+    :rtype: str
+    """
+
+    where = ' WHERE ingested >= %i' % since if since else ''
+
+    return ' UNION ALL '.join(
+        'SELECT %s FROM main.%s%s' % (COLUMNS, partition, where) for partition in partitions)
+
+
+def create_partition(curs, name):
+    """
+    Create a monthly table and update the ``workflows`` view to include it
+
+    :param sqlite3.Cursor curs: Cursor to the history database
+    :param str name: Name of the table, from :py:func:`partition_name`
+    """
+
+    curs.execute('CREATE TABLE IF NOT EXISTS {0} (fullkey varchar(1023), '
+                 'stepname varchar(255), errorcode int, '
+                 'sitename varchar(255), numbererrors int, '
+                 'sitereadiness varchar(15), ingested int)'.format(name))
+    curs.execute('CREATE INDEX IF NOT EXISTS {0}_index '
+                 'ON {0} (stepname, errorcode, sitename)'.format(name))
+
+    update_view(curs)
+
+
+def update_view(curs):
+    """
+    Recreate the ``workflows`` view from the current monthly tables
+
+    :param sqlite3.Cursor curs: Cursor to the history database
+    """
+
+    partitions = list_partitions(curs)
+    if not partitions:
+        create_partition(curs, partition_name(time.time()))
+        return
+
+    curs.execute('DROP VIEW IF EXISTS main.workflows')
+    curs.execute('CREATE VIEW main.workflows AS %s' % _view_query(partitions))
+
+
+def setup_schema(curs, legacy_time=None):
+    """
+    Create the tables of the history database if needed.
+    An unsplit ``workflows`` table is moved into a monthly table.
+
+    :param sqlite3.Cursor curs: Cursor to the history database
+    :param float legacy_time: Time to give the rows in an old ``workflows`` table.
+                              Defaults to now.
+    """
+
+    if is_history(curs):
+        setup_ingests(curs)
+        return
+
+    curs.execute('CREATE TABLE history_keys (fullkey varchar(1023) PRIMARY KEY, '
+                 'month varchar(15))')
+
+    if list(curs.execute("SELECT name FROM main.sqlite_master "
+                         "WHERE type='table' AND name='workflows'")):
+        legacy_time = int(legacy_time or time.time())
+        name = partition_name(legacy_time)
+
+        cherrypy.log('Moving the workflow history into %s' % name)
+
+        curs.execute('ALTER TABLE workflows RENAME TO %s' % name)
+        curs.execute('ALTER TABLE %s ADD COLUMN ingested int DEFAULT %i' % (name, legacy_time))
+        curs.execute('INSERT OR IGNORE INTO history_keys SELECT fullkey, ? FROM %s' % name,
+                     (name,))
+
+    update_view(curs)
+    setup_ingests(curs)
+
+
+def _has_ingests(curs):
+    """
+    :param sqlite3.Cursor curs: Cursor to the history database
+    :returns: If the database has the ``history_ingests`` table
+    :rtype: bool
+    """
+
+    return bool(list(curs.execute(
+        "SELECT name FROM main.sqlite_master WHERE type='table' AND name='history_ingests'")))
+
+
+def setup_ingests(curs):
+    """
+    Create the table that holds the time the newest rows were added to each month,
+    so that it does not have to be found from every monthly table.
+    A history made before this table existed is filled in from the monthly tables.
+
+    :param sqlite3.Cursor curs: Cursor to the history database
+    """
+
+    if _has_ingests(curs):
+        return
+
+    curs.execute('CREATE TABLE history_ingests (month varchar(15) PRIMARY KEY, ingested int)')
+
+    for name in list_partitions(curs):
+        newest = curs.execute('SELECT MAX(ingested) FROM main.%s' % name).fetchone()[0]
+        if newest is not None:
+            curs.execute('INSERT INTO history_ingests VALUES (?, ?)', (name, newest))
+
+
+def latest_ingest(curs):
+    """
+    :param sqlite3.Cursor curs: Cursor to the history database
+    :returns: The time the newest rows were added to the history, or None if it is empty
+    :rtype: int
+    """
+
+    if _has_ingests(curs):
+        return curs.execute('SELECT MAX(ingested) FROM main.history_ingests').fetchone()[0]
+
+    # Read-only connections cannot add the table to a history
+    # that has not been opened by :py:func:`connect` since it was added
+    return curs.execute('SELECT MAX(ingested) FROM main.workflows').fetchone()[0]
+
+
+def connect(path):
+    """
+    Open the history database, creating or converting it if needed.
+
+    :param str path: Location of the history database
+    :returns: Connection to the database
+    :rtype: sqlite3.Connection
+    """
+
+    legacy_time = os.path.getmtime(path) if os.path.exists(path) else None
+
+    conn = sqlite3.connect(path, check_same_thread=False)
+    conn.execute('PRAGMA journal_mode=WAL')
+    setup_schema(conn.cursor(), legacy_time)
+    conn.commit()
+
+    return conn
+
+
+def add_rows(curs, rows, ingested=None, batch_size=errorutils.BATCH_SIZE):
+    """
+    Add rows to the history, in one transaction per batch.
+    Rows with a fullkey that is already in any month are ignored.
+
+    :param sqlite3.Cursor curs: Cursor to the history database
+    :param rows: Iterable of rows, like the output of :py:func:`errorutils.error_rows`
+    :type rows: iterable
+    :param float ingested: The time to store with the rows. Defaults to now.
+    :param int batch_size: The number of rows to insert per transaction
+    :returns: The number of rows added
+    :rtype: int
+    """
+
+    conn = curs.connection
+    ingested = int(ingested or time.time())
+    partition = partition_name(ingested)
+
+    if partition not in list_partitions(curs):
+        create_partition(curs, partition)
+        conn.commit()
+
+    curs.execute('CREATE TEMP TABLE IF NOT EXISTS history_staging '
+                 '(fullkey varchar(1023) PRIMARY KEY, '
+                 'stepname varchar(255), errorcode int, '
+                 'sitename varchar(255), numbererrors int, '
+                 'sitereadiness varchar(15))')
+
+    curs.execute('DELETE FROM temp.history_staging')
+
+    def move_staged(curs):
+        """
+        Move the rows of a batch that are not in any month yet
+        from the staging table to the current partition
+
+        :param sqlite3.Cursor curs: Cursor to the history database
+        :returns: The number of rows added to the partition
+        :rtype: int
+        """
+
+        curs.execute('DELETE FROM temp.history_staging WHERE fullkey IN '
+                     '(SELECT fullkey FROM main.history_keys)')
+
+        before = conn.total_changes
+        curs.execute('INSERT INTO main.%s SELECT *, ? FROM temp.history_staging' % partition,
+                     (ingested,))
+        number_added = conn.total_changes - before
+
+        if number_added:
+            curs.execute('INSERT OR IGNORE INTO main.history_ingests VALUES (?, ?)',
+                         (partition, ingested))
+            curs.execute('UPDATE main.history_ingests SET ingested = ? '
+                         'WHERE month = ? AND ingested < ?', (ingested, partition, ingested))
+
+        curs.execute('INSERT INTO main.history_keys SELECT fullkey, ? FROM temp.history_staging',
+                     (partition,))
+        curs.execute('DELETE FROM temp.history_staging')
+
+        return number_added
+
+    return errorutils.insert_rows(curs, rows, batch_size, 'temp.history_staging', move_staged)
+
+
+def add_to_history(curs, data_location, ingested=None):
+    """
+    Add errors from a source to the history
+
+    :param sqlite3.Cursor curs: Cursor to the history database
+    :param data_location: The source of errors, as described in
+                          :py:func:`errorutils.add_to_database`
+    :type data_location: str, list, or dict
+    :param float ingested: The time to store with the rows. Defaults to now.
+    :returns: The number of rows added
+    :rtype: int
+    """
+
+    number_added = add_rows(curs, errorutils.error_rows(errorutils.iter_source(data_location)),
+                            ingested)
+
+    if number_added:
+        cherrypy.log('Number of points added to the history: %i' % number_added)
+
+    return number_added
+
+
+def select_window(conn, since):
+    """
+    Make the ``workflows`` view of a connection only include rows ingested after a time.
+    This is done with a temporary view, so other connections are not affected.
+
+    :param sqlite3.Connection conn: Connection to the history database.
+                                    Other databases are not changed.
+    :param float since: The earliest ingest time to include
+    """
+
+    curs = conn.cursor()
+    if not is_history(curs):
+        return
+
+    since = int(since)
+    first = partition_name(since)
+    partitions = list_partitions(curs)
+
+    query = _view_query([name for name in partitions if name >= first], since) or \
+        'SELECT %s FROM main.%s WHERE 0' % (COLUMNS, partitions[0])
+
+    curs.execute('DROP VIEW IF EXISTS temp.workflows')
+    curs.execute('CREATE TEMP VIEW workflows AS %s' % query)
+
+
+def compact(conn, keep_months):
+    """
+    Drop the oldest months of the history and reclaim the space
+
+    :param sqlite3.Connection conn: Connection to the history database
+    :param int keep_months: The number of most recent months to keep.
+                            If 0, nothing is dropped.
+    :returns: The names of the dropped tables
+    :rtype: list
+    """
+
+    curs = conn.cursor()
+    partitions = list_partitions(curs)
+
+    dropped = partitions[:-keep_months] if keep_months else []
+
+    for name in dropped:
+        cherrypy.log('Dropping %s from the workflow history' % name)
+        curs.execute('DELETE FROM history_keys WHERE month = ?', (name,))
+        curs.execute('DELETE FROM history_ingests WHERE month = ?', (name,))
+        curs.execute('DROP TABLE %s' % name)
+
+    update_view(curs)
+    conn.commit()
+
+    conn.execute('VACUUM')
+
+    return dropped
+
+
+def setup_checkpoints(curs):
+    """
+    Create the tables that hold the hashes of the sources and their workflows
+
+    :param sqlite3.Cursor curs: Cursor to the history database
+    """
+
+    curs.execute('CREATE TABLE IF NOT EXISTS history_sources '
+                 '(source varchar(1023) PRIMARY KEY, digest varchar(40), updated int)')
+    curs.execute('CREATE TABLE IF NOT EXISTS history_checkpoints '
+                 '(source varchar(1023), workflow varchar(255), digest varchar(40), '
+                 'PRIMARY KEY (source, workflow))')
+
+
+def workflow_digests(items):
+    """
+    Hash the errors of each workflow.
+    The hash of a workflow does not depend on the order of its steps.
+
+    :param items: Iterable of ``(stepname, errors)`` pairs,
+                  like the output of :py:func:`errorutils.iter_source`
+    :type items: iterable
+    :returns: The hash of each workflow
+    :rtype: dict
+    """
+
+    sums = defaultdict(int)
+
+    for stepname, errors in items:
+        step_hash = hashlib.sha1(json.dumps([stepname, errors], sort_keys=True).encode())
+        workflow = stepname.split('/')[1]
+        # Adding the hashes of the steps makes the order not matter
+        sums[workflow] = (sums[workflow] + int(step_hash.hexdigest(), 16)) % (1 << 160)
+
+    return {workflow: '%040x' % total for workflow, total in sums.items()}
+
+
+def update_checkpointed(curs, source, digest, contents, ingested=None):
+    """
+    Add the errors of the workflows that have changed in a source
+    since it was last added with this function.
+
+    :param sqlite3.Cursor curs: Cursor to the history database
+    :param str source: The name of the source, where the checkpoint is stored
+    :param str digest: The hash of the whole source, from :py:func:`snapshots.load_source`
+    :param contents: The errors, from :py:func:`snapshots.load_source`
+    :type contents: str or dict
+    :param float ingested: The time to store with the rows. Defaults to now.
+    :returns: The number of rows added, the number of workflows that changed,
+              and the number of workflows in the source.
+              The last two are None if the whole source did not change.
+    :rtype: tuple
+    """
+
+    conn = curs.connection
+    setup_checkpoints(curs)
+
+    if list(curs.execute('SELECT 1 FROM history_sources WHERE source=? AND digest=?',
+                         (source, digest))):
+        return 0, None, None
+
+    # The source is only read once, even though it is used twice below
+    if not isinstance(contents, dict):
+        contents = dict(errorutils.iter_source(contents))
+
+    digests = workflow_digests(errorutils.iter_source(contents))
+    old_digests = dict(curs.execute(
+        'SELECT workflow, digest FROM history_checkpoints WHERE source=?', (source,)))
+
+    changed = set(workflow for workflow, workflow_digest in digests.items()
+                  if old_digests.get(workflow) != workflow_digest)
+
+    number_added = 0
+    if changed:
+        number_added = add_rows(
+            curs, errorutils.error_rows(
+                item for item in errorutils.iter_source(contents)
+                if item[0].split('/')[1] in changed),
+            ingested)
+
+    # The checkpoint is only saved after all of the rows are in
+    curs.execute('DELETE FROM history_checkpoints WHERE source=?', (source,))
+    curs.executemany('INSERT INTO history_checkpoints VALUES (?,?,?)',
+                     [(source, workflow, workflow_digest)
+                      for workflow, workflow_digest in digests.items()])
+    curs.execute('INSERT OR REPLACE INTO history_sources VALUES (?,?,?)',
+                 (source, digest, int(time.time())))
+    conn.commit()
+
+    return number_added, len(changed), len(digests)
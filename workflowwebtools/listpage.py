@@ -48,11 +48,11 @@ def listworkflows(error_code, site_name, workflow, session=None):
         else:
             # Click on workflow (not step)
             info = check_session(session)
-            if workflow in info.return_workflows():
+            if info.has_workflow(workflow):
                 nextlist = info.get_step_list(workflow)
             # Otherwise, is hopefully a PrepID
             else:
-                nextlist = info.get_prepid(workflow).get_workflows()
+                nextlist = info.get_prepid_workflows(workflow)
 
             for step in nextlist:
                 for key, numerrors in listworkflows(error_code, site_name, step, session):
@@ -0,0 +1,376 @@
+"""
+Instrumented locks used to find contention inside the server.
+
+Each :py:class:`InstrumentedLock` behaves like a ``threading.Lock``,
+but it also records how long threads waited to acquire it,
+how long it was held, and which call site held it.
+Locks that share a name share their statistics,
+so something like the per-session locks can be viewed together.
+
+Timings are filled into histograms with logarithmic buckets.
+Every ``sample`` acquisitions of a given lock name are also written to ``cherrypy.log``.
+The sampling rate is set in the ``locks`` section of ``config.yml``,
+and defaults to 1000.
+A value of 0 turns off the logging, but the histograms are always filled.
+
+A summary of all of the locks is returned by :py:func:`report`.
+"""
+
+import os
+import sys
+import time
+import weakref
+import threading
+
+import cherrypy
+
+from . import serverconfig
+
+
+BUCKETS = (0.00001, 0.0001, 0.001, 0.01, 0.1, 1.0, 10.0)
+"""Upper edges of the histogram buckets, in seconds"""
+
+_STATS = {}
+_STATS_LOCK = threading.Lock()
+
+_SAMPLE = None
+
+
+def sample_rate():
+    """
+    :returns: The number of acquisitions between each logged acquisition
+    :rtype: int
+    """
+
+    global _SAMPLE # pylint: disable=global-statement
+
+    if _SAMPLE is None:
+        _SAMPLE = int(serverconfig.config_dict().get('locks', {}).get('sample', 1000))
+
+    return _SAMPLE
+
+
+class Histogram(object):
+    """A simple histogram of times"""
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.total = 0.0
+        self.max = 0.0
+
+    def fill(self, value):
+        """
+        :param float value: The time to add to the histogram
+        """
+        index = 0
+        for edge in BUCKETS:
+            if value <= edge:
+                break
+            index += 1
+
+        self.counts[index] += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def summary(self):
+        """
+        :returns: The contents of the histogram
+        :rtype: dict
+        """
+
+        labels = ['<=%g' % edge for edge in BUCKETS] + ['>%g' % BUCKETS[-1]]
+
+        return {
+            'buckets': dict(zip(labels, self.counts)),
+            'total': self.total,
+            'max': self.max,
+            'mean': self.total/(sum(self.counts) or 1)
+            }
+
+
+class LockStats(object):
+    """Accumulates the timing information of all locks with the same name"""
+
+    def __init__(self, name):
+        """
+        :param str name: The name of the locks that are tracked
+        """
+
+        self.name = name
+        self.lock = threading.Lock()
+        self.acquires = 0
+        self.contended = 0
+        self.wait = Histogram()
+        self.hold = Histogram()
+        # Each call site points to [acquires, total wait, total hold, max hold]
+        self.callsites = {}
+
+    def record(self, wait, hold, callsite):
+        """
+        Fill the statistics for a single hold of a lock
+
+        :param float wait: Time waited before the lock was acquired
+        :param float hold: Time that the lock was held
+        :param str callsite: Location in the code that acquired the lock
+        """
+
+        with self.lock:
+            self.acquires += 1
+            if wait:
+                self.contended += 1
+            self.wait.fill(wait)
+            self.hold.fill(hold)
+
+            site = self.callsites.get(callsite)
+            if site is None:
+                site = self.callsites[callsite] = [0, 0.0, 0.0, 0.0]
+
+            site[0] += 1
+            site[1] += wait
+            site[2] += hold
+            site[3] = max(site[3], hold)
+
+            number = self.acquires
+
+        rate = sample_rate()
+        if rate and not number % rate:
+            cherrypy.log('Lock %s acquire %i: waited %.6fs, held %.6fs at %s' %
+                         (self.name, number, wait, hold, callsite))
+
+    def summary(self, num_sites=10):
+        """
+        :param int num_sites: The maximum number of call sites to list
+        :returns: The statistics of this lock name
+        :rtype: dict
+        """
+
+        with self.lock:
+            sites = sorted(self.callsites.items(), key=lambda site: site[1][2], reverse=True)
+
+            return {
+                'acquires': self.acquires,
+                'contended': self.contended,
+                'wait': self.wait.summary(),
+                'hold': self.hold.summary(),
+                'callsites': [
+                    {'callsite': callsite,
+                     'acquires': values[0],
+                     'wait': values[1],
+                     'hold': values[2],
+                     'max_hold': values[3]}
+                    for callsite, values in sites[:num_sites]
+                    ]
+                }
+
+
+def get_stats(name):
+    """
+    :param str name: Name of the lock
+    :returns: The statistics shared by all locks with this name
+    :rtype: LockStats
+    """
+
+    with _STATS_LOCK:
+        if name not in _STATS:
+            _STATS[name] = LockStats(name)
+
+        return _STATS[name]
+
+
+def _callsite():
+    """
+    :returns: The first location in the stack that is outside of this module
+    :rtype: str
+    """
+
+    frame = sys._getframe(1) # pylint: disable=protected-access
+    this_file = frame.f_code.co_filename
+
+    while frame is not None and frame.f_code.co_filename == this_file:
+        frame = frame.f_back
+
+    if frame is None:
+        return 'unknown'
+
+    return '%s:%i (%s)' % (os.path.basename(frame.f_code.co_filename),
+                           frame.f_lineno, frame.f_code.co_name)
+
+
+class InstrumentedLock(object):
+    """A lock that records how it is used"""
+
+    def __init__(self, name):
+        """
+        :param str name: The name that the statistics are stored under
+        """
+
+        self.name = name
+        self.stats = get_stats(name)
+        self._lock = threading.Lock()
+        # These are only set by the thread holding the lock
+        self._acquired = None
+        self._wait = None
+        self._callsite = None
+
+    def acquire(self, blocking=True):
+        """
+        Acquire the lock, recording the time spent waiting
+
+        :param bool blocking: If False, do not wait for the lock
+        :returns: True if the lock was acquired
+        :rtype: bool
+        """
+
+        start = time.time()
+
+        if self._lock.acquire(False):
+            wait = 0.0
+        elif blocking:
+            self._lock.acquire()
+            wait = time.time() - start
+        else:
+            return False
+
+        self._acquired = time.time()
+        self._wait = wait
+        self._callsite = _callsite()
+
+        return True
+
+    def release(self):
+        """Release the lock and store the timing"""
+
+        hold = time.time() - self._acquired
+        wait = self._wait
+        callsite = self._callsite
+
+        self._lock.release()
+
+        self.stats.record(wait, hold, callsite)
+
+    def locked(self):
+        """
+        :returns: If the lock is currently held
+        :rtype: bool
+        """
+        return self._lock.locked()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+
+class KeyedLock(InstrumentedLock):
+    """An :py:class:`InstrumentedLock` that keeps itself in a dictionary while it is held"""
+
+    def __init__(self, name, key, held):
+        """
+        :param str name: The name that the statistics are stored under
+        :param key: The key of the lock
+        :param dict held: Where the lock is kept while it is held
+        """
+
+        super(KeyedLock, self).__init__(name)
+        self.key = key
+        self.held = held
+
+    def acquire(self, blocking=True):
+        acquired = super(KeyedLock, self).acquire(blocking)
+        if acquired:
+            self.held[self.key] = self
+
+        return acquired
+
+    def release(self):
+        # Only the thread holding the lock changes its entry
+        self.held.pop(self.key, None)
+        super(KeyedLock, self).release()
+
+
+class InstrumentedLockDict(object):
+    """
+    Hands out a separate :py:class:`InstrumentedLock` for each key,
+    such as a workflow name.
+    All of the locks share the statistics of one name.
+    A lock is dropped once it is not held and nothing refers to it,
+    so the dictionary does not grow with every key ever used.
+    """
+
+    def __init__(self, name):
+        """
+        :param str name: The name that the statistics are stored under
+        """
+
+        self.name = name
+        self.lock = threading.Lock()
+        self.locks = weakref.WeakValueDictionary()
+        self.held = {}
+
+    def get(self, key):
+        """
+        :param key: The object to get the lock for
+        :returns: The lock for that key
+        :rtype: InstrumentedLock
+        """
+
+        with self.lock:
+            lock = self.locks.get(key)
+            if lock is None:
+                lock = self.locks[key] = KeyedLock(self.name, key, self.held)
+
+            return lock
+
+    def acquire(self, keys):
+        """
+        Acquire the locks for multiple keys.
+        The locks are always taken in sorted order, so that two threads
+        asking for overlapping keys cannot deadlock.
+
+        :param list keys: The keys to lock
+        :returns: The acquired locks, which should be passed to :py:meth:`release`
+        :rtype: list
+        """
+
+        locks = [self.get(key) for key in sorted(set(keys))]
+        for lock in locks:
+            lock.acquire()
+
+        return locks
+
+    @staticmethod
+    def release(locks):
+        """
+        :param list locks: The locks returned by :py:meth:`acquire`
+        """
+
+        for lock in reversed(locks):
+            lock.release()
+
+
+def report(num_sites=10):
+    """
+    Summarize all of the locks that have been created.
+    The locks are ordered so that the lock with the most total time
+    spent waiting is first.
+
+    :param int num_sites: The maximum number of call sites to list per lock
+    :returns: List of the lock statistics, each with a ``'name'``
+    :rtype: list
+    """
+
+    with _STATS_LOCK:
+        all_stats = list(_STATS.values())
+
+    output = []
+    for stats in all_stats:
+        summary = stats.summary(num_sites)
+        summary['name'] = stats.name
+        output.append(summary)
+
+    output.sort(key=lambda summary: summary['wait']['total'], reverse=True)
+
+    return output
@@ -165,8 +165,8 @@ def submitaction(user, workflows, action, session=None, **kwargs):
             'Parameters': wf_params,
             'Reasons': [reason['long'] for reason in reasons],
             'user': user,
-            'ACDCs': [wkf for wkf in error_info.get_prepid(
-                error_info.get_workflow(workflow).get_prep_id()).get_workflows() \
+            'ACDCs': [wkf for wkf in error_info.get_prepid_workflows(
+                error_info.get_workflow(workflow).get_prep_id()) \
                           if wkf != workflow and is_resub(wkf) and is_new(wkf, workflow)]
             }
 
@@ -0,0 +1,368 @@
+"""
+Finds the workflows with the most similar errors to a given workflow.
+
+Workflows are placed on the same hypersphere shells that are used for clustering,
+described in :py:mod:`clusterworkflows`.
+The error code and site name parts of each vector are then scaled by the
+weights in the ``neighbors`` section of ``config.yml``,
+and the nearest workflows are found by a brute force search over the sparse vectors,
+which only touches the non-zero entries of each vector.
+
+The index covers the workflows in the current errors, as well as the
+workflows in the history that have had actions submitted,
+so that similar past workflows and what was done to them can be found.
+It is rebuilt for each new snapshot of the current errors.
+Workflows that have actions submitted while a snapshot is in use are added
+to the existing index, without rebuilding the rest.
+This is checked in a background thread at most every ``neighbors: check_every`` seconds,
+so queries are answered from the index in memory without waiting for the database.
+The errors of the past workflows are only read from the history once.
+"""
+
+import os
+import copy
+import time
+import threading
+
+import cherrypy
+import numpy
+import scipy.sparse
+import sklearn.neighbors
+
+from . import globalerrors
+from . import serverconfig
+from . import manageactions
+from . import snapshots
+from . import clusterworkflows
+
+
+def get_settings():
+    """
+    :returns: The neighbor search settings, with defaults filled in
+    :rtype: dict
+    """
+
+    settings = {'k': 10, 'errorcode': 1.0, 'sitename': 1.0, 'check_every': 60}
+    settings.update(serverconfig.config_dict().get('neighbors', {}))
+
+    return settings
+
+
+HISTORY_BATCH = 400
+"""The number of workflows read from the history in each query"""
+
+
+def history_rows(history_path, workflows):
+    """
+    Get the errors of workflows from the history database.
+    The workflows are read in batches of :py:data:`HISTORY_BATCH`, with one query each.
+
+    :param str history_path: Location of the workflow history database
+    :param list workflows: The workflows to get
+    :returns: The ``(stepname, errorcode, sitename, numbererrors)`` of each workflow
+    :rtype: dict
+    """
+
+    if not workflows or not (history_path.endswith('.db') and os.path.isfile(history_path)):
+        return {}
+
+    workflows = sorted(set(workflows))
+    output = {workflow: [] for workflow in workflows}
+
+    conn = snapshots.connect(history_path)
+    try:
+        for start in range(0, len(workflows), HISTORY_BATCH):
+            batch = workflows[start:start + HISTORY_BATCH]
+            params = []
+            for workflow in batch:
+                # All steps of a workflow are between these in the stepname index
+                params.extend(('/%s/' % workflow, '/%s0' % workflow))
+
+            for row in conn.execute(
+                    'SELECT stepname, errorcode, sitename, numbererrors FROM workflows WHERE ' +
+                    ' OR '.join(['(stepname >= ? AND stepname < ?)'] * len(batch)), params):
+                output[row[0].split('/')[1]].append(row)
+    finally:
+        conn.close()
+
+    return output
+
+
+class NeighborIndex(object):
+    """Holds the weighted workflow vectors and a nearest neighbors search over them"""
+
+    def __init__(self, workflows, rows, history=None, settings=None):
+        """
+        :param list workflows: The current workflows
+        :param rows: The ``(stepname, errorcode, sitename, numbererrors)``
+                     of the current workflows
+        :param dict history: The rows of past workflows, as returned by :py:func:`history_rows`.
+                             Workflows that are also current or have no errors are ignored.
+        :param dict settings: The neighbor settings. See :py:func:`get_settings`.
+        """
+
+        self.settings = settings or get_settings()
+
+        rows = list(rows)
+        current = set(workflows)
+        past = sorted(workflow for workflow, errors in (history or {}).items()
+                      if errors and workflow not in current)
+        for workflow in past:
+            rows.extend(history[workflow])
+
+        self.workflows = list(workflows) + past
+        self.current = current
+        self.index = {workflow: row for row, workflow in enumerate(self.workflows)}
+
+        self.allmap = {
+            'errorcode': sorted(set(row[1] for row in rows), key=str),
+            'sitename': sorted(set(row[2] for row in rows))
+            }
+
+        self.vectors = self._vectors(rows, self.workflows)
+        self._fit()
+
+    def _vectors(self, rows, workflows):
+        """
+        :param rows: The ``(stepname, errorcode, sitename, numbererrors)`` of the workflows
+        :param list workflows: The workflows to make vectors for
+        :returns: The weighted vectors of the workflows, with columns from ``self.allmap``
+        :rtype: scipy.sparse.csr_matrix
+        """
+
+        matrix = clusterworkflows.build_workflow_matrix(rows, workflows, self.allmap)
+
+        weights = [float(self.settings['errorcode'])] * len(self.allmap['errorcode']) + \
+            [float(self.settings['sitename'])] * len(self.allmap['sitename'])
+
+        return matrix.dot(scipy.sparse.diags(weights)).tocsr() if weights else matrix
+
+    def _fit(self):
+        """Sets up the search over the current vectors"""
+
+        # Trees cannot be built over sparse vectors
+        self.tree = sklearn.neighbors.NearestNeighbors(algorithm='brute').fit(self.vectors) \
+            if self.workflows else None
+
+    def extended(self, history):
+        """
+        Get an index that also has some more past workflows.
+        Only the vectors of the new workflows are built.
+        This index is not changed, so it can still be queried while the new one is made.
+
+        :param dict history: The rows of the past workflows to add,
+                             as returned by :py:func:`history_rows`.
+                             Workflows that are already in the index or have no errors
+                             are ignored.
+        :returns: The new index, or this one if there is nothing to add
+        :rtype: NeighborIndex
+        """
+
+        past = sorted(workflow for workflow, errors in history.items()
+                      if errors and workflow not in self.index)
+        if not past:
+            return self
+
+        rows = [row for workflow in past for row in history[workflow]]
+
+        output = copy.copy(self)
+        output.allmap = {
+            'errorcode': sorted(set(self.allmap['errorcode']) | set(row[1] for row in rows),
+                                key=str),
+            'sitename': sorted(set(self.allmap['sitename']) | set(row[2] for row in rows))
+            }
+
+        vectors = self.vectors
+        if output.allmap != self.allmap:
+            # Move the existing entries to the columns of the new error codes and sites
+            code_index = {code: index for index, code in enumerate(output.allmap['errorcode'])}
+            site_index = {site: len(code_index) + index
+                          for index, site in enumerate(output.allmap['sitename'])}
+            columns = numpy.array([code_index[code] for code in self.allmap['errorcode']] +
+                                  [site_index[site] for site in self.allmap['sitename']],
+                                  dtype=int)
+
+            vectors = scipy.sparse.csr_matrix(
+                (vectors.data, columns[vectors.indices] if len(columns) else vectors.indices,
+                 vectors.indptr),
+                shape=(vectors.shape[0], len(code_index) + len(site_index)))
+            vectors.sort_indices()
+
+        output.vectors = scipy.sparse.vstack(
+            [vectors, output._vectors(rows, past)]).tocsr() # pylint: disable=protected-access
+        output.workflows = self.workflows + past
+        output.index = dict(self.index)
+        output.index.update((workflow, len(self.workflows) + row)
+                            for row, workflow in enumerate(past))
+        output._fit() # pylint: disable=protected-access
+
+        return output
+
+    def query(self, workflow, k):
+        """
+        :param str workflow: The workflow to find neighbors for
+        :param int k: The maximum number of neighbors. If less than one, nothing is returned.
+        :returns: The nearest workflows, closest first. Each has the keys
+                  'workflow', 'distance', and 'current', which is False for past workflows.
+        :rtype: list of dicts
+        """
+
+        row = self.index.get(workflow)
+        if row is None or k < 1:
+            return []
+
+        num = min(k + 1, len(self.workflows))
+        distances, indices = self.tree.kneighbors(self.vectors[row:row + 1], n_neighbors=num)
+
+        output = []
+        for distance, index in zip(distances[0], indices[0]):
+            neighbor = self.workflows[index]
+            if neighbor != workflow:
+                output.append({'workflow': neighbor,
+                               'distance': float(distance),
+                               'current': neighbor in self.current})
+
+        return output[:k]
+
+
+_INDEX = {'key': None, 'index': None, 'checked': 0}
+"""The current index, which is only read or replaced while holding :py:data:`_LOCK`"""
+_HISTORY = {}
+"""The rows of past workflows, which are only used while holding :py:data:`_UPDATE_LOCK`"""
+_LOCK = threading.Lock()
+_UPDATE_LOCK = threading.Lock()
+
+
+def acted_since(timestamp):
+    """
+    :param int timestamp: The earliest time of actions to check
+    :returns: The workflows that had actions submitted at or after the time
+    :rtype: set
+    """
+
+    return set(match['workflow'] for match in
+               manageactions.get_actions_collection().find(
+                   {'timestamp': {'$gte': int(timestamp)}}, {'workflow': 1}))
+
+
+def build_index(errorinfo, key):
+    """
+    Build the index for a snapshot and make it the current index.
+    This must be called while holding :py:data:`_UPDATE_LOCK`.
+
+    :param globalerrors.ErrorInfo errorinfo: The current errors
+    :param tuple key: The key of the snapshot
+    :returns: The new index
+    :rtype: NeighborIndex
+    """
+
+    cherrypy.log('Building neighbor index')
+    checked = time.time()
+
+    workflows = errorinfo.return_workflows()
+    acted = set(manageactions.get_acted_workflows(0)) - set(workflows)
+
+    # Only the workflows that were not acted on before are read from the history
+    for workflow in list(_HISTORY):
+        if workflow not in acted:
+            _HISTORY.pop(workflow)
+    _HISTORY.update(history_rows(serverconfig.workflow_history_path(),
+                                 [workflow for workflow in acted if workflow not in _HISTORY]))
+
+    index = NeighborIndex(
+        workflows,
+        errorinfo.execute('SELECT stepname, errorcode, sitename, numbererrors FROM workflows'),
+        _HISTORY)
+
+    with _LOCK:
+        _INDEX.update(key=key, index=index, checked=checked)
+
+    return index
+
+
+def refresh_index(key):
+    """
+    Add the workflows acted on since the index was last checked to the current index.
+    This must be called while holding :py:data:`_UPDATE_LOCK`, which it releases when done.
+
+    :param tuple key: The key of the snapshot that the index was built for.
+                      Nothing is changed if the index was rebuilt for another snapshot.
+    """
+
+    try:
+        with _LOCK:
+            if _INDEX['key'] != key:
+                return
+            index = _INDEX['index']
+            since = _INDEX['checked']
+
+        checked = time.time()
+
+        new = [workflow for workflow in acted_since(since)
+               if workflow not in _HISTORY and workflow not in index.current]
+        if new:
+            cherrypy.log('Adding %i acted workflows to neighbor index' % len(new))
+            added = history_rows(serverconfig.workflow_history_path(), new)
+            _HISTORY.update(added)
+            index = index.extended(added)
+
+        with _LOCK:
+            if _INDEX['key'] == key:
+                _INDEX.update(index=index, checked=checked)
+
+    except Exception as error:      # pylint: disable=broad-except
+        cherrypy.log('Could not refresh neighbor index: %s' % error)
+    finally:
+        _UPDATE_LOCK.release()
+
+
+def get_index(session=None):
+    """
+    Get the neighbor index for the current errors of a session.
+    The index is shared by all sessions with the same snapshot.
+    If the index was last checked more than ``neighbors: check_every`` seconds ago,
+    workflows acted on since then are added to it in a background thread,
+    and the index is returned without waiting for them.
+    Only a new snapshot makes the caller wait for the index to be built.
+
+    :param cherrypy.Session session: Stores the information for a session
+    :returns: The index
+    :rtype: NeighborIndex
+    """
+
+    errorinfo = globalerrors.check_session(session, can_refresh=True)
+    key = (errorinfo.db_path, errorinfo.data_location)
+
+    with _LOCK:
+        current = dict(_INDEX)
+
+    if current['key'] == key:
+        if time.time() - current['checked'] >= float(get_settings()['check_every']) and \
+                _UPDATE_LOCK.acquire(False):
+            thread = threading.Thread(target=refresh_index, args=(key,))
+            thread.daemon = True
+            thread.start()
+
+        return current['index']
+
+    with _UPDATE_LOCK:
+        # Another request might have built it while this one waited
+        with _LOCK:
+            if _INDEX['key'] == key:
+                return _INDEX['index']
+
+        return build_index(errorinfo, key)
+
+
+def get_neighbors(workflow, k=None, session=None):
+    """
+    Get the workflows with errors most similar to a workflow
+
+    :param str workflow: The workflow to find neighbors for
+    :param int k: The maximum number of neighbors. Defaults to ``neighbors: k`` in the config.
+    :param cherrypy.Session session: Stores the information for a session
+    :returns: The nearest workflows. See :py:meth:`NeighborIndex.query`.
+    :rtype: list of dicts
+    """
+
+    return get_index(session).query(workflow, k or int(get_settings()['k']))
@@ -8,16 +8,107 @@ for error handling workflows.
 
    Regression part is a work in progress. Need more data.
 
+The error matrices of each subtask are flattened into one row of a sparse feature matrix.
+When run as a script, the features and the parameters of each subtask are stored
+next to the input file in a ``.npz`` file named after the hash of the input,
+so they are only built once for each input, and the input is not read again after that.
+
 :author: Daniel Abercrombie <dabercro@mit.edu>
 """
 
 from __future__ import print_function
 
+import os
 import sys
 import json
+import hashlib
+
+import numpy
+import scipy.sparse
 
 from sklearn.neural_network import MLPClassifier
 
+
+KEYS = ['good_sites', 'bad_sites']
+"""The error matrices of each subtask, in the order of the features"""
+
+
+def get_vocabularies(matrices):
+    """
+    Get all of the errors and sites in sparse matrices.
+    Dense matrices are skipped.
+
+    :param matrices: Sparse matrices, with keys of error code and then site names
+    :type matrices: iterable
+    :returns: The sorted error codes, as ints, and the sorted sites
+    :rtype: list, list
+    """
+
+    allerrors = set()
+    allsites = set()
+
+    for matrix in matrices:
+        if not isinstance(matrix, list):
+            for error, sites in matrix.items():
+                allerrors.add(int(error))
+                allsites.update(sites)
+
+    return sorted(allerrors), sorted(allsites)
+
+
+def get_entries(matrix, error_index, site_index, num_sites):
+    """
+    Find the non-zero cells of an error matrix.
+    Errors and sites that are not in the indices are skipped.
+
+    :param matrix: A sparse matrix with keys of error code and then site names,
+                   or a dense matrix with rows in the order of the error index
+                   and columns in the order of the site index
+    :type matrix: dict or list
+    :param dict error_index: The row of each error code, keyed by string
+    :param dict site_index: The column of each site
+    :param int num_sites: The number of columns
+    :returns: The flattened cell positions, ``row * num_sites + column``, and their values
+    :rtype: list, list
+    :raises ValueError: if a dense matrix does not have a row for each error code
+                        and a column for each site
+    """
+
+    if isinstance(matrix, list):
+        dense = numpy.asarray(matrix)
+        if dense.size == 0 and not error_index:
+            return [], []
+        if dense.shape != (len(error_index), num_sites):
+            raise ValueError('Dense matrix has shape %s, but there are %i errors and %i sites' %
+                             (dense.shape, len(error_index), num_sites))
+        rows, columns = numpy.nonzero(dense)
+        return (rows * num_sites + columns).tolist(), dense[rows, columns].tolist()
+
+    cells = []
+    values = []
+    for error, sites in matrix.items():
+        row = error_index.get(str(error))
+        if row is None:
+            continue
+        for site, value in sites.items():
+            column = site_index.get(site)
+            if column is not None:
+                cells.append(row * num_sites + column)
+                values.append(value)
+
+    return cells, values
+
+
+def to_array(values):
+    """
+    :param list values: The values of matrix cells
+    :returns: The values as an array, keeping their type
+    :rtype: numpy.ndarray
+    """
+
+    return numpy.array(values) if values else numpy.array([], dtype=int)
+
+
 def convert_to_dense(errors, keys=None, allerrors=None, allsites=None):
     """
     Take a dictionary of sparse matrices,
@@ -34,34 +125,165 @@ def convert_to_dense(errors, keys=None, allerrors=None, allsites=None):
     :returns: Container for two dense matrices
     :rtype: dict of lists of lists
     """
-    keys = keys or ['good_sites', 'bad_sites']
+    keys = keys or KEYS
 
     if not allerrors and not allsites:
-        # First get all errors and all sites
-        allerrors = set()
-        allsites = set()
+        allerrors, allsites = get_vocabularies(errors[status] for status in keys)
 
-        for status in keys:
-            for error, sites in errors[status].items():
-                allerrors.add(int(error))
-                for site in sites:
-                    allsites.add(site)
+    allerrors = allerrors or []
+    allsites = allsites or []
 
-        allerrors = sorted(allerrors)
-        allsites = sorted(allsites)
+    error_index = {str(error): row for row, error in enumerate(allerrors)}
+    site_index = {site: column for column, site in enumerate(allsites)}
 
     # Build the dense output
     output = {}
     for status in keys:
-        output[status] = [[0] * len(allsites) for _ in allerrors]
-        for i_error, error in enumerate(allerrors):
-            for i_site, site in enumerate(allsites):
-                output[status][i_error][i_site] += errors[status].get(str(error), {}).get(site, 0)
+        cells, values = get_entries(errors[status], error_index, site_index, len(allsites))
+        values = to_array(values)
+        dense = numpy.zeros(len(allerrors) * len(allsites), dtype=values.dtype)
+        dense[cells] = values
+        output[status] = dense.reshape(len(allerrors), len(allsites)).tolist()
 
     return output
 
 
-def get_classifier(raw_data, parameter, **kwargs):
+def build_features(raw_data):
+    """
+    Build the feature matrix for training from all of the subtasks.
+    Each row is the good sites matrix of a subtask followed by its bad sites matrix,
+    both flattened one error code at a time.
+
+    :param dict raw_data: Raw data in the form of output from
+                          :py:func:`actionshistorylink.dump_json`.
+    :returns: The keys 'keys', 'features', 'allerrors', 'allsites', and 'parameters'.
+              The features are a sparse matrix with a row for each key, in the same order.
+              The parameters are the action parameters of each key, also in the same order,
+              so classifiers can be trained without the raw data.
+    :rtype: dict
+    """
+
+    keys = sorted(raw_data)
+
+    allerrors, allsites = get_vocabularies(
+        raw_data[key]['errors'][status] for key in keys for status in KEYS)
+
+    error_index = {str(error): row for row, error in enumerate(allerrors)}
+    site_index = {site: column for column, site in enumerate(allsites)}
+    size = len(allerrors) * len(allsites)
+
+    rows = []
+    columns = []
+    values = []
+
+    for row, key in enumerate(keys):
+        for offset, status in enumerate(KEYS):
+            cells, cell_values = get_entries(raw_data[key]['errors'][status],
+                                             error_index, site_index, len(allsites))
+            rows.extend([row] * len(cells))
+            columns.extend(cell + offset * size for cell in cells)
+            values.extend(cell_values)
+
+    features = scipy.sparse.csr_matrix(
+        (to_array(values), (numpy.array(rows, dtype=int), numpy.array(columns, dtype=int))),
+        shape=(len(keys), len(KEYS) * size))
+
+    return {'keys': keys, 'features': features, 'allerrors': allerrors, 'allsites': allsites,
+            'parameters': [raw_data[key]['parameters'] for key in keys]}
+
+
+def features_path(input_path, cache_dir=None):
+    """
+    :param str input_path: Location of the raw data JSON file
+    :param str cache_dir: Directory of the cached features.
+                          Defaults to the directory of the input file.
+    :returns: The location of the cached features for the current contents of the input file
+    :rtype: str
+    """
+
+    digest = hashlib.sha1()
+    with open(input_path, 'rb') as input_file:
+        for chunk in iter(lambda: input_file.read(1 << 20), b''):
+            digest.update(chunk)
+
+    return os.path.join(cache_dir or os.path.dirname(os.path.abspath(input_path)),
+                        'features_%s.npz' % digest.hexdigest())
+
+
+def save_features(features, path):
+    """
+    :param dict features: The output of :py:func:`build_features`
+    :param str path: Where to store the features
+    """
+
+    matrix = features['features']
+    temp_path = '%s.%i.tmp' % (path, os.getpid())
+
+    with open(temp_path, 'wb') as output:
+        numpy.savez(output, data=matrix.data, indices=matrix.indices, indptr=matrix.indptr,
+                    shape=numpy.array(matrix.shape),
+                    keys=numpy.array(features['keys'], dtype=str),
+                    allerrors=numpy.array(features['allerrors'], dtype=int),
+                    allsites=numpy.array(features['allsites'], dtype=str),
+                    parameters=numpy.array(json.dumps(features['parameters'])))
+
+    # Other training runs only ever see a complete file
+    os.rename(temp_path, path)
+
+
+def load_features(path):
+    """
+    :param str path: Location of features stored by :py:func:`save_features`
+    :returns: The same as :py:func:`build_features`,
+              or None if the stored features do not have the parameters
+    :rtype: dict
+    """
+
+    with numpy.load(path) as stored:
+        # Stored before the parameters were kept with the features
+        if 'parameters' not in stored.files:
+            return None
+
+        return {
+            'keys': stored['keys'].tolist(),
+            'features': scipy.sparse.csr_matrix(
+                (stored['data'], stored['indices'], stored['indptr']),
+                shape=tuple(stored['shape'])),
+            'allerrors': stored['allerrors'].tolist(),
+            'allsites': stored['allsites'].tolist(),
+            'parameters': json.loads(str(stored['parameters']))
+            }
+
+
+def cached_features(input_path, raw_data=None, cache_dir=None):
+    """
+    Get the features for a raw data file, only building them
+    if they were not stored for the same file contents before.
+
+    :param str input_path: Location of the raw data JSON file
+    :param dict raw_data: The contents of the file, if already loaded
+    :param str cache_dir: Directory of the cached features. See :py:func:`features_path`.
+    :returns: The same as :py:func:`build_features`
+    :rtype: dict
+    """
+
+    path = features_path(input_path, cache_dir)
+    if os.path.exists(path):
+        features = load_features(path)
+        if features is not None:
+            return features
+
+    if raw_data is None:
+        with open(input_path, 'r') as input_file:
+            raw_data = json.load(input_file)
+
+    features = build_features(raw_data)
+    save_features(features, path)
+
+    return features
+
+
+def get_classifier(raw_data, parameter, features=None, **kwargs):
     """
     Fit a classifier.
     If the module is run as a script,
@@ -70,64 +292,52 @@ def get_classifier(raw_data, parameter, **kwargs):
 
     :param dict raw_data: Raw data in the form of output from
                           :py:func:`actionshistorylink.dump_json`.
+                          This is not used if the features are given.
     :param str parameter: The parameter to classify.
+    :param dict features: The output of :py:func:`build_features` for the raw data.
+                          If not given, the features are built here.
     :param kwargs: These are kwargs for the ``sklearn.neural_network.MLPClassifier``
                    that is running underneath.
     :returns: Trained classifier model
     :rtype: sklearn.neural_network.MLPClassifier
     """
 
-    primary_ids = sorted({key.split('/')[1] for key in raw_data.keys()})
+    features = features or build_features(raw_data)
+
+    primary_ids = sorted({key.split('/')[1] for key in features['keys']})
 
     # Only split samples when running interactive tests
     training_ids = primary_ids[0::2] if __name__ == '__main__' else primary_ids
 
-    training_data = []
+    training_rows = []
     training_target = []
-    testing_data = []
+    testing_rows = []
     testing_target = []
 
     class_labels = []
 
     # Prepare the data
 
-    allerrors = set()
-    allsites = set()
-
-    for key in sorted(raw_data):
-        for status in ['good_sites', 'bad_sites']:
-            matrix = raw_data[key]['errors'][status]
-            # Only do this for sparse matrices
-            if not isinstance(matrix, list):
-                for error, sites in matrix.items():
-                    allerrors.add(int(error))
-                    for site in sites:
-                        allsites.add(site)
-
-    allerrors = sorted(allerrors)
-    allsites = sorted(allsites)
-
-    for key in sorted(raw_data):
+    for row, (key, parameters) in enumerate(zip(features['keys'], features['parameters'])):
         if key.split('/')[1] in training_ids:
-            data = training_data
+            rows = training_rows
             target = training_target
         else:
-            data = testing_data
+            rows = testing_rows
             target = testing_target
 
-        errors = raw_data[key]['errors']
-        if not isinstance(errors['good_sites'], list):
-            errors = convert_to_dense(errors, allerrors=allerrors, allsites=allsites)
-
-        data.append(sum(errors['good_sites'] + errors['bad_sites'], []))
+        rows.append(row)
 
-        param = raw_data[key]['parameters'].get(parameter, '')
+        param = parameters.get(parameter, '')
         if param in class_labels:
             target.append(class_labels.index(param))
         else:
             target.append(len(class_labels))
             class_labels.append(param)
 
+    training_data = features['features'][training_rows]
+    testing_data = features['features'][testing_rows]
+
     classifier = MLPClassifier(**kwargs)
     classifier.fit(training_data, training_target)
 
@@ -136,7 +346,8 @@ def get_classifier(raw_data, parameter, **kwargs):
         def print_results(data, target):
             """Print the results of predictions.
 
-            :param list data: Errors in the format of a matrix
+            :param data: Errors of each subtask, as a sparse matrix
+            :type data: scipy.sparse.csr_matrix
             :param list target: The values that the data should correspond to
             """
 
@@ -172,10 +383,8 @@ def main():
     else:
         parameter = 'action'
 
-    with open(sys.argv[1], 'r') as input_file:
-        raw_data = json.load(input_file)
-
-    get_classifier(raw_data, parameter,
+    # The raw data is only read if the features were not stored for it yet
+    get_classifier(None, parameter, cached_features(sys.argv[1]),
                    solver='lbfgs', hidden_layer_sizes=(100, 10))
 
 
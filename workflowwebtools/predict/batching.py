@@ -0,0 +1,94 @@
+"""
+Combines work requested by different threads into batches.
+This is used to send concurrent single predictions to the model together,
+since one call with many inputs takes about as long as one call with a single input.
+"""
+
+import threading
+
+
+class MicroBatcher(object):
+    """
+    Combines calls from different threads that arrive close together into one call.
+    The first call of a batch waits for the window, or until the batch is full,
+    then runs the function on the whole batch and hands each caller its own output.
+    If the function raises for the batch, it is run on each input alone,
+    so that only the callers with bad inputs get an error.
+    """
+
+    def __init__(self, function, window=0.01, max_size=64):
+        """
+        :param function: Function that takes a list of inputs and returns
+                         a list of outputs in the same order
+        :param float window: Seconds to wait for more calls before running a batch
+        :param int max_size: Number of calls that runs a batch without waiting
+                             for the rest of the window
+        """
+
+        self.function = function
+        self.window = window
+        self.max_size = max_size
+
+        self.lock = threading.Lock()
+        self.pending = []
+        self.full = None
+
+    def run(self, batch):
+        """
+        Run the function on a batch, falling back to one input at a time if it fails.
+        The output or error of each entry is stored under 'output' or 'error'.
+
+        :param list batch: The entries of the calls in the batch
+        """
+
+        try:
+            outputs = self.function([each['input'] for each in batch])
+        except Exception as error:      # pylint: disable=broad-except
+            if len(batch) == 1:
+                batch[0]['error'] = error
+                return
+
+            for each in batch:
+                self.run([each])
+            return
+
+        for each, output in zip(batch, outputs):
+            each['output'] = output
+
+    def __call__(self, value):
+        """
+        :param value: The input for the function
+        :returns: The output of the function for this input
+        """
+
+        entry = {'input': value, 'done': threading.Event()}
+
+        with self.lock:
+            self.pending.append(entry)
+            if len(self.pending) == 1:
+                # This call runs the batch
+                self.full = full = threading.Event()
+            else:
+                full = None
+                if len(self.pending) >= self.max_size:
+                    self.full.set()
+
+        if full is None:
+            entry['done'].wait()
+        else:
+            full.wait(self.window)
+
+            with self.lock:
+                batch = self.pending
+                self.pending = []
+
+            try:
+                self.run(batch)
+            finally:
+                for each in batch:
+                    each['done'].set()
+
+        if 'error' in entry:
+            raise entry['error']
+
+        return entry['output']
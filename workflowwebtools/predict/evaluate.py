@@ -2,184 +2,286 @@
 
 """
 A module that evaluates a model and returns the prediction
-"""
 
-from __future__ import print_function
+The model and the tables it needs are loaded once into a :py:class:`Predictor`
+that is shared by all requests.
+The files are checked before each prediction, and loaded again if they have changed.
+Single predictions from concurrent requests are combined into one call to the model
+by a :py:class:`batching.MicroBatcher`.
+"""
 
 import os
-import random
-import itertools
+import time
 
+import cherrypy
 import numpy as np
 import pandas as pd
 import keras as K
 
+from .. import lockstats
+from .. import serverconfig
+from .features import FeatureMap
+from .batching import MicroBatcher
 
-def modified_site_name(site):
-    site_name = site.split('_')[:-1]
-    s = ''
-    for i in site_name:
-        s = s+i+'_'
-    s = s.rstrip('_')
-    return s
-
-def build_table(df, template_table):
-    sparse_df = template_table.copy()
-
-    tier0_sites, tier1_sites, tier2_sites, tier3_sites = [], [], [], []
-    for i in sparse_df.keys():
-        if i != 'NA':
-            if i[1] == '0':
-                tier0_sites.append(i)
-            elif i[1] == '1':
-                tier1_sites.append(i)
-            elif i[1] == '2':
-                tier2_sites.append(i)
-            elif i[1] == '3':
-                tier3_sites.append(i)
-
-    n0, n1, n2, n3 = len(tier0_sites), len(tier1_sites), len(tier2_sites), len(tier3_sites)
-    for exit_code, site_dict in zip(df.keys(), df.values()):
-        exit_code = int(exit_code)
-        for site, count in site_dict.items():
-
-            chosen_site = None
-            site_present_in_training_data = site in sparse_df.keys()
-            if not site_present_in_training_data:
-
-                site = modified_site_name(site)
-                cond = site in sparse_df.keys()
-                if cond:
-                    chosen_site = site
-
-                print("Detected a site %s which was not present in the training dataset" % site)
-                print("We would use a proxy site for this based on whether it is T1, T2 or T3")
-                tier = site.split("_")[0][1]
-                if chosen_site is None:
-                    if tier == '1':
-                        chosen_num = random.randint(0, n1-1)
-                        chosen_site = tier1_sites[chosen_num]
-                    elif tier == '2':
-                        chosen_num = random.randint(0, n2-1)
-                        chosen_site = tier2_sites[chosen_num]
-                        print('The chosen site is ', chosen_site)
-                    elif tier == '3':
-                        chosen_num = random.randint(0, n3-1)
-                        chosen_site = tier3_sites[chosen_num]
-                        print('The chosen site is ', chosen_site)
-                    elif tier == '0':
-                        chosen_num = random.randint(0, n0-1)
-                        chosen_site = tier0_sites[chosen_num]
-                        print('The chosen site is ', chosen_site)
-                    else:
-                        continue
-                if chosen_site is None:
-                    chosen_site = site
-
-                if np.isnan(count) or np.isnan(sparse_df.loc[exit_code, chosen_site]):
-                    sparse_df.loc[exit_code, chosen_site] = 0
-                else:
-                    sparse_df.loc[exit_code, chosen_site] = count
-
-    return sparse_df
-
-
-def list_of_sites(x):
-    return [item.keys() for item in x] or ['NA']
-
-def build_table_flatten(x):
-    d_outer = []
-
-    for column in x:
-
-        for item in x[column]:
-            d_outer.append(item)
-
-    return d_outer
 
+FILES = {
+    'table': 'sparse_table.csv',
+    'actions': 'actionfile.txt',
+    'model': 'my_model.h5'
+}
+"""The files that the predictor needs, relative to its directory"""
 
-def pred(errors):
-    # Needs all of these files to be local
-    for filename in ['sparse_table.csv', 'actionfile.txt', 'my_model.h5']:
-        if not os.path.exists(filename):
-            return ['TBD']
 
-    df = pd.DataFrame(columns=('workflow', 'errors'))
-    base_data = []
-    for i in errors:
-        it = i.items()
-        base_data.extend(it)
+def read_action_codes(filename):
+    """
+    :param str filename: The location of the file of action names and their codes
+    :returns: The action name for each code
+    :rtype: dict
+    """
 
-    for i, dat in enumerate(base_data):
-        workflow, error_dict = dat[0], dat[1]
+    action_code_dictionary = {}
+    a = np.genfromtxt(filename, delimiter='\t', dtype=str)
+    b = list(i.split('   ') for i in a)
+    for i in b:
 
-        if 'NotReported' in error_dict:
-            error_dict[-1] = error_dict.pop('NotReported')
+        action_code_dictionary[int(i[1])] = i[0]
 
-        df.loc[i] = [workflow, error_dict]
+    return action_code_dictionary
 
-    template_table = pd.read_csv("sparse_table.csv").set_index("Unnamed: 0")
-    template_table[:] = 0
-    df['errors_sites_exit_codes'] = df['errors'].apply(lambda x: x.keys() if x else ['0'])
 
-    df['errors_sites_dict'] = df['errors'].apply(lambda x: x.values() if x else [{'NA': 0}])
+class Predictor(object):
+    """
+    Holds a model and its tables, so that they are not loaded for every prediction.
+    The model is called by one thread at a time, and the files are loaded again
+    when their modification times change.
+    The inputs of the model are built outside of the lock.
+    """
 
-    df['errors_sites_list'] = df['errors_sites_dict'].apply(list_of_sites)
+    def __init__(self, directory=''):
+        """
+        :param str directory: The directory containing the :py:data:`FILES`.
+                              Defaults to the working directory.
+        """
+
+        self.paths = {key: os.path.join(directory, name) for key, name in FILES.items()}
+        self.lock = lockstats.InstrumentedLock('Predictor.lock')
+
+        self.mtimes = None
+        self.model = None
+        self.graph = None
+        self.feature_map = None
+        self.action_codes = None
+
+        self.load_time = lockstats.Histogram()
+        self.predict_time = lockstats.Histogram()
+
+    def get_mtimes(self):
+        """
+        :returns: The modification time of each file, or None if any file is missing
+        :rtype: dict
+        """
+
+        try:
+            return {key: os.path.getmtime(path) for key, path in self.paths.items()}
+        except OSError:
+            return None
+
+    def load(self):
+        """
+        Load the files if they changed since they were last loaded.
+        This must be called while holding :py:attr:`lock`.
+
+        :returns: True if a model is ready for predictions
+        :rtype: bool
+        """
+
+        mtimes = self.get_mtimes()
+        if mtimes is None:
+            # Needs all of these files to be local
+            return False
+        if mtimes == self.mtimes:
+            return self.model is not None
+
+        start = time.time()
+
+        # Free the old model before loading the new one
+        self.model = None
+        K.backend.clear_session()
+
+        template_table = pd.read_csv(self.paths['table']).set_index("Unnamed: 0")
+
+        self.action_codes = read_action_codes(self.paths['actions'])
+        self.feature_map = FeatureMap(template_table.index, template_table.columns)
+        self.model = K.models.load_model(self.paths['model'])
+
+        # Keras with TensorFlow 1 only predicts in the graph that the model was loaded in
+        if hasattr(K.backend, 'get_session'):
+            self.graph = K.backend.get_session().graph
+
+        self.mtimes = mtimes
+        self.load_time.fill(time.time() - start)
+        cherrypy.log('Loaded model from %s in %.2f s' % (self.paths['model'], time.time() - start))
+
+        return True
+
+    def run_model(self, features):
+        """
+        Call the model.
+        This must be called while holding :py:attr:`lock`, after :py:meth:`load`.
+
+        :param numpy.ndarray features: The input built by :py:attr:`feature_map`
+        :returns: The predicted action for each row of the input
+        :rtype: list
+        """
+
+        if self.graph is None:
+            predicted_actions_encoded = self.model.predict(features)
+        else:
+            with self.graph.as_default():
+                predicted_actions_encoded = self.model.predict(features)
 
-    list2d = df['errors_sites_exit_codes'].tolist()
+        predicted_actions_encoded = np.round(predicted_actions_encoded)
 
-    sites_exit_codes = sorted(set(list(itertools.chain.from_iterable(list2d))), key=int)
-    sites_exit_codes = [str(x) for x in sites_exit_codes]
+        predicted_actions = []
+        for i in predicted_actions_encoded:
+            pos = np.argmax(i)
 
-    list2d_step1 = df['errors_sites_list'].tolist()
-    list2d_step2 = list(itertools.chain.from_iterable(list2d_step1))
-    site_names = sorted(set(list(itertools.chain.from_iterable(list2d_step2))))
-    site_names = [str(x) for x in site_names]
+            if pos in self.action_codes:
+                predicted_actions.append(self.action_codes[pos])
+            else:
+                predicted_actions.append(-1)
 
-    df['table_sites'] = df['errors'].apply(
-        lambda x: build_table(x, template_table))
-    df['table_sites_flatten'] = df['table_sites'].apply(build_table_flatten)
-    x_dataframe = df.loc[:, "table_sites_flatten"]
-    x_matrix = x_dataframe.values
-    feature_size = len(x_matrix[0])
-    res = []
-    clip_length = len(x_matrix[0])
-    for i in x_matrix:
-        i_clipped = i[:clip_length]
-        res.extend(i_clipped)
+        return predicted_actions
 
-    res = np.asarray(res).reshape(-1, feature_size)
-    mask = ~np.any(pd.isnull(res), axis=1)
-    res = res[mask]
+    def predict_each(self, errors):
+        """
+        Predict the actions of many workflows with one call to the model
 
-    model = K.models.load_model('my_model.h5')
-    predicted_actions_encoded = model.predict(np.array(np.asfarray(res)))
-    predicted_actions_encoded = np.round(predicted_actions_encoded)
+        :param list errors: The errors of each workflow, as returned by
+                            :py:meth:`workflowinfo.WorkflowInfo.get_errors`
+        :returns: The predicted action for each step of each workflow.
+                  If the files of the model are not all present,
+                  each workflow gets a single 'TBD'.
+        :rtype: list of lists
+        """
 
-    action_code_dictionary = {}
-    a = np.genfromtxt("actionfile.txt", delimiter='\t', dtype=str)
-    b = list(i.split('   ') for i in a)
-    for i in b:
+        steps = [step for workflow in errors for step in workflow.values()]
 
-        action_code_dictionary[int(i[1])] = i[0]
+        feature_map = None
+        features = None
 
-    predicted_actions = []
-    for i in predicted_actions_encoded:
-        pos = np.argmax(i)
+        while True:
+            with self.lock:
+                if not self.load():
+                    return [['TBD'] for _ in errors]
 
-        if pos in action_code_dictionary:
-            predicted_actions.append(action_code_dictionary[pos])
-        else:
-            predicted_actions.append(-1)
+                # Only use the input if no other thread loaded new files while it was built
+                if features is not None and feature_map is self.feature_map:
+                    # Only the model is timed, not building the input or waiting for the lock
+                    start = time.time()
+                    predicted_actions = self.run_model(features)
+                    self.predict_time.fill(time.time() - start)
+                    break
+
+                feature_map = self.feature_map
+
+            if not steps:
+                return [[] for _ in errors]
+
+            features = feature_map.build(steps)
+
+        output = []
+        for workflow in errors:
+            output.append(predicted_actions[:len(workflow)])
+            predicted_actions = predicted_actions[len(workflow):]
+
+        return output
+
+    def predict(self, errors):
+        """
+        :param list errors: The errors of each workflow
+        :returns: The predicted action for each step of all of the workflows
+        :rtype: list
+        """
 
-    K.backend.clear_session()
+        return [action for actions in self.predict_each(errors) for action in actions]
 
-    return predicted_actions
+    def stats(self):
+        """
+        :returns: Histograms of the seconds spent loading files and making predictions,
+                  under the keys 'load' and 'predict'
+        :rtype: dict
+        """
+
+        with self.lock:
+            return {'load': self.load_time.summary(),
+                    'predict': self.predict_time.summary()}
+
+
+_PREDICTOR = {'predictor': None}
+_PREDICTOR_LOCK = lockstats.InstrumentedLock('PREDICTOR_LOCK')
+
+
+def get_predictor():
+    """
+    :returns: The predictor shared by the whole server
+    :rtype: Predictor
+    """
+
+    with _PREDICTOR_LOCK:
+        if _PREDICTOR['predictor'] is None:
+            _PREDICTOR['predictor'] = Predictor()
+
+        return _PREDICTOR['predictor']
+
+
+_BATCHER = {'batcher': None}
+
+
+def get_batcher():
+    """
+    :returns: The batcher of single predictions shared by the whole server.
+              The window and size are set in the ``predict`` section of ``config.yml``.
+    :rtype: MicroBatcher
+    """
+
+    with _PREDICTOR_LOCK:
+        if _BATCHER['batcher'] is None:
+            settings = serverconfig.config_dict().get('predict', {})
+            _BATCHER['batcher'] = MicroBatcher(
+                lambda errors: get_predictor().predict_each(errors),
+                float(settings.get('batch_window', 0.01)),
+                int(settings.get('batch_size', 64)))
+
+        return _BATCHER['batcher']
+
+
+def first_action(actions):
+    """
+    :param list actions: The predicted actions of the steps of a workflow
+    :returns: The action to show for the workflow
+    :rtype: str
+    """
+
+    return actions[0] if actions else 'TBD'
+
+
+def pred(errors):
+    """
+    :param list errors: The errors of each workflow
+    :returns: The predicted action of each step. See :py:meth:`Predictor.predict`.
+    :rtype: list
+    """
+
+    return get_predictor().predict(errors)
 
 
 def predict(wf_obj):
     """
-    Takes the errors for a workflow and makes an action prediction
+    Takes the errors for a workflow and makes an action prediction.
+    Predictions for different workflows requested at about the same time
+    are made together by :py:func:`get_batcher`.
+
     :param workflowwebtool.workflowinfo.WorkflowInfo wf_obj:
         The WorkflowInfo object that we want to perform a prediction on
     :returns: Prediction results to be passed back to a browser
@@ -187,5 +289,22 @@ def predict(wf_obj):
     """
 
     return {
-        'Action': pred([wf_obj.get_errors(True)])[0]
+        'Action': first_action(get_batcher()(wf_obj.get_errors(True)))
     }
+
+
+def predict_all(errors):
+    """
+    Makes action predictions for many workflows at once
+
+    :param dict errors: The errors of each workflow, as returned by
+                        :py:meth:`workflowinfo.WorkflowInfo.get_errors`
+    :returns: The same as :py:func:`predict` for each workflow
+    :rtype: dict
+    """
+
+    workflows = sorted(errors)
+    actions = get_predictor().predict_each([errors[workflow] for workflow in workflows])
+
+    return {workflow: {'Action': first_action(workflow_actions)}
+            for workflow, workflow_actions in zip(workflows, actions)}
@@ -0,0 +1,105 @@
+"""
+Builds the input of the action prediction model from the errors of workflows.
+
+The model was trained on a table of exit codes and sites, flattened one site at a time.
+A :py:class:`FeatureMap` holds the position of each exit code and site in that input,
+so the counts can be written straight into a numpy array.
+
+Sites that were not in the training data are replaced by a proxy.
+If the site name without its last part, such as ``T2_XX_Site`` for ``T2_XX_Site_Disk``,
+was in the training data, that is used.
+Otherwise, a random site of the same tier is chosen once, and used for that site from then on.
+Exit codes that were not in the training data are ignored.
+"""
+
+import random
+
+import numpy as np
+
+
+def modified_site_name(site):
+    """
+    :param str site: A site name
+    :returns: The site name without the last part after an underscore
+    :rtype: str
+    """
+
+    return '_'.join(site.split('_')[:-1])
+
+
+class FeatureMap(object):
+    """The position of each exit code and site in the model input"""
+
+    def __init__(self, exit_codes, sites):
+        """
+        :param list exit_codes: The exit codes of the rows in the training table
+        :param list sites: The sites of the columns in the training table
+        """
+
+        self.num_codes = len(exit_codes)
+        self.size = len(exit_codes) * len(sites)
+
+        self.rows = {int(code): row for row, code in enumerate(exit_codes)}
+        self.columns = {site: column for column, site in enumerate(sites)}
+
+        self.tiers = {}
+        for column, site in enumerate(sites):
+            if site != 'NA':
+                self.tiers.setdefault(site[1], []).append(column)
+
+        # Column of each site that was not in the training data, or None if it is skipped
+        self.proxies = {}
+
+    def site_column(self, site):
+        """
+        :param str site: The name of a site
+        :returns: The column of the site or its proxy, or None if there is no proxy
+        :rtype: int
+        """
+
+        column = self.columns.get(site)
+        if column is not None:
+            return column
+
+        if site not in self.proxies:
+            modified = modified_site_name(site)
+            column = self.columns.get(modified)
+
+            if column is None:
+                tier_sites = self.tiers.get(modified.split('_')[0][1:2])
+                if tier_sites:
+                    column = random.choice(tier_sites)
+
+            # Threads building inputs at the same time agree on one proxy
+            return self.proxies.setdefault(site, column)
+
+        return self.proxies[site]
+
+    def build(self, steps):
+        """
+        :param list steps: The errors of each step, keyed by exit code and then site name,
+                           like the values of :py:meth:`workflowinfo.WorkflowInfo.get_errors`
+        :returns: A row of the model input for each step
+        :rtype: numpy.ndarray
+        """
+
+        cells = {}
+        for index, errors in enumerate(steps):
+            for exit_code, sites in errors.items():
+                row = self.rows.get(-1 if exit_code == 'NotReported' else int(exit_code))
+                if row is None:
+                    continue
+
+                for site, count in sites.items():
+                    column = self.site_column(site)
+                    if column is not None:
+                        # Matches the flattening of the training table, one site at a time
+                        cells[(index, column * self.num_codes + row)] = count
+
+        output = np.zeros((len(steps), self.size))
+        if cells:
+            indices = np.array(list(cells.keys()), dtype=int)
+            output[indices[:, 0], indices[:, 1]] = np.nan_to_num(
+                np.array(list(cells.values()), dtype=float))
+
+        return output
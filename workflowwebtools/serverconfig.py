@@ -147,3 +147,13 @@ def get_history_length():
     """
 
     return int(config_dict()['actions']['submithistory'])
+
+
+def history_window():
+    """
+    :returns: the number of days of the workflow history to use for clustering
+              and training. 0 means that the whole history is used.
+    :rtype: int
+    """
+
+    return int(config_dict().get('history', {}).get('window_days', 0))
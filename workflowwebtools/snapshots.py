@@ -0,0 +1,292 @@
+"""
+Keeps the SQLite databases built from the current errors on disk,
+so that they do not have to be rebuilt every time the server starts
+or an :py:class:`globalerrors.ErrorInfo` refreshes.
+
+Each source of errors gets its own directory under ``<workspace>/snapshots``.
+Inside this directory, each snapshot is named after the hash of the contents it was built from.
+If the source has not changed since the last build, the existing snapshot is opened directly.
+Otherwise a new snapshot is built in a temporary file and then moved into place,
+so readers never see a partially built database.
+Local files are hashed without being parsed.
+For urls, the server is asked for the ETag or Last-Modified time of the file,
+and the file is only downloaded if that changed.
+
+For the server's current errors, the snapshot also contains the errors of the other
+workflows in the same PrepIDs, as they were when the snapshot was built.
+These can change without the source changing,
+so these snapshots are rebuilt after ``max_age`` seconds, set in ``config.yml``.
+
+The last few snapshots of each source are kept, as set by the ``snapshots`` section
+of ``config.yml``.
+Snapshots that are held by an open :py:class:`globalerrors.ErrorInfo`, through :py:func:`hold`,
+are kept as well.
+Snapshots are read through read-only connections, so a reader of a snapshot that was removed
+by another process gets an error, instead of creating an empty database in its place.
+To roll back, point ``data: all_errors`` to one of the older ``.db`` files,
+which are listed by :py:func:`list_snapshots`.
+"""
+
+import os
+import re
+import json
+import glob
+import time
+import sqlite3
+import hashlib
+import threading
+
+try:
+    from urllib.parse import quote
+except ImportError:
+    from urllib import quote
+
+import cherrypy
+import validators
+
+from . import serverconfig
+from . import errorutils
+from . import workflowsources
+
+
+def get_settings():
+    """
+    :returns: The snapshot settings, with defaults filled in
+    :rtype: dict
+    """
+
+    settings = {'keep': 5, 'mmap_size': 268435456, 'max_age': 900}
+    settings.update(serverconfig.config_dict().get('snapshots', {}))
+
+    return settings
+
+
+_HELD = {}
+"""The number of holders of each snapshot path that is in use"""
+_HELD_LOCK = threading.Lock()
+
+
+def snapshot_dir(data_location):
+    """
+    :param data_location: The source of the errors, as passed to
+                          :py:func:`errorutils.add_to_database`
+    :type data_location: str or list
+    :returns: The directory that holds the snapshots for this source
+    :rtype: str
+    """
+
+    source = json.dumps(data_location, sort_keys=True)
+    name = re.sub(r'\W+', '_', os.path.basename(str(data_location)))[-40:]
+
+    return os.path.join(serverconfig.config_dict()['workspace'], 'snapshots',
+                        '%s_%s' % (name, hashlib.sha1(source.encode()).hexdigest()[:12]))
+
+
+def load_source(data_location):
+    """
+    Get the contents of a source and its hash.
+    Local files are hashed directly, so that they do not have to be parsed
+    when a snapshot for them already exists.
+    Urls that report a version through :py:func:`errorutils.url_version` are
+    hashed with that version, and are only downloaded when the snapshot is built.
+    Everything else is fetched and the errors are hashed.
+
+    :param data_location: The source of the errors, as passed to
+                          :py:func:`errorutils.add_to_database`
+    :type data_location: str or list
+    :returns: The hash of the contents and the data to pass
+              to :py:func:`errorutils.add_to_database`
+    :rtype: str, str or dict
+    """
+
+    if workflowsources.get_source() is None and \
+            isinstance(data_location, str) and os.path.isfile(data_location):
+        digest = hashlib.sha1()
+        with open(data_location, 'rb') as input_file:
+            for chunk in iter(lambda: input_file.read(1 << 20), b''):
+                digest.update(chunk)
+
+        return digest.hexdigest(), data_location
+
+    if workflowsources.get_source() is None and \
+            not isinstance(data_location, list) and validators.url(data_location):
+        version = errorutils.url_version(data_location)
+        if version is not None:
+            return (hashlib.sha1(json.dumps([data_location, version]).encode()).hexdigest(),
+                    data_location)
+
+    contents = errorutils.get_list_info(data_location) \
+        if isinstance(data_location, list) else \
+        (errorutils.open_location(data_location) or {})
+
+    return (hashlib.sha1(json.dumps(contents, sort_keys=True).encode()).hexdigest(),
+            contents)
+
+
+def connect(path, read_only=True):
+    """
+    Open a snapshot.
+    The snapshot is memory-mapped, up to the ``mmap_size`` setting.
+
+    :param str path: Location of the snapshot
+    :param bool read_only: If True, the snapshot is opened read-only,
+                           and is never created if it does not exist
+    :returns: A connection to the snapshot
+    :rtype: sqlite3.Connection
+    :raises sqlite3.OperationalError: if the snapshot is opened read-only and does not exist
+    """
+
+    if not read_only:
+        conn = sqlite3.connect(path, check_same_thread=False)
+    else:
+        try:
+            conn = sqlite3.connect('file:%s?mode=ro' % quote(os.path.abspath(path)),
+                                   uri=True, check_same_thread=False)
+        except TypeError:
+            # Python 2 cannot open databases read-only, so check that the file is there
+            if not os.path.isfile(path):
+                raise sqlite3.OperationalError('unable to open database file')
+            conn = sqlite3.connect(path, check_same_thread=False)
+
+    conn.execute('PRAGMA mmap_size=%i' % int(get_settings()['mmap_size']))
+
+    return conn
+
+
+def hold(path):
+    """
+    Keep a snapshot from being removed by :py:func:`prune` until it is released
+
+    :param str path: Location of the snapshot
+    """
+
+    with _HELD_LOCK:
+        path = os.path.abspath(path)
+        _HELD[path] = _HELD.get(path, 0) + 1
+
+
+def release(path):
+    """
+    Let a snapshot held by :py:func:`hold` be removed again
+
+    :param str path: Location of the snapshot
+    """
+
+    with _HELD_LOCK:
+        path = os.path.abspath(path)
+        if _HELD.get(path, 0) > 1:
+            _HELD[path] -= 1
+        else:
+            _HELD.pop(path, None)
+
+
+def list_snapshots(data_location):
+    """
+    :param data_location: The source of the errors
+    :type data_location: str or list
+    :returns: Paths to the snapshots of this source, with the most recently used first
+    :rtype: list
+    """
+
+    return sorted(glob.glob(os.path.join(snapshot_dir(data_location), '*.db')),
+                  key=os.path.getmtime, reverse=True)
+
+
+def prune(data_location):
+    """
+    Remove all but the most recent snapshots of a source.
+    Snapshots that are held are not removed.
+
+    :param data_location: The source of the errors
+    :type data_location: str or list
+    """
+
+    with _HELD_LOCK:
+        held = set(_HELD)
+
+    for old in list_snapshots(data_location)[int(get_settings()['keep']):]:
+        if os.path.abspath(old) in held:
+            continue
+        cherrypy.log('Removing old snapshot %s' % old)
+        os.remove(old)
+
+
+def build_errors(conn, contents):
+    """
+    Fills a new snapshot with only the errors of its source.
+    This can be passed as ``build`` to :py:func:`get_snapshot`.
+
+    :param sqlite3.Connection conn: Connection to the new snapshot
+    :param contents: Data to pass to :py:func:`errorutils.add_to_database`
+    :type contents: str or dict
+    """
+
+    curs = conn.cursor()
+
+    errorutils.create_table(curs)
+    errorutils.add_to_database(curs, contents)
+
+
+def get_snapshot(data_location, build=build_errors, max_age=None):
+    """
+    Get the snapshot of a source, building it if needed.
+
+    :param data_location: The source of the errors, as passed to
+                          :py:func:`errorutils.add_to_database`
+    :type data_location: str or list
+    :param build: A function that fills the database.
+                  It is passed an open ``sqlite3.Connection`` to the new snapshot
+                  and the data to pass to :py:func:`errorutils.add_to_database`.
+                  Defaults to :py:func:`build_errors`.
+    :type build: function
+    :param int max_age: If set, the snapshot is rebuilt after this many seconds,
+                        even if the source did not change.
+                        This is for snapshots that hold more than the source.
+    :returns: The path to the snapshot
+    :rtype: str
+    :raises Exception: if the snapshot cannot be built. Anything raised by ``build``
+                       is passed on after the partially built snapshot is removed.
+    """
+
+    digest, contents = load_source(data_location)
+
+    if max_age:
+        digest = hashlib.sha1(
+            ('%s_%i' % (digest, time.time() // max_age)).encode()).hexdigest()
+
+    directory = snapshot_dir(data_location)
+    path = os.path.join(directory, '%s.db' % digest)
+
+    if os.path.exists(path):
+        cherrypy.log('Reusing snapshot %s' % path)
+        # Mark as recently used, so that it is not pruned
+        os.utime(path, None)
+        return path
+
+    if not os.path.exists(directory):
+        try:
+            os.makedirs(directory)
+        except OSError:
+            # Another thread might have just made it
+            if not os.path.isdir(directory):
+                raise
+
+    temp_path = '%s.%i.%i.tmp' % (path, os.getpid(), threading.current_thread().ident)
+
+    cherrypy.log('Building snapshot %s' % path)
+
+    conn = sqlite3.connect(temp_path, check_same_thread=False)
+    try:
+        build(conn, contents)
+        conn.commit()
+    except Exception:
+        conn.close()
+        os.remove(temp_path)
+        raise
+
+    conn.close()
+
+    os.rename(temp_path, path)
+    prune(data_location)
+
+    return path
@@ -107,6 +107,10 @@ wfwebtool.fillSimilar = function () {
         url: '/similarwfs',
         data: {workflow: wf},            // Then we fill the list of multiple workflows
         success: function (data) {
+            // The server is still clustering the workflows
+            if (data.status == 'model not ready')
+                return;
+
             var button = document.getElementById("showmulti");
             button.style.display = '';
             var wfdiv = document.getElementById("wflist");
@@ -239,10 +239,20 @@ class WorkflowInfo(Info):
 
         # Is set first time get_explanation() is called
         self.explanations = None
+        # Filled by classifyerrors.get_index() and replaced on reset()
+        self.error_index = {}
 
     def __str__(self):
         return 'workflowinfo_%s' % self.workflow
 
+    def reset(self):
+        """
+        Reset the cache, and the explanations and index of errors built from it.
+        """
+        super(WorkflowInfo, self).reset()
+        self.explanations = None
+        self.error_index = {}
+
     @cached_json('workflow_params')
     def get_workflow_parameters(self):
         """
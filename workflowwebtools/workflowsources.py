@@ -0,0 +1,163 @@
+"""
+Sources of workflow lists, such as the workflows that are in manual assistance.
+
+In production, the lists come from the Unified Oracle database.
+The ``oracle`` list in ``config.yml`` is the arguments that would be passed to
+``cx_Oracle.connect``, either ``[user, password, dsn]`` or ``['user/password@dsn']``.
+Connections are taken from a session pool that is shared by every caller,
+instead of opening a new connection for each query.
+The size of the pool can be set with ``oracle_pool: {min: 1, max: 4}``.
+
+For tests and benchmarks, ``workflow_db`` can point to an SQLite file instead.
+The file should have a ``workflow`` table with the columns of the Unified table
+that are queried, such as ``NAME``, ``STATUS`` and ``WM_STATUS``.
+It is attached as ``CMS_UNIFIED_ADMIN``, so the same queries run unchanged.
+If both are given, ``oracle`` is used.
+"""
+
+import abc
+import json
+import sqlite3
+import threading
+
+import cx_Oracle
+
+from . import serverconfig
+
+
+MANUAL_QUERY = "SELECT NAME FROM CMS_UNIFIED_ADMIN.workflow WHERE lower(STATUS) LIKE '%manual%'"
+"""Query for the workflows that need manual assistance"""
+
+RUNNING_QUERY = "SELECT NAME FROM CMS_UNIFIED_ADMIN.WORKFLOW WHERE WM_STATUS LIKE 'running%'"
+"""Query for the workflows that are running"""
+
+
+class WorkflowSource(abc.ABCMeta('ABC', (object,), {})):
+    """The interface of a source of workflows"""
+
+    @abc.abstractmethod
+    def query(self, query, params=None):
+        """
+        :param str query: The SQL query to run
+        :param params: Parameters to bind to the query
+        :type params: list or dict
+        :returns: The rows of the result
+        :rtype: list of tuples
+        """
+
+    def workflows(self, query=MANUAL_QUERY):
+        """
+        :param str query: A query that selects a single column of workflow names
+        :returns: The names of the workflows
+        :rtype: list
+        """
+        return [row for row, in self.query(query)]
+
+    def close(self):
+        """Release any connections held by the source"""
+
+
+def _oracle_login(args):
+    """
+    :param list args: The arguments that would be passed to ``cx_Oracle.connect``
+    :returns: The user, password, and dsn
+    :rtype: tuple
+    """
+
+    if len(args) == 1:
+        user, rest = args[0].split('/', 1)
+        password, dsn = rest.rsplit('@', 1)
+        return user, password, dsn
+
+    return tuple(args[:3])
+
+
+class OracleSource(WorkflowSource):
+    """Runs queries on Oracle through a pool of sessions"""
+
+    def __init__(self, args, min_sessions=1, max_sessions=4):
+        """
+        :param list args: The arguments that would be passed to ``cx_Oracle.connect``
+        :param int min_sessions: The number of sessions to keep open
+        :param int max_sessions: The maximum number of sessions
+        """
+
+        user, password, dsn = _oracle_login(args)
+
+        self.pool = cx_Oracle.SessionPool( # pylint:disable=c-extension-no-member
+            user, password, dsn, min_sessions, max_sessions, 1, threaded=True)
+
+    def query(self, query, params=None):
+        conn = self.pool.acquire()
+        try:
+            curs = conn.cursor()
+            curs.execute(query, params or [])
+            output = [tuple(row) for row in curs]
+            curs.close()
+        finally:
+            self.pool.release(conn)
+
+        return output
+
+    def close(self):
+        self.pool.close()
+
+
+class SQLiteSource(WorkflowSource):
+    """Runs the same queries on a local SQLite file"""
+
+    def __init__(self, path):
+        """
+        :param str path: Location of the SQLite file
+        """
+
+        self.path = path
+
+    def query(self, query, params=None):
+        conn = sqlite3.connect(':memory:')
+        try:
+            conn.execute('ATTACH DATABASE ? AS CMS_UNIFIED_ADMIN', (self.path,))
+            output = list(conn.execute(query, params or []))
+        finally:
+            conn.close()
+
+        return output
+
+
+_SOURCES = {}
+_SOURCES_LOCK = threading.Lock()
+
+
+def get_source(config=None):
+    """
+    Get the workflow source that is set in a configuration.
+    Sources are shared by all callers with the same configuration.
+
+    :param dict config: The configuration. If not given, the server configuration is used.
+    :returns: The workflow source, or None if no source is configured
+    :rtype: WorkflowSource
+    """
+
+    if config is None:
+        config = serverconfig.config_dict()
+
+    if 'oracle' in config:
+        # The password is left out, so that it is not kept around in the key
+        user, _, dsn = _oracle_login(config['oracle'])
+        key = json.dumps(['oracle', user, dsn, config.get('oracle_pool', {})],
+                         sort_keys=True)
+    elif 'workflow_db' in config:
+        key = json.dumps(['sqlite', config['workflow_db']])
+    else:
+        return None
+
+    with _SOURCES_LOCK:
+        if key not in _SOURCES:
+            if 'oracle' in config:
+                pool = config.get('oracle_pool', {})
+                _SOURCES[key] = OracleSource(config['oracle'],
+                                             pool.get('min', 1), pool.get('max', 4))
+            else:
+                _SOURCES[key] = SQLiteSource(config['workflow_db'])
+
+        return _SOURCES[key]
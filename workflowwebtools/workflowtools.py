@@ -14,7 +14,6 @@ import json
 import time
 import datetime
 import threading
-import sqlite3
 
 import cherrypy
 
@@ -28,8 +27,11 @@ from workflowwebtools import reasonsmanip
 from workflowwebtools import listpage
 from workflowwebtools import globalerrors
 from workflowwebtools import clusterworkflows
+from workflowwebtools import neighbors
 from workflowwebtools import classifyerrors
-from workflowwebtools import actionshistorylink
+from workflowwebtools import featurestore
+from workflowwebtools import lockstats
+from workflowwebtools import errorutils
 from workflowwebtools.web.templates import render
 from workflowwebtools.predict import evaluate
 
@@ -38,14 +40,25 @@ from workflowwebtools import statuses
 
 class WorkflowTools(object):
 
-    RESET_LOCK = threading.Lock()
+    RESET_LOCK = lockstats.InstrumentedLock('RESET_LOCK')
 
     def __init__(self):
-        self.lock = threading.Lock()
-        self.wflock = threading.Lock()
-        self.readinesslock = threading.Lock()
-        self.seeworkflowlock = threading.Lock()
-        self.cluster()
+        self.lock = lockstats.InstrumentedLock('WorkflowTools.lock')
+        self.wflock = lockstats.InstrumentedLock('WorkflowTools.wflock')
+        self.readinesslock = lockstats.InstrumentedLock('WorkflowTools.readinesslock')
+        # Pages for different workflows can be built at the same time
+        self.workflowlocks = lockstats.InstrumentedLockDict('WorkflowTools.workflowlock')
+        # This stays None until the first clusterer is loaded or fit
+        self.clusterer = None
+        self.cluster_thread = None
+        # The last clusterer fit that failed, so it is not retried right away
+        self.cluster_failure = {'time': 0, 'error': None}
+        self.classify_thread = None
+        # The last snapshot that could not be classified, so it is not retried right away
+        self.classify_failure = {'version': None, 'time': 0, 'error': None}
+        # The workflows in manual assistance, as of the last update
+        self.manual_workflows = []
+        self.load_cluster()
         self.update()
 
         self.markedreset = set()
@@ -69,6 +82,7 @@ class WorkflowTools(object):
                     self.wflock.release()
                     if workflow_obj:
                         workflow_obj.reset()
+                    classifyerrors.forget(wf)
 
                 prep_obj = self.prepids.pop(pid, None)
                 if prep_obj:
@@ -85,10 +99,13 @@ class WorkflowTools(object):
         self.workflows = {}
 
         try:
-            for workflow in statuses.get_manual_workflows(
-                    serverconfig.config_dict()['data']['all_errors']):
+            manual_workflows = statuses.get_manual_workflows(
+                serverconfig.config_dict()['data']['all_errors'])
+            for workflow in manual_workflows:
                 self.get(workflow)
 
+            self.manual_workflows = sorted(manual_workflows)
+
             self.prepids = {
                 prepid: workflowinfo.PrepIDInfo(prepid) for prepid in
                 [info.get_prep_id() for info in self.workflows.values()]
@@ -116,6 +133,66 @@ class WorkflowTools(object):
         """
         return render('welcome.html')
 
+    def load_cluster(self):
+        """
+        Loads the clusterer stored in the workspace.
+        If it was fit to an older history or configuration,
+        it is used until a new one is fit in the background.
+        If there is no stored clusterer, a new one is fit in the background,
+        and :py:meth:`similarwfs` reports that the model is not ready until then.
+        """
+        key, self.clusterer = clusterworkflows.load_clusterer()
+
+        if self.clusterer is None:
+            cherrypy.log('No stored clusterer. Fitting in the background.')
+            self.start_cluster()
+        elif key != clusterworkflows.model_key(serverconfig.workflow_history_path()):
+            cherrypy.log('Stored clusterer is stale. Refitting in the background.')
+            self.start_cluster()
+        else:
+            cherrypy.log('Loaded clusterer from %s' % clusterworkflows.model_path())
+
+    def start_cluster(self):
+        """
+        Runs :py:meth:`fit_cluster` in a background thread,
+        unless one is already running.
+        The current clusterer is used until the new one replaces it.
+        """
+        with self.lock:
+            if self.cluster_thread is not None and self.cluster_thread.is_alive():
+                return
+
+            self.cluster_thread = threading.Thread(target=self.fit_cluster)
+            self.cluster_thread.daemon = True
+            self.cluster_thread.start()
+
+    def fit_cluster(self):
+        """
+        Fits a new clusterer, or updates the current one if ``cluster: incremental``
+        is set in the configuration, and stores it in the workspace.
+        This should only be run through :py:meth:`start_cluster`,
+        so that only one fit runs at a time.
+        If that fails, the failure is recorded in ``self.cluster_failure``.
+        """
+        data = serverconfig.config_dict()['data']
+        try:
+            if self.clusterer:
+                clusterer = clusterworkflows.update_clusterer(
+                    self.clusterer, data['workflow_history'], data['all_errors'])
+            else:
+                clusterer = clusterworkflows.get_clusterer(
+                    data['workflow_history'], data['all_errors'])
+
+            with self.lock:
+                self.clusterer = clusterer
+                self.cluster_failure = {'time': 0, 'error': None}
+
+            clusterworkflows.save_clusterer(clusterer, clusterer['key'])
+        except Exception as error:      # pylint: disable=broad-except
+            cherrypy.log('Could not fit clusterer: %s' % error)
+            with self.lock:
+                self.cluster_failure = {'time': time.time(), 'error': str(error)}
+
     @cherrypy.expose
     def cluster(self):
         """
@@ -126,13 +203,16 @@ class WorkflowTools(object):
         This is useful when the history database of past errors has been
         updated with relevant errors since the server has been started or
         this function has been called.
+        If ``cluster: incremental`` is set in the configuration,
+        only the new errors are folded into the existing clusters.
+        The clusters are regenerated in the background by :py:meth:`start_cluster`,
+        so nothing new is started if they are already being regenerated.
+        The new clusterer is stored in the workspace and loaded at the next start.
 
         :returns: a confirmation page
         :rtype: str
         """
-        data = serverconfig.config_dict()['data']
-        self.clusterer = clusterworkflows.get_clusterer(
-            data['workflow_history'], data['all_errors'])
+        self.start_cluster()
         return render('complete.html')
 
     @cherrypy.expose
@@ -156,6 +236,46 @@ class WorkflowTools(object):
     def predict(self, workflow):
         return evaluate.predict(self.get(workflow))
 
+    @cherrypy.expose
+    @cherrypy.tools.json_out()
+    def predictall(self, prepid=None):
+        """
+        Predicts the actions of many workflows with one pass through the model.
+
+        :param str prepid: If set, only the workflows of this PrepID are predicted.
+                           Otherwise, every workflow in manual assistance is predicted.
+        :returns: Object with the output of :py:meth:`predict` for each workflow.
+                  Workflows whose errors could not be fetched only have the key ``error``.
+        :rtype: JSON
+        """
+        if prepid:
+            prep_obj = self.prepids.get(prepid)
+            workflows = prep_obj.get_workflows() if prep_obj else []
+        else:
+            workflows = list(self.manual_workflows)
+
+        def get_errors(workflow):
+            try:
+                return self.get(workflow).get_errors(True), None
+            except Exception as error:      # pylint: disable=broad-except
+                cherrypy.log('Could not get errors of %s: %s' % (workflow, error))
+                return None, str(error)
+
+        errors = {}
+        failed = {}
+        for workflow, (workflow_errors, error) in zip(
+                workflows, errorutils.thread_map(get_errors, workflows,
+                                                 'Getting errors for predictions')):
+            if error is None:
+                errors[workflow] = workflow_errors
+            else:
+                failed[workflow] = {'error': error}
+
+        output = evaluate.predict_all(errors)
+        output.update(failed)
+
+        return output
+
     def get_status(self, workflow):
         status = self.statuses.get(workflow)
         if status is None:
@@ -288,7 +408,7 @@ class WorkflowTools(object):
         get_names = lambda x: [globalerrors.TITLEMAP[name]
                                for name in globalerrors.get_row_col_names(x)]
 
-        template = lambda: render(
+        return render(
             'globalerror.html',
             errors=errors,
             decoder=json.dumps,
@@ -300,13 +420,6 @@ class WorkflowTools(object):
             get_names=get_names
             )
 
-        try:
-            return template()
-        # I don't remember what kind of exception this throws...
-        except Exception: # pylint: disable=broad-except
-            time.sleep(1)
-            return template()
-
     @cherrypy.expose
     @cherrypy.tools.json_out()
     def getreasons(self):
@@ -411,18 +524,17 @@ class WorkflowTools(object):
                  Resets personal cache in the meanwhile, just in case
         """
 
-        self.seeworkflowlock.acquire()
+        lock = self.workflowlocks.get(workflow)
+        lock.acquire()
 
         output = ''
 
         try:
-            if workflow not in \
-                    globalerrors.check_session(
-                            cherrypy.session, can_refresh=True).return_workflows():
+            if not globalerrors.check_session(
+                    cherrypy.session, can_refresh=True).has_workflow(workflow):
                 WorkflowTools.RESET_LOCK.acquire()
                 info = globalerrors.check_session(cherrypy.session)
                 if info:
-                    info.teardown()
                     info.setup()
                 WorkflowTools.RESET_LOCK.release()
 
@@ -444,7 +556,7 @@ class WorkflowTools(object):
                 last_submitted=manageactions.get_datetime_submitted(workflow)
                 )
         finally:
-            self.seeworkflowlock.release()
+            lock.release()
 
         return output
 
@@ -529,22 +641,43 @@ class WorkflowTools(object):
 
         :param str workflow: The workflow to find the group.
         :returns: List of similar workflows.
-                  If the quey is not a valid workflow in the system, an empty list is returned
+                  If the quey is not a valid workflow in the system, an empty list is returned.
+                  The status is 'model not ready' if the server is still fitting
+                  its first clusterer, 'failed' with the ``error`` if that fit failed,
+                  and 'ok' otherwise.
+                  A failed fit is tried again after ``cluster: retry_after`` seconds.
         :rtype: JSON
         """
-        output = {'similar': [], 'acted': []}
+        # A new clusterer can replace this one at any time, but this request keeps using it
+        with self.lock:
+            clusterer = self.clusterer
+            failure = dict(self.cluster_failure)
 
-        self.seeworkflowlock.acquire()
+        if clusterer is None:
+            if failure['error'] is not None:
+                retry_after = float(
+                    serverconfig.config_dict()['cluster'].get('retry_after', 600))
+                if time.time() - failure['time'] < retry_after:
+                    return {'similar': [], 'acted': [], 'status': 'failed',
+                            'error': failure['error']}
+
+                self.start_cluster()
+
+            return {'similar': [], 'acted': [], 'status': 'model not ready'}
+
+        output = {'similar': [], 'acted': [], 'status': 'ok'}
+
+        lock = self.workflowlocks.get(workflow)
+        lock.acquire()
 
         try:
-            if workflow in \
-                    globalerrors.check_session(cherrypy.session,
-                                               can_refresh=True).return_workflows():
+            if globalerrors.check_session(cherrypy.session,
+                                          can_refresh=True).has_workflow(workflow):
 
                 clusterworkflows.CLUSTER_LOCK.acquire()
 
                 similar_wfs = clusterworkflows.\
-                    get_clustered_group(workflow, self.clusterer, cherrypy.session)
+                    get_clustered_group(workflow, clusterer, cherrypy.session)
 
                 clusterworkflows.CLUSTER_LOCK.release()
 
@@ -554,13 +687,42 @@ class WorkflowTools(object):
                 ]
 
                 output = {'similar': sorted(list(similar_wfs)),
-                          'acted': acted}
+                          'acted': acted,
+                          'status': 'ok'}
         finally:
-            self.seeworkflowlock.release()
+            lock.release()
 
         return output
 
 
+    @cherrypy.expose
+    @cherrypy.tools.json_out()
+    def neighbors(self, workflow, k=None):
+        """
+        Gives back the workflows with the errors that are most similar to the queried workflow.
+        These include past workflows that had actions submitted.
+        See :py:mod:`WorkflowWebTools.neighbors` for how similarity is measured.
+
+        :param str workflow: The workflow to find neighbors for
+        :param int k: The maximum number of workflows to return.
+                      If there are fewer other workflows, all of them are returned.
+        :returns: Object with the key 'neighbors', which is a list of objects
+                  with the keys 'workflow', 'distance', and 'current', closest first.
+                  If the workflow does not have errors, the list is empty.
+        :rtype: JSON
+        :raises: cherrypy.HTTPError 400 if k is not a positive integer
+        """
+        if k:
+            try:
+                k = int(k)
+            except ValueError:
+                k = 0
+
+            if k < 1:
+                raise cherrypy.HTTPError(400, 'k must be a positive integer')
+
+        return {'neighbors': neighbors.get_neighbors(workflow, k or None, cherrypy.session)}
+
     @cherrypy.expose
     @cherrypy.tools.json_out()
     def classifyerror(self, workflow):
@@ -577,21 +739,90 @@ class WorkflowTools(object):
         """
 
         output = {}
-        self.seeworkflowlock.acquire()
+        lock = self.workflowlocks.get(workflow)
+        lock.acquire()
 
         try:
-            max_error = classifyerrors.get_max_errorcode(self.get(workflow))
-            main_error_class = classifyerrors.classifyerror(max_error, self.get(workflow))
-
-            output = {
-                'maxerror': max_error,
-                'types': main_error_class[0],
-                'recommended': main_error_class[1],
-                'params': main_error_class[2]
-            }
+            output = classifyerrors.describe(*classifyerrors.classify_workflow(
+                self.get(workflow), globalerrors.check_session(cherrypy.session).db_path))
 
         finally:
-            self.seeworkflowlock.release()
+            lock.release()
+
+        return output
+
+    def start_classify(self, workflows, version):
+        """
+        Classifies every workflow of a snapshot in a background thread,
+        unless a classification is already running.
+        The results are stored in the workspace when all workflows are done.
+        If that fails, the failure is recorded in ``self.classify_failure``.
+
+        :param list workflows: The workflows in the snapshot
+        :param str version: The path of the snapshot
+        """
+        def classify():
+            try:
+                classifyerrors.save_classifications(
+                    classifyerrors.classify_all(workflows), version)
+            except Exception as error:      # pylint: disable=broad-except
+                cherrypy.log('Could not classify %s: %s' % (version, error))
+                with self.lock:
+                    self.classify_failure = {'version': version, 'time': time.time(),
+                                             'error': str(error)}
+
+        with self.lock:
+            if self.classify_thread is not None and self.classify_thread.is_alive():
+                return
+
+            self.classify_thread = threading.Thread(target=classify)
+            self.classify_thread.daemon = True
+            self.classify_thread.start()
+
+    @cherrypy.expose
+    @cherrypy.tools.json_out()
+    def classifyall(self):
+        """
+        Gives the output of :py:meth:`classifyerror` for every workflow in the current errors,
+        so that the recommended procedures for the whole queue can be read at once.
+        The workflows are classified by a pool of threads in the background
+        the first time this is requested for a snapshot of the errors.
+        Until then, the classifications of the previous snapshot are returned.
+        If classifying a snapshot fails, it is only tried again after
+        ``classify: retry_after`` seconds.
+
+        :returns: Object with the keys:
+
+                  - ``status`` -- 'ok' if the classifications are for the current errors,
+                    'running' if they are still being made,
+                    and 'failed' if they could not be made recently
+                  - ``updated`` -- When the classifications were stored, in seconds since epoch
+                  - ``workflows`` -- The output of :py:meth:`classifyerror` for each workflow.
+                    Workflows that could not be classified only have the key ``error``.
+                  - ``error`` -- Why the classifications could not be made, if they failed
+
+        :rtype: JSON
+        """
+        errorinfo = globalerrors.check_session(cherrypy.session, can_refresh=True)
+        stored = classifyerrors.load_classifications()
+
+        output = {'status': 'ok',
+                  'updated': stored['updated'],
+                  'workflows': stored['workflows']}
+
+        if stored['version'] != errorinfo.db_path:
+            retry_after = float(
+                serverconfig.config_dict().get('classify', {}).get('retry_after', 600))
+
+            with self.lock:
+                failure = dict(self.classify_failure)
+
+            if failure['version'] == errorinfo.db_path and \
+                    time.time() - failure['time'] < retry_after:
+                output.update(status='failed', error=failure['error'])
+            else:
+                output['status'] = 'running'
+                self.start_classify(errorinfo.return_workflows(), errorinfo.db_path)
 
         return output
 
@@ -622,14 +853,55 @@ class WorkflowTools(object):
 
     @cherrypy.expose
     @cherrypy.tools.json_out()
-    def actionshistory(self):
+    def lockstats(self, sites=10):
+        """
+        Reports how the server's locks have been used since the server started.
+        This can be used to see which lock is limiting the throughput under load.
+
+        :param int sites: The maximum number of call sites to show for each lock
+        :returns: A list of locks, ordered by the total time spent waiting for them.
+                  Each lock reports the number of acquisitions, the number that had to wait,
+                  histograms of the wait and hold times in seconds,
+                  and the call sites that held the lock the longest.
+        :rtype: JSON
+        """
+        return lockstats.report(int(sites))
+
+    @cherrypy.expose
+    @cherrypy.tools.json_out()
+    def predictstats(self):
+        """
+        Reports how long the action predictor has spent loading its model
+        and making predictions since the server started.
+        The model is only loaded again when its files change.
+
+        :returns: Histograms of the times in seconds, under the keys 'load' and 'predict'
+        :rtype: JSON
+        """
+        return evaluate.get_predictor().stats()
+
+    @cherrypy.expose
+    @cherrypy.tools.json_out()
+    def actionshistory(self, start=None, end=None):
         """
         This API gives the sparse matrix that can be used for training.
+        It is read from :py:mod:`WorkflowWebTools.featurestore`,
+        after adding any acted workflows that are not in the store yet.
 
-        :returns: History of actions on workflows
+        :param int start: Only give the subtasks added at or after this time, if set
+        :param int end: Only give the subtasks added before this time, if set
+        :returns: History of actions on workflows, in the same form as
+                  :py:func:`WorkflowWebTools.actionshistorylink.dump_json`
         :rtype: JSON
         """
-        return actionshistorylink.dump_json()
+        try:
+            start = None if start is None else int(start)
+            end = None if end is None else int(end)
+        except ValueError:
+            raise cherrypy.HTTPError(400, 'start and end must be integers')
+
+        featurestore.backfill()
+        return featurestore.dump_json(start=start, end=end)
 
     @cherrypy.expose
     def submitaction(self, workflows='', action='', **kwargs):
@@ -652,7 +924,8 @@ class WorkflowTools(object):
 
         output = ''
 
-        self.seeworkflowlock.acquire()
+        locks = self.workflowlocks.acquire(
+            workflows if isinstance(workflows, list) else [workflows])
         try:
 
             workflows, reasons, params = manageactions.\
@@ -692,7 +965,7 @@ class WorkflowTools(object):
                                 user=cherrypy.request.login)
 
         finally:
-            self.seeworkflowlock.release()
+            self.workflowlocks.release(locks)
 
         return output
 
@@ -758,6 +1031,9 @@ class WorkflowTools(object):
                   - `'already_reported'` - List of workflows that were already removed
                   - `'does_not_exist'` - List of workflows that the database does not know
 
+        The errors and actions of the workflows that are marked as acted on
+        are added to the training data in :py:mod:`WorkflowWebTools.featurestore`.
+
         :rtype: JSON
         """
 
@@ -773,6 +1049,12 @@ class WorkflowTools(object):
             # This output is added to by passing reference to manageactions.report_actions
             manageactions.report_actions(input_json['workflows'], output)
 
+            try:
+                featurestore.add_workflows(output['success'])
+            except Exception as error:      # pylint: disable=broad-except
+                # Training data is not worth failing the report for
+                cherrypy.log('Could not add to feature store: %s' % error)
+
         return output
 
 
@@ -917,12 +1199,12 @@ class WorkflowTools(object):
             for wkf in workflows:
                 info.get_workflow(wkf).get_errors()
                 info.get_workflow(wkf).reset()
+                classifyerrors.forget(wkf)
 
             if not workflow:
                 for pid in prepids:
                     info.prepidinfos[pid].reset()
 
-            info.teardown()
             info.setup()
 
         WorkflowTools.RESET_LOCK.release()
@@ -952,12 +1234,7 @@ class WorkflowTools(object):
             manageactions.get_acted_workflows(
                 serverconfig.get_history_length())
 
-        # Retry after ProgrammingError
-        try:
-            info = listpage.listworkflows(errorcode, sitename, workflow, cherrypy.session)
-        except sqlite3.ProgrammingError:
-            time.sleep(5)
-            return self.listpage(errorcode, sitename, workflow)
+        info = listpage.listworkflows(errorcode, sitename, workflow, cherrypy.session)
 
         return render('listworkflows.html',
                       workflow=workflow,